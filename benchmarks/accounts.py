@@ -0,0 +1,114 @@
+"""
+Benchmark the bank accounts with synthetic users.
+
+The __slots__ BankUser is compared with the account it replaced: a dataclass built from the stored dict
+and turned back into a dict with dataclasses.asdict on every write.
+Memory of the accounts of every user is measured with tracemalloc,
+reads, writes and attribute lookups in nanoseconds per account.
+
+Usage: python -m benchmarks.accounts [--users 100000 1000000] [--output FILE]
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+import tracemalloc
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Callable
+
+from useless_bot import __version__
+from useless_bot.core.accounts import BankUser
+
+from .codecs import users_table
+
+
+@dataclass()
+class DataclassUser:
+    user_id: int
+    balance: int = 50
+    last_free_credits: int = 0
+
+
+def _memory(build: Callable, table: dict) -> int:
+    """Bytes allocated by the accounts built from table"""
+    gc.collect()
+    tracemalloc.start()
+    accounts = build(table)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del accounts
+    return size
+
+
+def _per_account(repeat: int, count: int, func: Callable) -> float:
+    """Best time of func, in nanoseconds per account"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        best = min(best, perf_counter() - start)
+    return best / count * 1e9
+
+
+def measure(layout: str, table: dict, repeat: int) -> dict:
+    if layout == "dataclass":
+        def build(users: dict) -> list:
+            return [DataclassUser(**user) for user in users.values()]
+
+        def write():
+            for account in accounts:
+                asdict(account)
+    else:
+        def build(users: dict) -> list:
+            return [BankUser(user["user_id"], user["balance"]) for user in users.values()]
+
+        def write():
+            for account in accounts:
+                account.to_dict()
+
+    accounts = build(table)
+
+    def lookup():
+        for account in accounts:
+            account.balance
+
+    return {
+        "memory": _memory(build, table),
+        "read": _per_account(repeat, len(table), lambda: build(table)),
+        "write": _per_account(repeat, len(table), write),
+        "lookup": _per_account(repeat, len(table), lookup),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each measure, the best is kept")
+    parser.add_argument("--output", default="accounts_report.json")
+    args = parser.parse_args()
+
+    report = {
+        "version": __version__,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": [],
+    }
+
+    for users in args.users:
+        table = users_table(users)
+        for layout in ("dataclass", "slots"):
+            print(f"Benchmarking {layout} with {users} users", file=sys.stderr)
+            report["results"].append({"layout": layout, "users": users, **measure(layout, table, args.repeat)})
+
+    with open(args.output, "w") as fp:
+        json.dump(report, fp, indent=2)
+
+    print(f"Report written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
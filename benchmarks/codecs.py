@@ -0,0 +1,102 @@
+"""
+Benchmark the codecs of the storage drivers with synthetic bank users.
+
+Two layouts are measured: the whole users table encoded at once, like a Json snapshot,
+and every value encoded on its own, like the entries of a Shelve shard.
+Codecs whose library is not installed are reported as unavailable.
+
+Usage: python -m benchmarks.codecs [--users 1000 100000] [--codecs pickle orjson msgpack] [--output FILE]
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Any, Callable
+
+from useless_bot import __version__
+from useless_bot.core.drivers.codecs import CODECS, Codec, get_codec
+
+from .storage import SEED, user_ids
+
+
+def users_table(users: int) -> dict:
+    rng = random.Random(SEED)
+    return {
+        user_id: {"user_id": user_id, "balance": rng.randrange(2 ** 32), "last_free_credits": rng.randrange(2 ** 31)}
+        for user_id in user_ids(users)
+    }
+
+
+def leaves(table: dict) -> list[Any]:
+    """Values stored one by one, as the drivers store them"""
+    return [value for user in table.values() for value in user.values()]
+
+
+def _best_of(repeat: int, func: Callable) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def measure(codec: Codec, table: dict, repeat: int) -> dict:
+    raw_table = codec.encode(table)
+    values = leaves(table)
+    raw_values = [codec.encode(value) for value in values]
+
+    return {
+        "table": {
+            "size": len(raw_table),
+            "encode": _best_of(repeat, lambda: codec.encode(table)),
+            "decode": _best_of(repeat, lambda: codec.decode(raw_table)),
+        },
+        "values": {
+            "size": sum(len(raw_value) for raw_value in raw_values),
+            "encode": _best_of(repeat, lambda: [codec.encode(value) for value in values]),
+            "decode": _best_of(repeat, lambda: [codec.decode(raw_value) for raw_value in raw_values]),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1_000, 100_000])
+    parser.add_argument("--codecs", nargs="+", choices=CODECS, default=list(CODECS))
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each measure, the best is kept")
+    parser.add_argument("--output", default="codecs_report.json")
+    args = parser.parse_args()
+
+    report = {
+        "version": __version__,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": [],
+    }
+
+    for users in args.users:
+        table = users_table(users)
+        for name in args.codecs:
+            for codec_name in (name, f"{name}+zstd"):
+                print(f"Benchmarking {codec_name} with {users} users", file=sys.stderr)
+                result = {"codec": codec_name, "users": users}
+                try:
+                    result.update(measure(get_codec(codec_name), table, args.repeat))
+                except NameError:
+                    # the library of the codec is not installed
+                    result["unavailable"] = True
+                report["results"].append(result)
+
+    with open(args.output, "w") as fp:
+        json.dump(report, fp, indent=2)
+
+    print(f"Report written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""
+Benchmark the storage drivers through Config with synthetic bank users.
+
+Every driver and dataset size runs in its own process, so the class-level state of the drivers
+and the memory usage of a run never leak into the next one.
+Redis runs on an in-process fakeredis server, so its data is populated and measured in the same process,
+its memory is in the rss of the process and it has no file size. It is reported as unavailable
+when fakeredis or lupa (to run the Lua scripts of the driver) is not installed.
+Latencies of Redis leave out the network round trips of a real server.
+
+Usage: python -m benchmarks.storage [--users 1000 100000 1000000] [--drivers shelve json sqlite redis] [--output FILE]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from statistics import quantiles
+from time import perf_counter
+from typing import Callable, Optional
+
+try:
+    import fakeredis
+    # the Redis driver runs Lua scripts
+    import lupa
+except ImportError:
+    fakeredis = None
+
+from useless_bot import __version__
+from useless_bot.core.config import Config
+from useless_bot.core.drivers import Base, Shelve, Json, Sqlite, Redis
+
+COG = "BankCore"
+SEED = 42
+
+
+def _shelve(directory: str) -> Base:
+    return Shelve(file=os.path.join(directory, "config"), directory=os.path.join(directory, "shelve"))
+
+
+def _json(directory: str) -> Base:
+    return Json(file=os.path.join(directory, "config.json"), directory=os.path.join(directory, "json"))
+
+
+def _sqlite(directory: str) -> Base:
+    return Sqlite(file=os.path.join(directory, "config.sqlite3"))
+
+
+# server of the fakeredis clients, living as long as the process
+_redis_server: Optional["fakeredis.FakeServer"] = None
+
+
+def _redis(directory: str) -> Base:
+    global _redis_server
+    if _redis_server is None:
+        _redis_server = fakeredis.FakeServer()
+    return Redis(client=fakeredis.FakeAsyncRedis(server=_redis_server))
+
+
+DRIVERS: dict[str, Callable[[str], Base]] = {
+    "shelve": _shelve,
+    "json": _json,
+    "sqlite": _sqlite,
+    "redis": _redis,
+}
+
+# drivers keeping their data in the process: both phases run in the same process
+IN_PROCESS = {"redis"}
+
+
+def user_ids(users: int) -> list[int]:
+    """Snowflake-like ids, the same for every driver"""
+    rng = random.Random(SEED)
+    return [(1 << 56) + rng.getrandbits(48) * 1024 + i for i in range(users)]
+
+
+def rss() -> int:
+    """Resident memory of this process, in bytes"""
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        # peak memory: bytes on macOS, kilobytes everywhere else
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def file_size(directory: str) -> int:
+    size = 0
+    for root, _, files in os.walk(directory):
+        size += sum(os.path.getsize(os.path.join(root, file)) for file in files)
+    return size
+
+
+def percentiles(samples: list[float]) -> dict:
+    """Latency summary, in milliseconds"""
+    if len(samples) < 2:
+        return {"count": len(samples)}
+
+    points = quantiles(samples, n=100, method="inclusive")
+    return {
+        "count": len(samples),
+        "p50": points[49] * 1000,
+        "p90": points[89] * 1000,
+        "p99": points[98] * 1000,
+        "max": max(samples) * 1000,
+    }
+
+
+async def _timed(samples: list[float], coroutine):
+    start = perf_counter()
+    await coroutine
+    samples.append(perf_counter() - start)
+
+
+async def populate(driver_name: str, users: int, directory: str) -> dict:
+    ids = user_ids(users)
+    rng = random.Random(SEED)
+    config = Config(COG, schema={"users": {}}, driver=DRIVERS[driver_name](directory))
+
+    start = perf_counter()
+    await config.set(("users",), {
+        user_id: {"user_id": user_id, "balance": rng.randrange(2 ** 32), "last_free_credits": rng.randrange(2 ** 31)}
+        for user_id in ids
+    })
+    # wait for background work, like journal compaction
+    await asyncio.gather(*(task for task in asyncio.all_tasks() if task is not asyncio.current_task()))
+
+    return {"populate_time": perf_counter() - start}
+
+
+async def measure(driver_name: str, users: int, directory: str, samples: int, budget: float) -> dict:
+    ids = user_ids(users)
+    rng = random.Random(SEED + 1)
+
+    # deleted users are never read or written again
+    victims = rng.sample(ids, min(samples, users // 2))
+    deleted = set(victims)
+    ids = [user_id for user_id in ids if user_id not in deleted]
+
+    # startup: driver and Config creation load the data
+    start = perf_counter()
+    driver = DRIVERS[driver_name](directory)
+    config = Config(COG, schema={"users": {}}, driver=driver, write_behind=True)
+    await config.get(("users", ids[0]))
+    startup_time = perf_counter() - start
+    memory = rss()
+
+    results = {"startup_time": startup_time, "rss": memory}
+
+    async def run(name: str, operation: Callable, count: int = samples):
+        latencies = []
+        deadline = perf_counter() + budget
+        for _ in range(count):
+            await _timed(latencies, operation())
+            if perf_counter() > deadline:
+                break
+        results[name] = percentiles(latencies)
+
+    # sets and deletes are saved right away, like a Config without write-behind
+    await run("get", lambda: config.get(("users", rng.choice(ids), "balance")))
+    await run("set", lambda: _saved(config, config.set(("users", rng.choice(ids), "balance"), rng.randrange(2 ** 32))))
+
+    # every victim is deleted once, there can be fewer than samples
+    victims_left = iter(victims)
+    await run("delete", lambda: _saved(config, config.delete(("users", next(victims_left)))), len(victims))
+
+    # dump of a single change
+    dumps = []
+    for _ in range(min(samples, 20)):
+        await config.set(("users", rng.choice(ids), "balance"), 0)
+        await _timed(dumps, driver.dump())
+    results["dump"] = percentiles(dumps)
+
+    await Config.flush_all()
+    await asyncio.gather(*(task for task in asyncio.all_tasks() if task is not asyncio.current_task()))
+    results["file_size"] = file_size(directory)
+    return results
+
+
+async def _saved(config: Config, coroutine):
+    await coroutine
+    await config.save()
+
+
+def _worker(args: argparse.Namespace):
+    if args.phase == "populate":
+        result = asyncio.run(populate(args.driver, args.users[0], args.directory))
+    elif args.phase == "both":
+        async def both() -> dict:
+            populated = await populate(args.driver, args.users[0], args.directory)
+            return {**populated, **await measure(args.driver, args.users[0], args.directory, args.samples,
+                                                 args.budget)}
+
+        result = asyncio.run(both())
+    else:
+        result = asyncio.run(measure(args.driver, args.users[0], args.directory, args.samples, args.budget))
+
+    print(json.dumps(result))
+
+
+def _spawn(args: argparse.Namespace, phase: str, driver_name: str, users: int, directory: str) -> dict:
+    command = [sys.executable, "-m", "benchmarks.storage", "--worker", phase, "--drivers", driver_name,
+               "--users", str(users), "--directory", directory,
+               "--samples", str(args.samples), "--budget", str(args.budget)]
+    process = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True)
+    return json.loads(process.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1_000, 100_000, 1_000_000])
+    parser.add_argument("--drivers", nargs="+", choices=DRIVERS, default=list(DRIVERS))
+    parser.add_argument("--samples", type=int, default=1000, help="operations measured for each latency")
+    parser.add_argument("--budget", type=float, default=30, help="maximum seconds spent on each latency")
+    parser.add_argument("--output", default="storage_report.json")
+    parser.add_argument("--worker", dest="phase", choices=["populate", "measure", "both"], help=argparse.SUPPRESS)
+    parser.add_argument("--directory", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phase is not None:
+        args.driver = args.drivers[0]
+        _worker(args)
+        return
+
+    report = {
+        "version": __version__,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": [],
+    }
+
+    for users in args.users:
+        for driver_name in args.drivers:
+            print(f"Benchmarking {driver_name} with {users} users", file=sys.stderr)
+            with tempfile.TemporaryDirectory(prefix="useless_bot-bench-") as directory:
+                result = {"driver": driver_name, "users": users}
+                if driver_name == "redis" and fakeredis is None:
+                    result["unavailable"] = True
+                elif driver_name in IN_PROCESS:
+                    result.update(_spawn(args, "both", driver_name, users, directory))
+                else:
+                    result.update(_spawn(args, "populate", driver_name, users, directory))
+                    result.update(_spawn(args, "measure", driver_name, users, directory))
+                report["results"].append(result)
+
+    with open(args.output, "w") as fp:
+        json.dump(report, fp, indent=2)
+
+    print(f"Report written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
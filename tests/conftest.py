@@ -0,0 +1,79 @@
+import asyncio
+import os
+
+import pytest
+
+from useless_bot.core.bank_core import BankCore
+from useless_bot.core.config import Config
+from useless_bot.core.drivers import Base, Json, Redis, Shelve, Sqlite
+from useless_bot.core.metrics import metrics
+from useless_bot.core.ttl import Sweeper
+
+
+class User:
+    """Like discord users, compared by id"""
+
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, User) and other.id == self.id
+
+    def __hash__(self) -> int:
+        return self.id >> 22
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def reset_drivers(monkeypatch):
+    """Forget the data drivers keep between instances, like a restart of the bot"""
+    for driver in (Json, Shelve):
+        monkeypatch.setattr(driver, "_shards", {})
+        monkeypatch.setattr(driver, "_loading", {})
+        monkeypatch.setattr(driver, "_schemas", {})
+        monkeypatch.setattr(driver, "_legacy", None)
+        monkeypatch.setattr(driver, "_closing", {})
+    monkeypatch.setattr(Sqlite, "_data", None)
+    monkeypatch.setattr(Sqlite, "_schemas", {})
+    monkeypatch.setattr(Redis, "_data", None)
+    monkeypatch.setattr(Redis, "_schemas", {})
+    monkeypatch.setattr(Redis, "_registering", {})
+    monkeypatch.setattr(Base, "_groups", {})
+    monkeypatch.setattr(Base, "_claims", {})
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    # drivers, configs and the bank share their state between instances: start every test from scratch
+    reset_drivers(monkeypatch)
+    monkeypatch.setattr(Base, "max_blocking_time", 0)
+    monkeypatch.setattr(Config, "_locks", {})
+    monkeypatch.setattr(Config, "_versions", {})
+    monkeypatch.setattr(Config, "_expirations", {})
+    monkeypatch.setattr(Config, "_drivers", {})
+    monkeypatch.setattr(Config, "_schedulers", {})
+    monkeypatch.setattr(Config, "_sweeper", Sweeper())
+    monkeypatch.setattr(BankCore, "_leaderboard", None)
+    monkeypatch.setattr(BankCore, "_loading", None)
+    monkeypatch.setattr(BankCore, "_ledger", None)
+    metrics.reset()
+
+    yield
+
+    if Sqlite._data is not None:
+        Sqlite._data.close()
+
+
+def open_driver(name: str, directory: str) -> Base:
+    if name == "json":
+        return Json(file=os.path.join(directory, "config.json"), directory=os.path.join(directory, "json"))
+    if name == "shelve":
+        return Shelve(file=os.path.join(directory, "config"), directory=os.path.join(directory, "shelve"))
+    return Sqlite(file=os.path.join(directory, "config.sqlite3"))
+
+
+@pytest.fixture()
+def json_driver(tmp_path) -> Json:
+    return open_driver("json", str(tmp_path))
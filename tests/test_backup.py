@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from conftest import open_driver, run
+from useless_bot.core import backup
+
+DATA = {"users": {1: {"balance": 10}, "1": {"balance": 20}, 2: {}}, "free_credits": 15}
+
+
+def test_export_restore(tmp_path):
+    async def main():
+        source = open_driver("json", str(tmp_path))
+        source.register("Bank", schema=DATA, override_schema=False)
+        source.register("Other", schema={}, override_schema=False)
+        await source.set("Other", ("name",), "a")
+        await source.get("Bank", ())
+
+        file = os.path.join(tmp_path, "backup.gz")
+        progress = []
+        assert await backup.export(source, file, chunk_size=2, progress=lambda *args: progress.append(args)) == 8
+        assert progress[-1] == ("Other", 8)
+        assert not os.path.exists(f"{file}.tmp")
+
+        target = open_driver("sqlite", str(tmp_path))
+        target.register("Bank", schema={}, override_schema=False)
+        await target.set("Bank", ("stale",), 1)
+        assert await backup.restore(target, file) == 8
+
+        # the data in the backup replaces the data of the cog
+        assert await target.get("Bank", ()) == DATA
+        assert await target.get("Other", ()) == {"name": "a"}
+
+        await source.commit()
+
+    run(main())
+
+
+def test_restore_incomplete(tmp_path):
+    async def main():
+        source = open_driver("json", str(tmp_path))
+        source.register("Bank", schema=DATA, override_schema=False)
+
+        file = os.path.join(tmp_path, "backup.gz")
+        await backup.export(source, file)
+        with open(file, "rb") as fp:
+            data = fp.read()
+        with open(file, "wb") as fp:
+            fp.write(data[:len(data) // 2])
+
+        target = open_driver("sqlite", str(tmp_path))
+        with pytest.raises((ValueError, EOFError)):
+            await backup.restore(target, file)
+
+        await source.commit()
+
+    run(main())
+
+
+def test_migrate(tmp_path):
+    async def main():
+        source = open_driver("json", str(tmp_path))
+        source.register("Bank", schema=DATA, override_schema=False)
+
+        target = open_driver("shelve", str(tmp_path))
+        assert await backup.migrate(source, target, cogs=["Bank"]) == 7
+        assert await target.get("Bank", ()) == DATA
+
+        await source.commit()
+
+    run(main())
@@ -0,0 +1,92 @@
+import asyncio
+from contextlib import suppress
+from random import Random
+
+from conftest import User, run
+from useless_bot.core.bank_core import BankCore
+from useless_bot.core.config import Config
+from useless_bot.core.errors import BalanceUnderLimitError
+from useless_bot.core.ledger import Kind, Ledger
+
+
+def test_move_keeps_total(json_driver):
+    async def main():
+        bank = BankCore(driver=json_driver)
+        for user_id in range(20):
+            await bank.add_user(user_id)
+
+        # a move to the same user changes nothing
+        await bank.move(User(1), User(1), 1900)
+        assert (await bank.get_user(1)).balance == 50
+
+        async def move(from_id: int, to_id: int):
+            try:
+                await bank.move(User(from_id), User(to_id), 30)
+            except BalanceUnderLimitError:
+                pass
+
+        random = Random(0)
+        await asyncio.gather(*(move(random.randrange(20), random.randrange(20)) for _ in range(500)))
+
+        balances = [(await bank.get_user(user_id)).balance for user_id in range(20)]
+        assert sum(balances) == 20 * 50
+
+        await Config.flush_all()
+
+    run(main())
+
+
+def test_leaderboard_loaded_once(json_driver, monkeypatch):
+    async def main():
+        bank = BankCore(driver=json_driver)
+        for user_id in range(30):
+            await bank.add_user(user_id)
+            await bank.deposit(user_id, user_id)
+
+        loads = 0
+        load = BankCore._load
+
+        async def counted(self):
+            nonlocal loads
+            loads += 1
+            await load(self)
+
+        monkeypatch.setattr(BankCore, "_load", counted)
+        bank.load()
+        # called while the load runs, they wait for the same load and see the whole leaderboard
+        top, rank = await asyncio.gather(bank.top(3), bank.rank(0))
+        assert loads == 1
+        assert top == [(29, 79), (28, 78), (27, 77)]
+        assert rank == (30, 30)
+
+        await Config.flush_all()
+
+    run(main())
+
+
+def test_ledger_records_accounts_changed(json_driver, tmp_path, monkeypatch):
+    async def main():
+        bank = BankCore(driver=json_driver, ledger=Ledger(str(tmp_path / "ledger")))
+        await bank.add_user(1)
+        # the account exists: opening it again records nothing
+        await bank._open(1)
+        await bank.add_user(2)
+        assert [entry.kind async for entry in bank.history(1)] == [Kind.OPEN]
+
+        # an account deleted after the scan is not closed twice
+        scan = Config.scan
+
+        async def deleted_meanwhile(self, *args, **kwargs):
+            user_ids = await scan(self, *args, **kwargs)
+            with suppress(KeyError):
+                await self.delete(("users", 2))
+            return user_ids
+
+        monkeypatch.setattr(Config, "scan", deleted_meanwhile)
+        assert await bank.cleanup(keep={1}) == 0
+        assert [entry.kind async for entry in bank.history(2)] == [Kind.OPEN]
+
+        await bank.close()
+        await Config.flush_all()
+
+    run(main())
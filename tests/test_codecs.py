@@ -0,0 +1,14 @@
+import pytest
+
+from useless_bot.core.drivers.codecs import get_codec
+
+
+@pytest.mark.parametrize("name, modules", [("pickle", []), ("orjson", ["orjson"]), ("msgpack", ["msgpack"]),
+                                           ("orjson+zstd", ["orjson", "zstandard"])])
+def test_keys_keep_their_type(name, modules):
+    for module in modules:
+        pytest.importorskip(module)
+    codec = get_codec(name)
+
+    value = {"users": {1: {"balance": 10}, "1": {"balance": 20}, "\x1f2": {}, "a": [1, "2"]}}
+    assert codec.decode(codec.encode(value)) == value
@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+
+from conftest import User, run
+from useless_bot.core.config import Config
+
+
+def test_guild_partitions(json_driver, monkeypatch):
+    async def main():
+        monkeypatch.setattr(Config, "guild_budget", 1)
+        schema = {"leave_msg": "bye", "warn": {"settings": {"count": 5}, "users": {}}}
+        config = Config("General", guild_schema=schema, driver=json_driver)
+        # values stored before the cog was partitioned
+        await config.set(("leave_msg",), "see you")
+        await config.set(("warn",), {"settings": {"count": 3}, "users": {9: 2}})
+        await config.set(("warn", "users", 9), 2, ttl=60)
+
+        # settings are copied, warn counts are not
+        first = await config.for_guild(User(5))
+        assert await first.get(("leave_msg",)) == "see you"
+        assert await first.get(("warn",)) == {"settings": {"count": 3}, "users": {}}
+
+        await first.update(("warn", "users", 1), lambda count: count + 1, default=0, ttl=60)
+        assert len(Config._sweeper) == 2
+
+        # the least recently used partition is unloaded with its locks and expirations
+        await config.for_guild(User(6))
+        assert "General.5" not in Config._locks
+        assert "General.5" not in Config._versions
+        assert "General.5" not in Config._expirations
+        assert len(Config._sweeper) == 1
+
+        # and its expirations are scheduled again when it is loaded
+        first = await config.for_guild(User(5))
+        assert 59 < await first.ttl(("warn", "users", 1)) <= 60
+        assert len(Config._sweeper) == 2
+
+        await Config.flush_all()
+
+    run(main())
+
+
+def test_set_many_clears_expiration(json_driver):
+    async def main():
+        config = Config("Bank", schema={"users": {}}, driver=json_driver)
+        await config.set(("users", 1), 10, ttl=0.05)
+        await config.set_many({("users", 1): 20, ("users", 2): 30})
+        assert await config.ttl(("users", 1)) is None
+
+        # the value set afterwards is not removed with the expiration of the previous one
+        await asyncio.sleep(0.1)
+        await Config._sweeper.sweep()
+        assert await config.get(("users",)) == {1: 20, 2: 30}
+
+        await Config.flush_all()
+
+    run(main())
+
+
+def test_subtree_reads_run_together(json_driver):
+    async def main():
+        config = Config("Bank", schema={"users": {1: 10}, "free_credits": 15}, driver=json_driver)
+        events = []
+
+        async def hold(paths, write: bool, name: str):
+            async with config._locked(paths, write=write):
+                events.append(f"{name} in")
+                await asyncio.sleep(0.01)
+                events.append(f"{name} out")
+
+        # reads of a whole subtree share the locks, writes of a key under it wait for them
+        await asyncio.gather(hold([("users",)], False, "a"), hold([("users",)], False, "b"),
+                             hold([("users", 1)], True, "c"))
+        assert events == ["a in", "b in", "a out", "b out", "c in", "c out"]
+
+    run(main())
+
+
+def test_subtree_reads_lock_their_stripes(json_driver):
+    async def main():
+        config = Config("Bank", schema={"users": {1: 10}, "free_credits": 15}, driver=json_driver)
+        await config.set(("users", 1), 20)
+        events = []
+
+        async def hold(paths, write: bool, name: str):
+            async with config._locked(paths, write=write):
+                events.append(f"{name} in")
+                await asyncio.sleep(0.01)
+                events.append(f"{name} out")
+
+        # no key under ("free_credits",) shares a stripe with ("users", 1)
+        await asyncio.gather(hold([("users", 1)], True, "a"), hold([("free_credits",)], False, "b"),
+                             hold([("users",)], False, "c"))
+        assert events == ["a in", "b in", "a out", "b out", "c in", "c out"]
+
+    run(main())
+
+
+def test_cache_hits_without_locks(json_driver, monkeypatch):
+    async def main():
+        config = Config("Bank", schema={"free_credits": 15}, driver=json_driver, cache_size=10)
+        assert await config.get(("free_credits",)) == 15
+
+        locked = Config._locked
+        monkeypatch.setattr(Config, "_locked", None)
+        assert await config.get(("free_credits",)) == 15
+        assert config.cache_info().hits == 1
+
+        # writes invalidate the cached values
+        monkeypatch.setattr(Config, "_locked", locked)
+        await config.set(("free_credits",), 20, ttl=0.05)
+        assert await config.get(("free_credits",)) == 20
+
+        # and expired values are not served
+        await asyncio.sleep(0.1)
+        with pytest.raises(KeyError):
+            await config.get(("free_credits",))
+
+        await Config.flush_all()
+
+    run(main())
+
+
+def test_unload_while_waiting(json_driver, monkeypatch):
+    async def main():
+        monkeypatch.setattr(Config, "guild_budget", 1)
+        config = Config("General", guild_schema={"count": 0}, driver=json_driver)
+        first = await config.for_guild(User(5))
+        events = []
+        tasks = []
+
+        async def hold(name: str):
+            async with first._locked([("count",)], write=True):
+                events.append(f"{name} in")
+                await asyncio.sleep(0.01)
+                events.append(f"{name} out")
+
+        async def unload():
+            await first._unload()
+            tasks.append(asyncio.create_task(hold("c")))
+
+        # b waits for the locks dropped by the unload, c takes the new ones: they still exclude each other
+        await asyncio.gather(hold("a"), unload(), hold("b"))
+        await asyncio.gather(*tasks)
+        assert events[:2] == ["a in", "a out"]
+        assert events[2:] in (["b in", "b out", "c in", "c out"], ["c in", "c out", "b in", "b out"])
+
+        await Config.flush_all()
+
+    run(main())
@@ -0,0 +1,242 @@
+import asyncio
+import os
+
+import pytest
+
+from conftest import open_driver, reset_drivers, run
+from useless_bot.core.drivers import Base, Json, Shelve
+from useless_bot.core.drivers.sharded import Sharded
+
+
+@pytest.fixture(params=["json", "shelve", "sqlite"])
+def name(request) -> str:
+    return request.param
+
+
+async def reopen(driver: Base, name: str, directory: str, monkeypatch) -> Base:
+    """Close a driver and open its files again, like a restart of the bot"""
+    await driver.commit()
+    if isinstance(driver, Sharded):
+        for cog in list(driver._shards):
+            await driver.unload(cog)
+    else:
+        driver._data.close()
+
+    reset_drivers(monkeypatch)
+    return open_driver(name, directory)
+
+
+def test_round_trip(name, tmp_path, monkeypatch):
+    async def main():
+        driver = open_driver(name, str(tmp_path))
+        driver.register("Bank", schema={"users": {}, "free_credits": 15}, override_schema=False)
+        driver.register("Other", schema={"name": "a"}, override_schema=False)
+
+        await driver.set("Bank", ("users", 1), {"balance": 10, "name": "a"})
+        assert not await driver.setdefault("Bank", ("users", 1), {"balance": 99})
+        assert await driver.setdefault("Bank", ("users", 2), {"balance": 20})
+        await driver.set_many("Bank", {("users", 3): {"balance": 30}, ("free_credits",): 20,
+                                       ("names",): {1: "a", "1": "b"}})
+        assert await driver.add("Bank", {("users", 1, "balance"): 5, ("users", 3, "balance"): -5}) == [15, 25]
+        with pytest.raises(ValueError):
+            await driver.add("Bank", {("users", 1, "balance"): 1, ("users", 2, "balance"): -100}, minimum=0)
+        await driver.delete("Bank", ("users", 2))
+        await driver.set("Other", ("name",), "b")
+
+        with pytest.raises(KeyError):
+            await driver.set("Bank", ("missing", 1), 1)
+        with pytest.raises(KeyError):
+            await driver.get("Bank", ("users", 2))
+
+        assert await driver.scan("Bank", ("users",)) == [1, 3]
+        expected = {"users": {1: {"balance": 15, "name": "a"}, 3: {"balance": 25}}, "free_credits": 20,
+                    "names": {1: "a", "1": "b"}}
+        assert await driver.get("Bank", ()) == expected
+
+        driver = await reopen(driver, name, str(tmp_path), monkeypatch)
+        driver.register("Bank", schema={"users": {}}, override_schema=False)
+        assert await driver.get("Bank", ()) == expected
+        assert await driver.get("Other", ("name",)) == "b"
+        assert await driver.cogs() == ["Bank", "Other"]
+
+        # unregistered cogs have no data
+        await driver.unregister("Other")
+        driver = await reopen(driver, name, str(tmp_path), monkeypatch)
+        assert [chunk async for chunk in driver.export("Other")] == []
+
+    run(main())
+
+
+def test_export(name, tmp_path):
+    async def main():
+        driver = open_driver(name, str(tmp_path))
+        driver.register("Bank", schema={"users": {1: {"balance": 10}}, "free_credits": 15}, override_schema=False)
+
+        entries = []
+        async for chunk in driver.export("Bank", chunk_size=2):
+            entries += chunk
+            # changes made during the export are not exported
+            await driver.set("Bank", ("users", 2), {"balance": 20})
+
+        expected = [(("free_credits",), 15), (("users",), {}), (("users", 1), {}), (("users", 1, "balance"), 10)]
+        assert sorted(entries, key=repr) == sorted(expected, key=repr)
+        # dictionaries come before their content
+        positions = {keys: position for position, (keys, _) in enumerate(entries)}
+        assert positions[("users",)] < positions[("users", 1)] < positions[("users", 1, "balance")]
+
+        await driver.commit()
+
+    run(main())
+
+
+def test_json_journal(tmp_path, monkeypatch):
+    async def main():
+        driver = open_driver("json", str(tmp_path))
+        driver.register("Bank", schema={"users": {}}, override_schema=False)
+        for user_id in range(3):
+            await driver.set("Bank", ("users", user_id), {"balance": user_id})
+        await driver.delete("Bank", ("users", 0))
+        await driver.commit()
+
+        # changes are only appended to the journal, and a crash can tear its last line
+        log_file = os.path.join(tmp_path, "json", "Bank.json.log")
+        assert not os.path.exists(os.path.join(tmp_path, "json", "Bank.json"))
+        with open(log_file, "ab") as fp:
+            fp.write(b'["s",["users",9],{"bal')
+
+        driver = await reopen(driver, "json", str(tmp_path), monkeypatch)
+        assert await driver.get("Bank", ("users",)) == {1: {"balance": 1}, 2: {"balance": 2}}
+
+    run(main())
+
+
+def test_json_compaction(tmp_path, monkeypatch):
+    async def main():
+        driver = Json(file=os.path.join(tmp_path, "config.json"), directory=os.path.join(tmp_path, "json"),
+                      compact_threshold=1, compress_snapshots=True)
+        driver.register("Bank", schema={"users": {}}, override_schema=False)
+        await driver.set("Bank", ("users",), {user_id: {"balance": user_id} for user_id in range(100)})
+        await driver.commit()
+
+        shard = driver._shards["Bank"]
+        await shard.compacting
+        assert os.path.getsize(shard.log_file) == 0
+
+        # changes made while the snapshot is written are kept in the journal
+        build = Json._build
+
+        async def change(snapshot):
+            await driver.set("Bank", ("users", 100), {"balance": 100})
+            await driver.delete("Bank", ("users", 0))
+            await driver.commit()
+            return await build(snapshot)
+
+        monkeypatch.setattr(Json, "_build", staticmethod(change))
+        await driver.set("Bank", ("users", 1), {"balance": 1})
+        await driver.commit()
+        await shard.compacting
+        assert 0 < os.path.getsize(shard.log_file) == shard.log_size < 100
+
+        driver = await reopen(driver, "json", str(tmp_path), monkeypatch)
+        users = await driver.get("Bank", ("users",))
+        assert sorted(users) == list(range(1, 101))
+        assert users[1] == {"balance": 1} and users[100] == {"balance": 100}
+
+    run(main())
+
+
+def test_shelve_recovery(tmp_path, monkeypatch):
+    async def main():
+        driver = open_driver("shelve", str(tmp_path))
+        driver.register("Bank", schema={"users": {}}, override_schema=False)
+        await driver.set("Bank", ("users", 1), {"balance": 10})
+        await driver.commit()
+
+        # a crash after the changes are logged, before they are written to the shelf
+        apply = Shelve._apply
+        monkeypatch.setattr(Shelve, "_apply", staticmethod(lambda *args: None))
+        await driver.set("Bank", ("users", 2), {"balance": 20})
+        await driver.commit()
+        monkeypatch.setattr(Shelve, "_apply", apply)
+
+        wal_file = os.path.join(tmp_path, "shelve", "Bank.wal")
+        with open(wal_file, "ab") as fp:
+            fp.write(b"\x00\x00\x00")
+
+        driver = await reopen(driver, "shelve", str(tmp_path), monkeypatch)
+        assert await driver.get("Bank", ("users",)) == {1: {"balance": 10}, 2: {"balance": 20}}
+        # the log is checkpointed once replayed
+        assert os.path.getsize(wal_file) == 0
+
+    run(main())
+
+
+@pytest.mark.parametrize("name", ["json", "shelve"])
+def test_unload_while_used(name, tmp_path):
+    async def main():
+        driver = open_driver(name, str(tmp_path))
+        driver.register("Bank", schema={"users": {}}, override_schema=False)
+        await driver.set("Bank", ("users", 1), {"balance": 10})
+
+        # the cog is loaded again only once the changes are written
+        await asyncio.gather(driver.unload("Bank"), driver.unload("Bank"), driver.get("Bank", ("users", 1)))
+        assert await driver.get("Bank", ("users", 1)) == {"balance": 10}
+        assert not driver._closing
+
+        await driver.commit()
+
+    run(main())
+
+
+def test_claims_in_memory(tmp_path):
+    async def main():
+        driver = open_driver("json", str(tmp_path))
+        assert await driver.claim("Bank", ("free_cooldown", 1), 1000, ttl=60) == 0
+        assert 59 < await driver.claim("Bank", ("free_cooldown", 1), 1000, ttl=60) <= 60
+        assert 59 < await driver.claimed("Bank", ("free_cooldown", 1)) <= 60
+
+        await driver.release("Bank", ("free_cooldown", 1))
+        assert await driver.claimed("Bank", ("free_cooldown", 1)) == 0
+        assert await driver.claim("Bank", ("free_cooldown", 1), 1000, ttl=0) == 0
+        assert await driver.claim("Bank", ("free_cooldown", 1), 1000, ttl=60) == 0
+
+    run(main())
+
+
+def test_shelve_syncs_on_checkpoint(tmp_path, monkeypatch):
+    async def main():
+        driver = Shelve(file=os.path.join(tmp_path, "config"), directory=os.path.join(tmp_path, "shelve"),
+                        checkpoint_size=4096)
+        driver.register("Bank", schema={"users": {}}, override_schema=False)
+        await driver.get("Bank", ())
+
+        # writes of the whole index of dbm.dumb
+        syncs = 0
+        database = type(driver._shards["Bank"].shelf.dict)
+        commit = database._commit
+
+        def counted(self):
+            nonlocal syncs
+            syncs += 1
+            commit(self)
+
+        # sync is an alias of _commit
+        monkeypatch.setattr(database, "_commit", counted)
+        monkeypatch.setattr(database, "sync", counted)
+
+        # the log makes every dump durable, the database is synced only when the log is checkpointed
+        await driver.set("Bank", ("users", 1), {"balance": 10})
+        await driver.set("Bank", ("users", 3), {"balance": 30})
+        await driver.commit()
+        await driver.delete("Bank", ("users", 3))
+        await driver.commit()
+        assert syncs == 0
+
+        await driver.set("Bank", ("users", 2), {"balance": "x" * 5000})
+        await driver.commit()
+        assert syncs == 1
+
+        driver = await reopen(driver, "shelve", str(tmp_path), monkeypatch)
+        assert await driver.get("Bank", ("users",)) == {1: {"balance": 10}, 2: {"balance": "x" * 5000}}
+
+    run(main())
@@ -0,0 +1,85 @@
+import pytest
+
+from useless_bot.core.drivers.flat import FlatStore, decode_path, encode_path
+
+
+def test_paths():
+    for keys in [(), ("users",), ("users", 1, "balance"), ("users", "1")]:
+        assert decode_path(encode_path(keys)) == keys
+
+    # the type of every key is kept
+    assert encode_path(("users", 1)) != encode_path(("users", "1"))
+    with pytest.raises(TypeError):
+        encode_path((1.5,))
+
+
+def test_set_get_delete():
+    store = FlatStore({"users": {1: {"balance": 10}}, "free_credits": 15})
+    assert store.changed == set()
+
+    store.set(("users", 2), {"balance": 20})
+    assert store.get(("users", 2, "balance")) == 20
+    assert store.get(("users",)) == {1: {"balance": 10}, 2: {"balance": 20}}
+    assert store.changed == {("users", 2), ("users", 2, "balance")}
+
+    # a value replaced by a dictionary and back
+    store.set(("free_credits",), {"amount": 15})
+    assert store.is_dict(("free_credits",))
+    store.set(("free_credits",), 30)
+    assert store.get(("free_credits",)) == 30
+    assert ("free_credits", "amount") not in store
+
+    assert not store.setdefault(("users", 1), {"balance": 0})
+    assert store.setdefault(("users", 3), {"balance": 0})
+
+    store.delete(("users", 1))
+    assert list(store.children(("users",))) == [2, 3]
+    with pytest.raises(KeyError):
+        store.get(("users", 1, "balance"))
+    with pytest.raises(KeyError):
+        store.delete(("users", 1))
+    with pytest.raises(KeyError):
+        store.set(("missing", 1), 1)
+
+    assert store.to_dict() == {"users": {2: {"balance": 20}, 3: {"balance": 0}}, "free_credits": 30}
+
+
+def test_scan():
+    store = FlatStore({"users": {key: {} for key in [5, "b", 1, "a", 3]}})
+
+    keys = []
+    after = None
+    while page := store.scan(("users",), after=after, count=2):
+        keys += page
+        after = page[-1]
+    assert keys == [1, 3, 5, "a", "b"]
+
+    # the sorted keys follow the changes
+    store.set(("users", 2), {})
+    store.delete(("users", "a"))
+    assert store.scan(("users",), after=1, count=10) == [2, 3, 5, "b"]
+
+    with pytest.raises(KeyError):
+        store.scan(("missing",))
+
+
+def test_from_entries():
+    store = FlatStore.from_entries([("users", 1), ("users",)], [(("users", 1, "balance"), 10), (("name",), "a")])
+    assert store.to_dict() == {"users": {1: {"balance": 10}}, "name": "a"}
+
+
+def test_snapshot():
+    store = FlatStore({"users": {1: {"balance": 10}}})
+    snapshot = store.snapshot()
+
+    store.set(("users", 1, "balance"), 20)
+    store.set(("users", 2), {"balance": 30})
+    store.delete(("users", 1))
+
+    # the snapshot sees the data at the time it was taken
+    assert snapshot.dictionaries == [("users",), ("users", 1)]
+    assert snapshot.values == [("users", 1, "balance")]
+    assert snapshot.get(("users", 1, "balance")) == 10
+
+    snapshot.close()
+    assert store.to_dict() == {"users": {2: {"balance": 30}}}
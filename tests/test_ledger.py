@@ -0,0 +1,66 @@
+import os
+
+from conftest import run
+from useless_bot.core.ledger import RECORD, Kind, Ledger
+
+
+def test_history_and_balances(tmp_path):
+    async def main():
+        ledger = Ledger(str(tmp_path), chunk_size=2)
+        ledger.append(Kind.OPEN, 1, 100, 100)
+        ledger.append(Kind.OPEN, 2, 100, 100)
+        ledger.append(Kind.MOVE, 1, -10, 90, other_id=2)
+        ledger.append(Kind.MOVE, 2, 10, 110, other_id=1)
+        ledger.append(Kind.DEPOSIT, 1, 5, 95)
+
+        history = [(entry.kind, entry.delta, entry.balance) async for entry in ledger.history(1)]
+        assert history == [(Kind.DEPOSIT, 5, 95), (Kind.MOVE, -10, 90), (Kind.OPEN, 100, 100)]
+        assert await ledger.balances() == {1: 95, 2: 110}
+
+        ledger.append(Kind.CLOSE, 2, -110, 0)
+        assert await ledger.balances() == {1: 95}
+        ledger.append(Kind.RESET, 0, 0, 0)
+        assert await ledger.balances() == {}
+
+        await ledger.close()
+
+    run(main())
+
+
+def test_checkpoint(tmp_path):
+    async def main():
+        ledger = Ledger(str(tmp_path))
+        for user_id in range(10):
+            ledger.append(Kind.OPEN, user_id, user_id, user_id)
+        await ledger.checkpoint()
+        assert os.path.exists(os.path.join(tmp_path, "checkpoint.bin"))
+
+        # the records after the checkpoint are replayed over it
+        ledger.append(Kind.DEPOSIT, 1, 10, 11)
+        ledger.append(Kind.CLOSE, 2, -2, 0)
+        await ledger.close()
+
+        ledger = Ledger(str(tmp_path))
+        balances = await ledger.balances()
+        assert balances[1] == 11 and 2 not in balances and len(balances) == 9
+        await ledger.close()
+
+    run(main())
+
+
+def test_torn_record(tmp_path):
+    async def main():
+        ledger = Ledger(str(tmp_path))
+        ledger.append(Kind.OPEN, 1, 100, 100)
+        await ledger.close()
+
+        # a crash in the middle of a record
+        with open(os.path.join(tmp_path, "ledger.bin"), "ab") as fp:
+            fp.write(RECORD.pack(0, Kind.DEPOSIT, 1, 0, 5, 105)[:10])
+
+        ledger = Ledger(str(tmp_path))
+        ledger.append(Kind.DEPOSIT, 1, 5, 105)
+        assert [entry.balance async for entry in ledger.history(1)] == [105, 100]
+        await ledger.close()
+
+    run(main())
@@ -0,0 +1,14 @@
+from useless_bot.core.metrics import metrics
+
+
+def test_guild_partitions_share_labels():
+    for guild_id in range(100):
+        metrics.observe("config", f"General.{guild_id}", "get", 0.001)
+        metrics.count("Json", f"General.{guild_id}", "bytes_written", 10)
+        metrics.maximum("Json", f"General.{guild_id}", "blocking", guild_id)
+    metrics.observe("config", "Bank", "get", 0.001)
+
+    snapshot = metrics.snapshot()
+    assert [(entry["cog"], entry["count"]) for entry in snapshot["latencies"]] == [("General", 100), ("Bank", 1)]
+    assert [(entry["cog"], entry["value"]) for entry in snapshot["counters"]] == [("General", 1000)]
+    assert [(entry["cog"], entry["value"]) for entry in snapshot["maxima"]] == [("General", 99)]
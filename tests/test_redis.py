@@ -0,0 +1,195 @@
+import pytest
+
+from conftest import User, run
+from useless_bot.core.bank_core import BankCore
+from useless_bot.core.config import Config
+from useless_bot.core.drivers import Redis
+from useless_bot.core.errors import FreeCreditsCooldownError
+
+fakeredis = pytest.importorskip("fakeredis")
+# the driver runs Lua scripts
+pytest.importorskip("lupa")
+
+
+@pytest.fixture()
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture()
+def driver(server):
+    return Redis(client=fakeredis.FakeAsyncRedis(server=server))
+
+
+def test_set_get(driver):
+    async def main():
+        driver.register("Bank", schema={"users": {}, "free_credits": 15}, override_schema=False)
+        assert await driver.get("Bank", ()) == {"users": {}, "free_credits": 15}
+
+        await driver.set("Bank", ("users", 1), {"balance": 10, "name": "a"})
+        assert not await driver.setdefault("Bank", ("users", 1), {"balance": 99})
+        assert await driver.setdefault("Bank", ("users", 2), {"balance": 20})
+        assert await driver.get("Bank", ("users", 1)) == {"balance": 10, "name": "a"}
+        assert await driver.get("Bank", ("users", 1, "balance")) == 10
+
+        with pytest.raises(KeyError):
+            await driver.set("Bank", ("missing", 1), 1)
+
+        await driver.delete("Bank", ("users", 1))
+        with pytest.raises(KeyError):
+            await driver.get("Bank", ("users", 1))
+
+    run(main())
+
+
+def test_scan(driver):
+    async def main():
+        driver.register("Bank", schema={"users": {}}, override_schema=False)
+        for user_id in range(10):
+            await driver.set("Bank", ("users", user_id), {"balance": user_id, "history": {"a": 1}})
+
+        user_ids = []
+        after = None
+        while page := await driver.scan("Bank", ("users",), after=after, count=3):
+            user_ids += page
+            after = page[-1]
+
+        assert sorted(user_ids) == list(range(10))
+        with pytest.raises(KeyError):
+            await driver.scan("Bank", ("users", 1, "balance"))
+
+    run(main())
+
+
+def test_add(driver):
+    async def main():
+        driver.register("Bank", schema={"users": {1: {"balance": 10}, 2: {"balance": 5}}}, override_schema=False)
+        deltas = {("users", 1, "balance"): -3, ("users", 2, "balance"): 3}
+        assert await driver.add("Bank", deltas, minimum=0) == [7, 8]
+
+        with pytest.raises(ValueError):
+            await driver.add("Bank", {("users", 2, "balance"): 1, ("users", 1, "balance"): -100}, minimum=0)
+        with pytest.raises(OverflowError):
+            await driver.add("Bank", {("users", 1, "balance"): 100}, maximum=100)
+        with pytest.raises(KeyError):
+            await driver.add("Bank", {("users", 3, "balance"): 1})
+
+        # nothing is changed when a delta fails
+        assert await driver.get("Bank", ("users",)) == {1: {"balance": 7}, 2: {"balance": 8}}
+
+    run(main())
+
+
+def test_export(driver):
+    async def main():
+        driver.register("Bank", schema={"users": {1: {"balance": 10}}, "free_credits": 15}, override_schema=False)
+        entries = []
+        async for chunk in driver.export("Bank", chunk_size=2):
+            entries += chunk
+
+        assert entries == [(("free_credits",), 15), (("users",), {}), (("users", 1), {}),
+                           (("users", 1, "balance"), 10)]
+        assert await driver.cogs() == ["Bank"]
+
+    run(main())
+
+
+def test_claim(driver):
+    async def main():
+        assert await driver.claim("Bank", ("free_cooldown", 1), 1000, ttl=60) == 0
+        assert 59 < await driver.claim("Bank", ("free_cooldown", 1), 2000, ttl=60) <= 60
+        assert 59 < await driver.claimed("Bank", ("free_cooldown", 1)) <= 60
+
+        await driver.release("Bank", ("free_cooldown", 1))
+        assert await driver.claimed("Bank", ("free_cooldown", 1)) == 0
+
+        await driver.claim("Bank", ("free_cooldown", 2), 1000, ttl=60)
+        await driver.unregister("Bank")
+        assert await driver.claimed("Bank", ("free_cooldown", 2)) == 0
+
+    run(main())
+
+
+def test_claim_without_expiration(driver, server):
+    async def main():
+        # a claim key left without expiration is claimed again, instead of reporting a negative cooldown
+        other = fakeredis.FakeAsyncRedis(server=server)
+        await other.set(driver._claim_key("Bank", ("free_cooldown", 1)), 1000)
+        assert await driver.claim("Bank", ("free_cooldown", 1), 2000, ttl=60) == 0
+        assert 59 < await driver.claimed("Bank", ("free_cooldown", 1)) <= 60
+
+    run(main())
+
+
+def test_open_account_between_processes(driver, monkeypatch):
+    async def main():
+        bank = BankCore(driver=driver)
+        get = Config.get
+
+        async def created_meanwhile(config, keys):
+            # another process creates and credits the account after it was found missing
+            try:
+                return await get(config, keys)
+            except KeyError:
+                await driver.set("BankCore", ("users", 1), {"user_id": 1, "balance": 500})
+                raise
+
+        monkeypatch.setattr(Config, "get", created_meanwhile)
+        assert (await bank.get_user(1)).balance == 500
+        monkeypatch.setattr(Config, "get", get)
+
+        await bank.add_user(1)
+        assert (await bank.get_user(1)).balance == 500
+
+        await Config.flush_all()
+
+    run(main())
+
+
+def test_claim_free_credits_between_processes(driver, server):
+    async def main():
+        bank = BankCore(driver=driver)
+        await bank.add_user(1)
+
+        await bank.claim_free_credits(User(1), 10, cooldown=60)
+        with pytest.raises(FreeCreditsCooldownError):
+            await bank.claim_free_credits(User(1), 10, cooldown=60)
+        assert (await bank.get_user(1)).balance == 60
+
+        # a claim made by another process is seen at once
+        other = fakeredis.FakeAsyncRedis(server=server)
+        await other.set(driver._claim_key("BankCore", ("free_cooldown", 2)), 1000, px=30_000)
+        assert await bank.free_credits_cooldown(2) == 30
+        with pytest.raises(FreeCreditsCooldownError):
+            await bank.claim_free_credits(User(2), 10, cooldown=60)
+
+        await Config.flush_all()
+
+    run(main())
+
+
+def test_set_many(driver):
+    async def main():
+        driver.register("Bank", schema={"users": {1: {"balance": 10}}, "free_credits": 15}, override_schema=False)
+
+        # parents can be set by the values before them
+        await driver.set_many("Bank", {("users", 2): {"history": {}}, ("users", 2, "history", "a"): 1,
+                                       ("guilds",): {}, ("guilds", 5): "x"})
+        assert await driver.get("Bank", ("users", 2)) == {"history": {"a": 1}}
+        assert await driver.get("Bank", ("guilds",)) == {5: "x"}
+
+        # nothing is written when a parent is missing, even one removed by a value before
+        for values in ({("free_credits",): 20, ("missing", 1): 1},
+                       {("users", 1): 5, ("users", 1, "balance"): 20},
+                       {("users", 2): {}, ("users", 2, "history", "b"): 2}):
+            with pytest.raises(KeyError):
+                await driver.set_many("Bank", values)
+
+        assert await driver.get("Bank", ()) == {"users": {1: {"balance": 10}, 2: {"history": {"a": 1}}},
+                                                "free_credits": 15, "guilds": {5: "x"}}
+
+        # the root replaces everything
+        await driver.set_many("Bank", {(): {"users": {}}, ("users", 3): 1})
+        assert await driver.get("Bank", ()) == {"users": {3: 1}}
+
+    run(main())
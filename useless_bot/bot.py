@@ -3,6 +3,7 @@ import logging
 import aiohttp
 
 from os import getenv
+from time import perf_counter
 from typing import Any
 
 from lavalink import lavalink
@@ -12,7 +13,9 @@ from nextcord.ext.commands import check, errors, Context
 
 from . import __version__, __author__, __title__
 from .cogs import system, settings, roles, reddit, doujin, bank, general, arcade, music, activity
-from .core import bank_core, reddit_api
+from .core import bank_core, config, reddit_api
+from .core.drivers import Redis
+from .core.ledger import Ledger
 
 logger = logging.getLogger("useless_bot.bot")
 useragent = f"python:{__title__}:{__version__} (by {__author__})"
@@ -20,6 +23,8 @@ useragent = f"python:{__title__}:{__version__} (by {__author__})"
 
 class UselessBot(commands.Bot):
     def __init__(self, debug: bool = False):
+        self._started = perf_counter()
+
         # init aiohttp
         headers = {
             "User-Agent": useragent
@@ -42,8 +47,11 @@ class UselessBot(commands.Bot):
         # set class variables
         self.debug = debug
 
-        # init bank
-        self.bank = bank_core.BankCore()
+        # init bank, shared with other bot processes through Redis if configured
+        redis_url = getenv("REDIS_URL")
+        # the ledger is synced as often as the write-behind of the bank
+        ledger = Ledger(sync_interval=config.Config.flush_interval)
+        self.bank = bank_core.BankCore(driver=Redis(url=redis_url) if redis_url else None, ledger=ledger)
 
         # init reddit api
         client_id = getenv("REDDIT_ID")
@@ -70,7 +78,11 @@ class UselessBot(commands.Bot):
 
     async def on_ready(self):
         """Log the start of bot"""
-        logger.info(f"Logged in as {self.user} ({self.user.id})")
+        logger.info(f"Logged in as {self.user} ({self.user.id}) {perf_counter() - self._started:.2f}s after start")
+
+        # in background, so startup does not grow with the bank. on_ready is dispatched again on every reconnect,
+        # the bank is loaded only once
+        self.bank.load()
 
         await lavalink.initialize(self)
         await lavalink.add_node(
@@ -117,6 +129,10 @@ class UselessBot(commands.Bot):
         if self.ws is not None and self.ws.open:
             await self.ws.close(code=1000)
 
+        # write changes still pending in write-behind and in the ledger
+        await self.bank.close()
+        await config.Config.flush_all()
+
         await self._session.close()
         await self.http.close()
         self._ready.clear()
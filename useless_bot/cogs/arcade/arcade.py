@@ -23,7 +23,7 @@ class Arcade(commands.Cog, name="Games"):
         self.bot = bot
         self.bank = bank
 
-        self.config = Config(cog="Arcade", schema=schema)
+        self.config = Config(cog="Arcade", schema=schema, cache_size=16)
 
     # noinspection PyUnusedLocal
     async def cog_command_error(self, ctx: Context, error: CommandError):
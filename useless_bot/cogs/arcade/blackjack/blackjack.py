@@ -8,6 +8,7 @@ from nextcord.ui import Button, View
 
 from useless_bot.core.bank_core import BankCore
 from useless_bot.core.errors import BalanceOverLimitError, BalanceUnderLimitError
+from useless_bot.core.ledger import Kind
 from .objects import Dealer
 from .objects import Status, Player
 
@@ -239,7 +240,7 @@ class Blackjack(View):
             self._check_final_player_status(player=player)
 
         # elaborate bets
-        self.bets()
+        await self.bets()
 
         # refresh game page
         await self.game_page(interaction)
@@ -247,15 +248,17 @@ class Blackjack(View):
         # stop game
         self.stop()
 
-    def bets(self):
+    async def bets(self):
         for user_id, player in self.players.items():
             player_status = player.status
+            # players may have never opened a bank
+            await self.bank.get_user(user_id)
 
             try:
                 if player_status == Status.Win:
-                    self.bank.deposit(user=user_id, value=self.bet * 2)
+                    await self.bank.deposit(user=user_id, value=self.bet * 2, kind=Kind.BLACKJACK)
                 elif player_status in (Status.Lost, Status.Bust):
-                    self.bank.withdraw(user=user_id, value=self.bet)
+                    await self.bank.withdraw(user=user_id, value=self.bet, kind=Kind.BLACKJACK)
             except (BalanceUnderLimitError, BalanceOverLimitError):
                 continue
 
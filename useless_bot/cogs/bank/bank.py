@@ -1,12 +1,12 @@
+import asyncio
 import logging
-from time import time
+from time import monotonic
 from typing import Union, Optional
 
 import nextcord
 from nextcord import Embed
 from nextcord.ext import commands
 from nextcord.ext.commands import Bot, group, Context, CommandError
-from nextcord.utils import get
 
 from useless_bot.core.bank_core import BankCore
 from useless_bot.core.config import Config
@@ -25,7 +25,7 @@ class Bank(commands.Cog, name="Bank"):
     def __init__(self, bot: Bot, bank: BankCore):
         self.bot = bot
 
-        self.config = Config(cog="Bank", schema=schema)
+        self.config = Config(cog="Bank", schema=schema, cache_size=16)
 
         # bank init
         self._bank = bank
@@ -43,7 +43,6 @@ class Bank(commands.Cog, name="Bank"):
 
     @staticmethod
     def gen_wait_str(seconds: int):
-        seconds = 86400 - seconds
         minutes, seconds = divmod(seconds, 60)
         hours, minutes = divmod(minutes, 60)
 
@@ -62,10 +61,11 @@ class Bank(commands.Cog, name="Bank"):
         else:
             user = ctx.author
 
-        author_account = await self._bank.get_user(user)
-        seconds = int(time()) - author_account.last_free_credits
+        # read before awaiting again, the account can change meanwhile
+        balance = (await self._bank.get_user(user)).balance
+        seconds = await self._bank.free_credits_cooldown(user)
 
-        if seconds > 86400:
+        if seconds <= 0:
             free_cr_text = f"Use `{ctx.prefix}bank free` to reclaim your free daily credits"
         else:
             free_cr_text = self.gen_wait_str(seconds)
@@ -74,7 +74,7 @@ class Bank(commands.Cog, name="Bank"):
         embed.title = "Bank Status"
         embed.description = f"Bank status of {user.mention}"
         embed.add_field(
-            name="Credits", value=f"`{author_account.balance}`", inline=False
+            name="Credits", value=f"`{balance}`", inline=False
         )
         embed.add_field(name="Free credits", value=free_cr_text, inline=False)
 
@@ -83,19 +83,16 @@ class Bank(commands.Cog, name="Bank"):
     @bank.command()
     async def free(self, ctx: Context):
         """Get your daily free credits"""
-        user = ctx.author
-        seconds = int(time()) - await self._bank.last_free_credits(user)
-
         free_credits = await self.config.get(["free_credits"])
 
-        if seconds > 86400:
-            await self._bank.deposit(user=user, value=free_credits)
-            await self._bank.update_last_free_credits(user=user, new_time=int(time()))
+        try:
+            await self._bank.claim_free_credits(user=ctx.author, value=free_credits, cooldown=86400)
+        except FreeCreditsCooldownError as error:
+            await ctx.send(self.gen_wait_str(error.seconds))
+        else:
             await ctx.send(
                 f"Added {free_credits} credits to your account"
             )
-        else:
-            await ctx.send(self.gen_wait_str(seconds))
 
     @commands.is_owner()
     @bank.command()
@@ -111,17 +108,55 @@ class Bank(commands.Cog, name="Bank"):
         await self._bank.withdraw(user=user, value=value)
         await ctx.send(f"Removed {value} credits from {user.mention}")
 
+    @commands.is_owner()
+    @bank.command()
+    async def airdrop(self, ctx: Context, role: nextcord.Role, value: int):
+        """Add some bank to every member of a role. WARNING: this will cause inflation"""
+        members = [member for member in role.members if not member.bot]
+        failed = await self._bank.airdrop(members, value)
+
+        text = f"Added {value} credits to {len(members) - len(failed)} members of {role.mention}"
+        if failed:
+            reasons = {BalanceUnderLimitError: "not enough credits", BalanceOverLimitError: "too much credits"}
+            lines = [f"<@{user_id}>: {reasons.get(type(error), 'no bank')}" for user_id, error in failed.items()]
+            text += f"\nFailed for {len(failed)} members:\n" + "\n".join(lines[:20])
+            if len(lines) > 20:
+                text += f"\nand {len(lines) - 20} more"
+
+        await ctx.send(text)
+
     @commands.is_owner()
     @bank.command(hidden=True)
     async def cleanup(self, ctx: Context):
-        members = list(self.bot.get_all_members())
-        i = 0
-        async for user_id in self._bank.users:
-            if get(members, id=user_id) is None:
-                await self._bank.del_user(user_id)
-                i += 1
-
-        await ctx.send(f"Bank database cleaned from {i} users")
+        """Delete the accounts of the users not in any guild of the bot"""
+        members = {member.id for member in self.bot.get_all_members()}
+        message = await ctx.send("Cleaning bank database...")
+
+        last_edit = monotonic()
+        edit: Optional[asyncio.Task] = None
+
+        def edited(task: asyncio.Task):
+            if not task.cancelled() and task.exception() is not None:
+                logger.warning("Cannot show the cleanup progress", exc_info=task.exception())
+
+        def progress(scanned: int, stale: int):
+            nonlocal last_edit, edit
+            # message edits are rate limited: one at a time, at most every 5 seconds
+            if monotonic() - last_edit > 5 and (edit is None or edit.done()):
+                last_edit = monotonic()
+                edit = asyncio.create_task(message.edit(content=f"Cleaning bank database: {scanned} accounts "
+                                                                f"checked, {stale} to delete"))
+                edit.add_done_callback(edited)
+
+        try:
+            removed = await self._bank.cleanup(members, progress=progress)
+        finally:
+            # a progress edit still running would overwrite the result
+            if edit is not None and not edit.done():
+                edit.cancel()
+                await asyncio.wait([edit])
+
+        await message.edit(content=f"Bank database cleaned from {removed} users")
 
     @commands.is_owner()
     @bank.command()
@@ -129,6 +164,47 @@ class Bank(commands.Cog, name="Bank"):
         await self._bank.clear()
         await ctx.send("Cleared database")
 
+    @bank.command()
+    async def top(self, ctx: Context, n: int = 10):
+        """Get the richest users"""
+        n = min(max(n, 1), 25)
+
+        embed = Embed()
+        embed.title = "Leaderboard"
+        embed.description = "\n".join(f"{position}. <@{user_id}> `{balance}`"
+                                       for position, (user_id, balance) in enumerate(await self._bank.top(n), 1))
+        await ctx.send(embed=embed)
+
+    @bank.command()
+    async def rank(self, ctx: Context, user: Optional[Union[nextcord.User, nextcord.Member]] = None):
+        """Get your position in the leaderboard"""
+        if user is None:
+            user = ctx.author
+
+        position, users = await self._bank.rank(user)
+        await ctx.send(f"{user.mention} is #{position} of {users}")
+
+    @bank.command()
+    async def history(self, ctx: Context, user: Optional[Union[nextcord.User, nextcord.Member]] = None, n: int = 10):
+        """Get the last changes of your credits"""
+        if user is None or not ctx.author.guild_permissions.administrator:
+            user = ctx.author
+        n = min(max(n, 1), 25)
+
+        lines = []
+        async for entry in self._bank.history(user):
+            line = f"<t:{int(entry.time)}:R> {entry.kind.name.lower()} `{entry.delta:+}` → `{entry.balance}`"
+            if entry.other_id:
+                line += f" ({'to' if entry.delta < 0 else 'from'} <@{entry.other_id}>)"
+            lines.append(line)
+            if len(lines) >= n:
+                break
+
+        embed = Embed()
+        embed.title = "History"
+        embed.description = f"Last changes of the credits of {user.mention}\n" + ("\n".join(lines) or "No changes")
+        await ctx.send(embed=embed)
+
     @bank.command()
     async def move(self, ctx: Context, user: Union[nextcord.User, nextcord.Member], value: int):
         value = abs(value)  # prevent bank stealing
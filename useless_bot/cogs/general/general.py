@@ -12,7 +12,10 @@ from .views import WarnLimit
 __all__ = ["General"]
 
 logger = logging.getLogger("useless_bot.cog.general")
-schema = {
+# warns are forgotten after 30 days without new warns
+WARN_TTL = 30 * 24 * 60 * 60
+# settings of every guild
+guild_schema = {
     "leave_msg": "{mention} has left the server",
     "warn": {
         "settings": {
@@ -29,7 +32,7 @@ class General(commands.Cog):
     def __init__(self, bot: Bot):
         self.bot = bot
 
-        self.config = Config(cog="General", schema=schema)
+        self.config = Config(cog="General", guild_schema=guild_schema, write_behind=True, cache_size=16)
 
         self.meme = self.bot.get_cog("Meme")
         self.sauce = self.bot.get_cog("Sauce")
@@ -41,7 +44,7 @@ class General(commands.Cog):
     @commands.Cog.listener()
     async def on_member_remove(self, member: Member):
         channel: TextChannel = member.guild.system_channel
-        leave_msg = await self.config.get(["leave_msg"])
+        leave_msg = await self.config.get_from_guild(member.guild, ["leave_msg"])
         await channel.send(leave_msg.format(mention=member.mention))
 
     @commands.command()
@@ -68,20 +71,17 @@ class General(commands.Cog):
     @has_permissions(administrator=True)
     async def warn(self, ctx: Context, user: Member):
         """Warn a user and, ban or kick him if he reached"""
-        try:
-            warns_count = await self.config.get(["warn", "users", user.id])
-        except KeyError:
-            warns_count = 0
-        warns_count += 1
-        await self.config.set(["warn", "users", user.id], warns_count)
-
-        if warns_count >= await self.config.get(["warn", "settings", "count"]):
+        guild_config = await self.config.for_guild(ctx.guild)
+        warns_count = await guild_config.update(["warn", "users", user.id], lambda count: count + 1, default=0,
+                                                ttl=WARN_TTL)
+
+        if warns_count >= await guild_config.get(["warn", "settings", "count"]):
             view = WarnLimit(user)
             await ctx.send(f"Warn limit reached for {user.mention}.\nDo you want to ban or kick the user?\n"
                            "Do nothing to reset the user's warn count", view=view)
             await view.wait()
             if not view:
-                await self.config.set(["warn", "users", user.id], 0)
+                await self.config.delete_from_guild(ctx.guild, ["warn", "users", user.id])
         else:
             await ctx.send(f"{user.mention} has now {warns_count} warn(s)")
 
@@ -23,7 +23,7 @@ class Roles(commands.Cog):
         self.bot = bot
         self.bank = bank
 
-        self.config = Config(cog="Roles", schema=schema)
+        self.config = Config(cog="Roles", schema=schema, cache_size=16)
 
     async def cog_command_error(self, ctx: Context, error: CommandError):
         # Handle the errors from the cog here
@@ -58,7 +58,7 @@ class Settings(commands.Cog):
     @settings.command(invoke_without_command=True)
     async def leave(self, ctx: Context, *, message: str):
         """Change leave message"""
-        await self.general_cog.config.set(["leave_msg"], message)
+        await self.general_cog.config.set_for_guild(ctx.guild, ["leave_msg"], message)
         await ctx.send(f"New leave message set\nExample: " + message.format(ctx.author.mention))
 
     @arcade.command()
@@ -1,10 +1,17 @@
 import logging
+import os
+from datetime import datetime
+from io import BytesIO
+from typing import Optional
 from platform import uname, python_compiler, python_implementation, python_version
 
 from nextcord import Embed, File
 from nextcord.ext import commands
 from nextcord.ext.commands import Bot, Context, is_owner, CommandError, check
 
+from useless_bot.core import backup
+from useless_bot.core.config import Config
+from useless_bot.core.metrics import metrics
 from useless_bot.utils import is_admin, on_global_command_error
 
 __all__ = ["System"]
@@ -37,6 +44,50 @@ class System(commands.Cog):
         except ValueError:
             await ctx.send("Logs not enabled")
 
+    @is_owner()
+    @commands.command(hidden=True)
+    async def backup(self, ctx: Context):
+        """Export a snapshot of the bot data, while the bot keeps running"""
+        os.makedirs("data/backups", exist_ok=True)
+        timestamp = f"{datetime.now():%Y%m%d-%H%M%S}"
+
+        message = await ctx.send("Exporting data...")
+        # a backup for every driver in use, since every backup is restored into a single driver
+        lines = []
+        for driver in Config.drivers():
+            file = f"data/backups/{timestamp}.{type(driver).__name__.lower()}.backup.gz"
+            count = await backup.export(driver, file)
+            lines.append(f"Exported {count} entries to `{file}`")
+
+        await message.edit(content="\n".join(lines))
+
+    @is_owner()
+    @commands.command(name="metrics", hidden=True)
+    async def storage_metrics(self, ctx: Context, cog: Optional[str] = None):
+        """Print the latencies and the counters of the storage, of every cog or of cog"""
+        snapshot = metrics.snapshot()
+        lines = [f"{'source':<8} {'cog':<20} {'operation':<11} {'count':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}"]
+        for latency in sorted(snapshot["latencies"], key=lambda item: item["total"], reverse=True):
+            if cog is None or latency["cog"] == cog:
+                lines.append(f"{latency['source']:<8} {latency['cog'][:20]:<20} {latency['operation']:<11} "
+                             f"{latency['count']:>8} {latency['p50'] * 1000:>8.3f} {latency['p99'] * 1000:>8.3f} "
+                             f"{latency['max'] * 1000:>8.3f}")
+
+        lines.append("")
+        for counter in snapshot["counters"]:
+            if cog is None or counter["cog"] == cog:
+                lines.append(f"{counter['source']:<8} {counter['cog'][:20]:<20} {counter['name']}: {counter['value']}")
+        for maximum in snapshot["maxima"]:
+            if cog is None or maximum["cog"] in (cog, "*"):
+                lines.append(f"{maximum['source']:<8} {maximum['cog'][:20]:<20} {maximum['name']}: "
+                             f"{maximum['value'] * 1000:.3f} ms")
+
+        text = "\n".join(lines)
+        if len(text) > 1900:
+            await ctx.send(file=File(BytesIO(text.encode()), filename="metrics.txt"))
+        else:
+            await ctx.send(f"```\n{text}\n```")
+
     @check(is_admin)
     @commands.command()
     async def print(self, ctx: Context):
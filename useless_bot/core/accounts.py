@@ -0,0 +1,14 @@
+class BankUser:
+    """Account of a user, as read from the bank"""
+    __slots__ = ("user_id", "balance")
+
+    def __init__(self, user_id: int, balance: int):
+        self.user_id = user_id
+        self.balance = balance
+
+    def to_dict(self) -> dict:
+        """Account as stored by BankCore"""
+        return {"user_id": self.user_id, "balance": self.balance}
+
+    def __repr__(self) -> str:
+        return f"BankUser(user_id={self.user_id}, balance={self.balance})"
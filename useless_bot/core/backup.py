@@ -0,0 +1,119 @@
+import asyncio
+import gzip
+import logging
+import os
+import pickle
+from typing import Any, BinaryIO, Callable, Iterable, Optional
+
+from .drivers import Base
+
+logger = logging.getLogger("useless_bot.core.backup")
+
+# a backup is a gzip stream of pickled records: the header, then for every cog
+# a ("cog", name) record followed by its ("entries", chunk) records, and an ("end", count) record
+FORMAT = "useless_bot-backup"
+VERSION = 1
+
+# called with the cog and the number of entries copied so far
+Progress = Callable[[str, int], Any]
+
+
+def _write(fp: BinaryIO, record: tuple):
+    pickle.dump(record, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _read(fp: BinaryIO) -> tuple:
+    try:
+        return pickle.load(fp)
+    except EOFError:
+        raise ValueError("Incomplete backup") from None
+
+
+async def export(driver: Base, file: str, *, cogs: Optional[Iterable[str]] = None, chunk_size: int = 1000,
+                 progress: Optional[Progress] = None) -> int:
+    """
+    Stream a consistent snapshot of every cog (or of cogs) to a compressed file, return the number of entries.
+    Chunks are compressed and written on a thread while the bot goes on, no lock is held during the export
+    """
+    cogs = list(await driver.cogs() if cogs is None else cogs)
+    logger.info(f"Exporting {len(cogs)} cogs to {file}")
+
+    # the backup appears only once complete
+    tmp_file = f"{file}.tmp"
+    fp = await asyncio.to_thread(gzip.open, tmp_file, "wb")
+    count = 0
+    try:
+        await asyncio.to_thread(_write, fp, (FORMAT, VERSION, cogs))
+        for cog in cogs:
+            await asyncio.to_thread(_write, fp, ("cog", cog))
+
+            async for chunk in driver.export(cog, chunk_size):
+                await asyncio.to_thread(_write, fp, ("entries", chunk))
+                count += len(chunk)
+                if progress is not None:
+                    progress(cog, count)
+
+        await asyncio.to_thread(_write, fp, ("end", count))
+        await asyncio.to_thread(fp.close)
+    except BaseException:
+        await asyncio.to_thread(fp.close)
+        os.remove(tmp_file)
+        raise
+
+    os.replace(tmp_file, file)
+    logger.info(f"Exported {count} entries to {file}")
+    return count
+
+
+async def restore(driver: Base, file: str, *, progress: Optional[Progress] = None) -> int:
+    """
+    Replace the data of the cogs in a backup with their data in the backup, return the number of entries.
+    The Config of the cogs restored must not be in use
+    """
+    fp = await asyncio.to_thread(gzip.open, file, "rb")
+    try:
+        header = await asyncio.to_thread(_read, fp)
+        if header[:2] != (FORMAT, VERSION):
+            raise ValueError(f"{file} is not a backup")
+
+        logger.info(f"Restoring {len(header[2])} cogs from {file}")
+        cog = None
+        count = 0
+        while True:
+            kind, value = await asyncio.to_thread(_read, fp)
+            if kind == "cog":
+                cog = value
+                driver.register(cog, schema={}, override_schema=True)
+            elif kind == "entries":
+                await driver.set_many(cog, dict(value))
+                count += len(value)
+                if progress is not None:
+                    progress(cog, count)
+            elif kind == "end":
+                break
+    finally:
+        await asyncio.to_thread(fp.close)
+
+    await driver.commit()
+    logger.info(f"Restored {count} entries from {file}")
+    return count
+
+
+async def migrate(source: Base, target: Base, *, cogs: Optional[Iterable[str]] = None, chunk_size: int = 1000,
+                  progress: Optional[Progress] = None) -> int:
+    """Copy the data of every cog (or of cogs) from a driver to another, return the number of entries"""
+    cogs = list(await source.cogs() if cogs is None else cogs)
+    logger.info(f"Migrating {len(cogs)} cogs from {type(source).__name__} to {type(target).__name__}")
+
+    count = 0
+    for cog in cogs:
+        target.register(cog, schema={}, override_schema=True)
+        async for chunk in source.export(cog, chunk_size):
+            await target.set_many(cog, dict(chunk))
+            count += len(chunk)
+            if progress is not None:
+                progress(cog, count)
+
+    await target.commit()
+    logger.info(f"Migrated {count} entries")
+    return count
@@ -1,46 +1,75 @@
 from __future__ import annotations
 
+import asyncio
 import logging
-from dataclasses import dataclass, asdict
-from typing import Union, Final, AsyncIterator
+from math import ceil
+from typing import Any, AsyncIterator, Callable, Container, Final, Iterable, Mapping, Optional, Union
 
 from nextcord import User, Member
 
+from .accounts import BankUser
 from .config import Config
-from .errors import BalanceOverLimitError, BalanceUnderLimitError
+from .drivers import Base
+from .errors import BalanceOverLimitError, BalanceUnderLimitError, FreeCreditsCooldownError
+from .leaderboard import Leaderboard
+from .ledger import Entry, Kind, Ledger
 
 MAX_BALANCE: Final = pow(2, 32)
+# balance of new accounts
+START_BALANCE: Final = 50
 
 logger = logging.getLogger("useless_bot.core.bank_core")
 
 schema = {
-    "users": {}
+    "users": {},
+    # users who claimed their free credits, until the cooldown expires
+    "free_cooldown": {}
 }
 
 
-@dataclass()
-class BankUser:
-    user_id: int
-    balance: int = 50
-    last_free_credits: int = 0
-
-
 class BankCore:
     _config: Config
+    # users ordered by balance, loaded on startup or on first use and then kept up to date
+    _leaderboard: Optional[Leaderboard] = None
+    _loading: Optional[asyncio.Future] = None
+    # log of every change of the balances, if any
+    _ledger: Optional[Ledger] = None
 
-    def __init__(self):
-        self.__class__._config = Config("BankCore", schema=schema)
+    def __init__(self, driver: Optional[Base] = None, ledger: Optional[Ledger] = None):
+        self.__class__._config = Config("BankCore", schema=schema, driver=driver, write_behind=True)
+        self.__class__._ledger = ledger
 
-    async def add_user(self, user: Union[User, Member, int]):
-        """Add a user in the database"""
-        if type(user) is int:
-            user_id = user
-        else:
-            user_id = user.id
+    async def close(self):
+        if self._ledger is not None:
+            await self._ledger.close()
+
+    @staticmethod
+    def _new_account(user_id: int) -> dict:
+        return {"user_id": user_id, "balance": START_BALANCE}
 
-        await self._config.set(keys=("users", user_id), value=asdict(BankUser(user_id)))
+    def _record(self, kind: Kind, user_id: int, delta: int, balance: int, other_id: int = 0):
+        if self._ledger is not None:
+            self._ledger.append(kind, user_id, delta, balance, other_id)
+
+    async def _open(self, user_id: int) -> dict:
+        """
+        Create the account of a user if it is missing, and return the account stored.
+        Another process could create and credit the account meanwhile, so an existing account is never overwritten
+        """
+        created = await self._config.setdefault(keys=("users", user_id), value=self._new_account(user_id))
+        user_data = await self._config.get(keys=("users", user_id))
+
+        self._rank(user_id, user_data["balance"])
+        if created:
+            self._record(Kind.OPEN, user_id, user_data["balance"], user_data["balance"])
+        return user_data
+
+    async def add_user(self, user: Union[User, Member, int]):
+        """Add a user in the database, an existing account is kept"""
+        await self.get_user(user)
 
     async def get_user(self, user: Union[User, Member, int]) -> BankUser:
+        """Account of a user, created if needed"""
         if type(user) is int:
             user_id = user
         else:
@@ -48,12 +77,10 @@ class BankCore:
 
         try:
             user_data = await self._config.get(keys=("users", user_id))
-            user = BankUser(**user_data)
         except KeyError:
-            user = BankUser(user_id)
-            await self._config.set(keys=("users", user_id), value=asdict(user))
-        finally:
-            return user
+            user_data = await self._open(user_id)
+
+        return BankUser(user_id, user_data["balance"])
 
     async def del_user(self, user: Union[User, Member, int]):
         if type(user) is int:
@@ -62,66 +89,288 @@ class BankCore:
             user_id = user.id
 
         await self._config.delete(keys=("users", user_id))
+        if self._leaderboard is not None:
+            self._leaderboard.remove(user_id)
+        self._record(Kind.CLOSE, user_id, 0, 0)
 
     async def balance(self, user: Union[User, Member]) -> int:
         return await self._config.get(keys=("users", user.id, "balance"))
 
-    async def last_free_credits(self, user: Union[User, Member]) -> int:
-        return await self._config.get(keys=("users", user.id, "last_free_credits"))
-
-    async def update_last_free_credits(self, user: Union[User, Member], new_time: int):
-        await self._config.set(keys=("users", user.id, "last_free_credits"), value=new_time)
+    async def free_credits_cooldown(self, user: Union[User, Member, int]) -> int:
+        """Seconds before the user can claim free credits again"""
+        user_id = user if type(user) is int else user.id
+        return ceil(await self._config.claimed(keys=("free_cooldown", user_id)))
 
     async def clear(self):
         """Reset database"""
         await self._config.delete_data()
-        await self._config.init()
+        await self._config.init(schema=schema)
+        if self._leaderboard is not None:
+            self._leaderboard.clear()
+        self._record(Kind.RESET, 0, 0, 0)
 
-    async def _subtraction(self, user: Union[User, Member], value: int) -> int:
-        new_value = await self.balance(user) - value
-        if new_value >= 0:
-            return new_value
-        else:
-            raise BalanceUnderLimitError
+    async def transfer(self, deltas: Mapping[Union[User, Member, int], int], kind: Kind = Kind.TRANSFER):
+        """
+        Add a delta to the balance of every user atomically, saving them with a single commit.
+        If a balance would go under 0 or over the limit, no balance is changed.
+        The changes are recorded in the ledger as kind
+        """
+        balances = {}
+        for user, delta in deltas.items():
+            keys = ("users", user if type(user) is int else user.id, "balance")
+            balances[keys] = balances.get(keys, 0) + delta
 
-    async def _addition(self, user: Union[User, Member], value: int) -> int:
-        new_value = await self.balance(user) + value
-        if new_value < MAX_BALANCE:
-            return new_value
-        else:
-            raise BalanceOverLimitError
+        logger.debug(f"Transferring credits: {balances}")
+        try:
+            values = await self._config.add(balances, minimum=0, maximum=MAX_BALANCE - 1)
+        except ValueError:
+            raise BalanceUnderLimitError from None
+        except OverflowError:
+            raise BalanceOverLimitError from None
 
-    async def withdraw(self, user: Union[User, Member, int], value: int):
-        if type(user) is int:
-            user_id = user
-        else:
-            user_id = user.id
+        # between two users, each record refers to the other one
+        others = {}
+        if len(balances) == 2:
+            (_, first, _), (_, second, _) = balances
+            others = {first: second, second: first}
 
-        logger.debug(f"Withdrawing {value} credits from {user_id}")
-        value = await self._subtraction(user, value)
-        await self._config.set(keys=("users", user_id, "balance"), value=value)
-        logger.debug(f"Withdraw of {value} credits from {user_id}")
+        for ((_, user_id, _), delta), value in zip(balances.items(), values):
+            self._rank(user_id, value)
+            self._record(kind, user_id, delta, value, others.get(user_id, 0))
 
-    async def deposit(self, user: Union[User, Member, int], value: int):
-        if type(user) is int:
-            user_id = user
-        else:
-            user_id = user.id
+    async def withdraw(self, user: Union[User, Member, int], value: int, kind: Kind = Kind.WITHDRAW):
+        await self.transfer({user: -value}, kind=kind)
+
+    async def deposit(self, user: Union[User, Member, int], value: int, kind: Kind = Kind.DEPOSIT):
+        await self.transfer({user: value}, kind=kind)
+
+    async def claim_free_credits(self, user: Union[User, Member], value: int, cooldown: int):
+        """Deposit free credits if they have not been claimed in the last cooldown seconds"""
+        logger.debug(f"Claiming {value} free credits for {user.id}")
+        # the cooldown key only exists until it expires
+        try:
+            seconds = await self._config.claim(keys=("free_cooldown", user.id), ttl=cooldown)
+        except KeyError:
+            # data saved before the cooldowns were added
+            await self._config.setdefault(keys=("free_cooldown",), value={})
+            seconds = await self._config.claim(keys=("free_cooldown", user.id), ttl=cooldown)
+
+        if seconds > 0:
+            raise FreeCreditsCooldownError(ceil(seconds))
 
-        logger.debug(f"Depositing {value} credits to {user_id}")
-        value = await self._addition(user, value)
-        await self._config.set(keys=("users", user_id, "balance"), value=value)
-        logger.debug(f"Deposit of {value} credits to {user_id} complete")
+        try:
+            await self.deposit(user, value)
+        except Exception:
+            await self._config.release(keys=("free_cooldown", user.id))
+            raise
 
     async def move(self, from_user: Union[User, Member], to_user: Union[User, Member], value: int):
         """Move credits from a user to another"""
         logger.debug(f"Moving {value} from <@{from_user}> to <@{to_user}>")
 
-        await self.withdraw(user=from_user, value=value)
-        await self.deposit(user=to_user, value=value)
+        # users compare by id: sum the deltas, so a move to the same user changes nothing
+        deltas = {from_user.id: -value}
+        deltas[to_user.id] = deltas.get(to_user.id, 0) + value
+        await self.transfer(deltas, kind=Kind.MOVE)
+
+    async def airdrop(self, users: Iterable[Union[User, Member, int]], value: int, *,
+                      batch_size: int = 1000) -> dict[int, Exception]:
+        """
+        Add value (remove it, if negative) to the balance of many users, creating the missing accounts,
+        and save them with a single commit. Users whose balance would go under 0 or over the limit are skipped:
+        return their errors by user id
+        """
+        user_ids = list(dict.fromkeys(user if type(user) is int else user.id for user in users))
+        logger.debug(f"Airdropping {value} credits to {len(user_ids)} users")
+
+        failed = {}
+        async with self._config.transaction():
+            for start in range(0, len(user_ids), batch_size):
+                batch = user_ids[start:start + batch_size]
+                balances = await self._config.get_many((("users", user_id, "balance") for user_id in batch),
+                                                       default=None)
+
+                # another process could create the accounts meanwhile, only the ones created here are opened
+                created = set()
+                missing = [user_id for user_id, balance in zip(batch, balances) if balance is None]
+                if missing:
+                    for user_id in missing:
+                        if await self._config.setdefault(keys=("users", user_id), value=self._new_account(user_id)):
+                            created.add(user_id)
+                    balances = await self._config.get_many((("users", user_id, "balance") for user_id in batch),
+                                                           default=None)
+
+                # check the limits of the whole batch, then apply the valid deltas together
+                deltas = {}
+                for user_id, balance in zip(batch, balances):
+                    if balance is None:
+                        # deleted meanwhile
+                        failed[user_id] = KeyError(user_id)
+                        continue
+                    if user_id in created:
+                        self._rank(user_id, balance)
+                        self._record(Kind.OPEN, user_id, balance, balance)
+
+                    if balance + value < 0:
+                        failed[user_id] = BalanceUnderLimitError()
+                    elif balance + value >= MAX_BALANCE:
+                        failed[user_id] = BalanceOverLimitError()
+                    else:
+                        deltas[("users", user_id, "balance")] = value
+
+                try:
+                    values = await self._config.add(deltas, minimum=0, maximum=MAX_BALANCE - 1)
+                except (KeyError, ValueError, OverflowError):
+                    # a balance changed since it was checked: apply the deltas one by one
+                    values = []
+                    for keys in list(deltas):
+                        try:
+                            values += await self._config.add({keys: value}, minimum=0, maximum=MAX_BALANCE - 1)
+                        except KeyError as error:
+                            failed[keys[1]] = error
+                        except ValueError:
+                            failed[keys[1]] = BalanceUnderLimitError()
+                        except OverflowError:
+                            failed[keys[1]] = BalanceOverLimitError()
+                        else:
+                            continue
+                        del deltas[keys]
+
+                for (_, user_id, _), balance in zip(deltas, values):
+                    self._rank(user_id, balance)
+                    self._record(Kind.AIRDROP, user_id, value, balance)
+
+        logger.info(f"Airdropped {value} credits to {len(user_ids) - len(failed)} users, {len(failed)} failed")
+        return failed
+
+    # ------------|
+    # Leaderboard |
+    # ------------|
+    def load(self) -> asyncio.Future:
+        """
+        Build the leaderboard from the accounts stored, in background.
+        The load is started once and shared: await the future returned to wait for it
+        """
+        if self._loading is None:
+            self.__class__._loading = asyncio.ensure_future(self._load())
+
+        return self._loading
+
+    async def _load(self):
+        # Set before loading, so the balances changed meanwhile are applied as they change:
+        # a page is added as soon as it is read, so it never overwrites a newer balance
+        leaderboard = self.__class__._leaderboard = Leaderboard()
+        try:
+            async for user in self.accounts():
+                leaderboard.update(user.user_id, user.balance)
+        except Exception:
+            logger.error("Loading the leaderboard failed", exc_info=True)
+            # loaded again on next use
+            self.__class__._leaderboard = None
+            self.__class__._loading = None
+            raise
+
+        logger.info(f"Loaded {len(leaderboard)} accounts")
+
+    def _rank(self, user_id: int, balance: int):
+        if self._leaderboard is not None:
+            self._leaderboard.update(user_id, balance)
+
+    async def top(self, n: int, start: int = 0) -> list[tuple[int, int]]:
+        """(user id, balance) of the n richest users, from the position start"""
+        # a cancelled caller must not cancel the load for the others
+        await asyncio.shield(self.load())
+
+        return self._leaderboard.top(n, start)
+
+    async def rank(self, user: Union[User, Member, int]) -> tuple[int, int]:
+        """Position of a user in the leaderboard, starting from 1, and number of users ranked"""
+        await asyncio.shield(self.load())
+
+        return self._leaderboard.rank(user if type(user) is int else user.id), len(self._leaderboard)
+
+    # ---------|
+    # Accounts |
+    # ---------|
+    async def accounts(self, *, batch_size: int = 1000, min_balance: Optional[int] = None,
+                       max_balance: Optional[int] = None,
+                       claimed_free_credits: Optional[bool] = None) -> AsyncIterator[BankUser]:
+        """
+        Iterate the accounts page by page, holding the lock only while a page is read.
+        Filter them by balance range, and by whether their free credits are on cooldown.
+        Accounts created or deleted during the iteration may be skipped
+        """
+        after = None
+        while True:
+            user_ids = await self._config.scan(keys=("users",), after=after, count=batch_size)
+            if not user_ids:
+                return
+            after = user_ids[-1]
+            # let other tasks run between pages, reading a page may not wait at all
+            await asyncio.sleep(0)
+
+            for user_data in await self._config.get_many((("users", user_id) for user_id in user_ids), default=None):
+                # deleted since the page was listed
+                if user_data is None:
+                    continue
+
+                user = BankUser(user_data["user_id"], user_data["balance"])
+                if min_balance is not None and user.balance < min_balance:
+                    continue
+                if max_balance is not None and user.balance > max_balance:
+                    continue
+                if claimed_free_credits is not None:
+                    if claimed_free_credits != (await self.free_credits_cooldown(user.user_id) > 0):
+                        continue
+
+                yield user
+
+    async def cleanup(self, keep: Container[int], *, batch_size: int = 1000,
+                      progress: Optional[Callable[[int, int], Any]] = None) -> int:
+        """
+        Delete the accounts of the users not in keep, return the number of accounts deleted.
+        Account ids are compared with keep page by page, then the stale accounts are deleted with a single commit.
+        progress is called after every page with the number of accounts scanned and of stale accounts found
+        """
+        stale = []
+        scanned = 0
+        after = None
+        while True:
+            user_ids = await self._config.scan(keys=("users",), after=after, count=batch_size)
+            if not user_ids:
+                break
+            after = user_ids[-1]
+
+            scanned += len(user_ids)
+            stale.extend(user_id for user_id in user_ids if user_id not in keep)
+            if progress is not None:
+                progress(scanned, len(stale))
+            await asyncio.sleep(0)
+
+        # accounts deleted meanwhile are skipped
+        deleted = []
+        async with self._config.transaction():
+            for start in range(0, len(stale), batch_size):
+                deleted += await self._config.delete_many(("users", user_id)
+                                                          for user_id in stale[start:start + batch_size])
+
+        for _, user_id in deleted:
+            if self._leaderboard is not None:
+                self._leaderboard.remove(user_id)
+            self._record(Kind.CLOSE, user_id, 0, 0)
+
+        logger.info(f"Deleted {len(deleted)} stale accounts of {scanned}")
+        return len(deleted)
+
+    async def history(self, user: Union[User, Member, int]) -> AsyncIterator[Entry]:
+        """Changes of the balance of a user, newest first, streamed from the ledger"""
+        if self._ledger is None:
+            return
+
+        async for entry in self._ledger.history(user if type(user) is int else user.id):
+            yield entry
 
     @property
     async def users(self) -> AsyncIterator[int]:
-        # TODO: improve this, it's not efficient when there are a lot of users
-        for user in await self._config.get(["users"]):
-            yield user["id"]
+        async for user in self.accounts():
+            yield user.user_id
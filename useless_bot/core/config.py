@@ -1,30 +1,109 @@
+import json
 import logging
-from contextlib import asynccontextmanager
-from typing import Any, Optional
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager, suppress
+from time import perf_counter, time
+from typing import Any, Optional, Callable, Iterable, Mapping, NamedTuple, Union
 
 from aiorwlock import RWLock
 from nextcord import Guild
 
 from .drivers import Base, KeysSet, Shelve
+from .metrics import measured, metrics
+from .ttl import Sweeper
+from .write_behind import WriteBehind
 
 logger = logging.getLogger("useless_bot.core.config")
 
+# default value of update, when the key must exist
+_MISSING = object()
+# top-level key storing the expiration time of every expiring key of a cog
+_EXPIRES = "__expires__"
+
+
+def _cog_of(config: "Config", *args, **kwargs) -> str:
+    return config._cog
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    size: int
+    max_size: int
+
 
 class Config:
-    def __init__(self, cog: str, schema=None, override_schema: bool = False, driver: Optional[Base] = None):
+    # write-behind settings: flush every flush_interval seconds or after flush_threshold changes
+    flush_interval: float = 5
+    flush_threshold: int = 100
+
+    # one scheduler per driver class, since drivers share their data between instances
+    _schedulers: dict[type, WriteBehind] = {}
+    # a driver of every class in use, to save them on close
+    _drivers: dict[type, Base] = {}
+
+    # version of the data of every cog, bumped on every write
+    _versions: dict[str, int] = {}
+
+    # Every cog has its own locks, shared by its instances: a cog lock and stripes.
+    # Keys sharing their first lock_prefix_length keys, like ("users", user_id), are guarded by the same stripe,
+    # taken with the reader lock of the cog. Keys shorter than the prefix, like ("users",) or ("free_credits",),
+    # cover whole subtrees: writing them takes the writer lock of the cog alone,
+    # reading them takes the reader lock of the cog and of the stripes used under them, so reads still run together.
+    # The stripes used under every short prefix are registered by the first writer of a stripe under the prefix,
+    # holding the writer lock of the cog, so they don't change while a subtree is read.
+    # Lock ordering: the cog lock first, then the stripes once each, in ascending index order,
+    # so operations never deadlock.
+    lock_stripes: int = 64
+    lock_prefix_length: int = 2
+    # cog lock, stripes and stripes used under every short prefix of every cog, created on first use,
+    # so they are bound to the running event loop
+    _locks: dict[str, tuple[RWLock, dict[int, RWLock], dict[tuple, set[int]]]] = {}
+
+    # expiration time of the expiring keys of every cog, loaded on first use
+    _expirations: dict[str, dict[tuple, float]] = {}
+    _sweeper = Sweeper()
+
+    # number of guild partitions of a cog kept in memory, the least recently used are unloaded
+    guild_budget: int = 256
+
+    def __init__(self, cog: str, schema=None, override_schema: bool = False, driver: Optional[Base] = None,
+                 write_behind: bool = False, cache_size: int = 0, guild_schema=None):
         if schema is None:
             schema = {}
+        if guild_schema is None:
+            guild_schema = {}
 
         self._driver = driver or Shelve()
+        self._drivers.setdefault(type(self._driver), self._driver)
+
+        # setup write-behind
+        self._scheduler: Optional[WriteBehind] = None
+        if write_behind:
+            driver_type = type(self._driver)
+            if driver_type not in self._schedulers:
+                self._schedulers[driver_type] = WriteBehind(self._driver, interval=self.flush_interval,
+                                                            threshold=self.flush_threshold)
+            self._scheduler = self._schedulers[driver_type]
 
         # set main key
         self._cog = cog
+        self._versions.setdefault(cog, 0)
+
+        # setup read cache: keys -> (version, value)
+        self._cache: Optional[OrderedDict[tuple, tuple[int, Any]]] = OrderedDict() if cache_size > 0 else None
+        self._cache_size = cache_size
+        self._hits = 0
+        self._misses = 0
 
         # register main key
         self._driver.register(self._cog, schema=schema, override_schema=override_schema)
 
-        # setup lock
-        self._lock = RWLock(fast=True)
+        # guild partitions loaded, in least recently used order
+        self._guild_schema = guild_schema
+        self._guild_seeded: Optional[dict] = None
+        self._guilds: OrderedDict[int, Config] = OrderedDict()
+        self._unloaded = False
 
         # transaction variables
         self._in_transaction = False
@@ -32,86 +111,541 @@ class Config:
     # -------|
     # Global |
     # -------|
+    @measured("get", source="config", cog=_cog_of)
     async def get(self, keys: KeysSet) -> Any:
-        async with self._lock.reader_lock:
+        if self._cache is not None:
+            # writers bump the version when they take their lock, so a hit is up to date without locking
+            value = self._cache_hit(tuple(keys))
+            if value is not _MISSING:
+                return value
+
+        async with self._reader([keys]):
             logging.debug(f"Getting value for {self._cog}/{keys}")
-            return await self._driver.get(cog=self._cog, keys=keys)
+            await self._check_expired(keys)
+            if self._cache is None:
+                return await self._driver.get(cog=self._cog, keys=keys)
+
+            return await self._cached_get(tuple(keys))
 
-    async def set(self, keys: KeysSet, value: Any):
-        async with self._lock.writer_lock:
+    @measured("set", source="config", cog=_cog_of)
+    async def set(self, keys: KeysSet, value: Any, ttl: Optional[float] = None):
+        """Set a value, removed after ttl seconds if given"""
+        async with self._writer([keys]):
             logging.debug(f"Setting value for {self._cog}/{keys}")
             await self._driver.set(cog=self._cog, keys=keys, value=value)
+            await self._set_expiration(keys, ttl)
 
-            if not self._in_transaction:
-                # save changes
-                await self.save()
+            await self._commit()
 
+    @measured("delete", source="config", cog=_cog_of)
     async def delete(self, keys: KeysSet):
-        async with self._lock.writer_lock:
+        async with self._writer([keys]):
             logging.debug(f"Deleting value for {self._cog}/{keys}")
             await self._driver.delete(cog=self._cog, keys=keys)
+            await self._set_expiration(keys, None)
 
-            if not self._in_transaction:
-                # save changes
-                await self.save()
+            await self._commit()
 
-    async def setdefault(self, keys: KeysSet, value: Any) -> Any:
-        async with self._lock.writer_lock:
-            await self._driver.setdefault(cog=self._cog, keys=keys, value=value)
+    @measured("setdefault", source="config", cog=_cog_of)
+    async def setdefault(self, keys: KeysSet, value: Any) -> bool:
+        """Set keys to value unless they are set, return whether they were set"""
+        async with self._writer([keys]):
+            await self._remove_expired(keys)
+            created = await self._driver.setdefault(cog=self._cog, keys=keys, value=value)
 
-            if not self._in_transaction:
-                # save changes
-                await self.save()
+            await self._commit()
+            return created
+
+    # ------|
+    # Batch |
+    # ------|
+    @measured("get_many", source="config", cog=_cog_of)
+    async def get_many(self, paths: Iterable[KeysSet], default: Any = _MISSING) -> list[Any]:
+        """Get the values of many keys at once. Missing keys raise KeyError, or get default if given"""
+        paths = list(paths)
+        async with self._reader(paths):
+            logging.debug(f"Getting many values for {self._cog}")
+            values = []
+            for keys in paths:
+                try:
+                    await self._check_expired(keys)
+                    values.append(await self._driver.get(cog=self._cog, keys=keys))
+                except KeyError:
+                    if default is _MISSING:
+                        raise
+                    values.append(default)
+
+            return values
+
+    @measured("delete_many", source="config", cog=_cog_of)
+    async def delete_many(self, paths: Iterable[KeysSet]) -> list[tuple]:
+        """Delete many keys at once, saving them together. Keys not set are skipped, return the keys deleted"""
+        paths = list(paths)
+        async with self._writer(paths):
+            logging.debug(f"Deleting {len(paths)} values for {self._cog}")
+            deleted = []
+            for keys in paths:
+                with suppress(KeyError):
+                    await self._driver.delete(cog=self._cog, keys=keys)
+                    await self._set_expiration(keys, None)
+                    deleted.append(tuple(keys))
+
+            await self._commit()
+            return deleted
+
+    @measured("scan", source="config", cog=_cog_of)
+    async def scan(self, keys: KeysSet, after: Union[str, int, None] = None,
+                   count: int = 1000) -> list[Union[str, int]]:
+        """
+        A page of the keys of a dictionary: at most count keys following the key after.
+        Iterate a dictionary page by page passing the last key of the previous page,
+        the lock is released between pages, so keys added or removed meanwhile may be skipped
+        """
+        async with self._reader([keys]):
+            return await self._driver.scan(cog=self._cog, keys=keys, after=after, count=count)
+
+    @measured("set_many", source="config", cog=_cog_of)
+    async def set_many(self, values: Mapping[tuple, Any]):
+        """Set many values at once, saving them together"""
+        async with self._writer(values):
+            logging.debug(f"Setting {len(values)} values for {self._cog}")
+            await self._driver.set_many(cog=self._cog, values=values)
+            for keys in values:
+                await self._set_expiration(keys, None)
+
+            await self._commit()
+
+    @measured("update", source="config", cog=_cog_of)
+    async def update(self, keys: KeysSet, func: Callable[[Any], Any], default: Any = _MISSING,
+                     ttl: Optional[float] = None) -> Any:
+        """
+        Replace a value with func(value) atomically and return the new value.
+        If the key is not set, default is passed to func, or KeyError is raised if no default is given.
+        Exceptions raised by func leave the value unchanged.
+        If ttl is given the value is removed after ttl seconds, otherwise its expiration is kept
+        """
+        async with self._writer([keys]):
+            logging.debug(f"Updating value for {self._cog}/{keys}")
+            await self._remove_expired(keys)
+            try:
+                value = await self._driver.get(cog=self._cog, keys=keys)
+            except KeyError:
+                if default is _MISSING:
+                    raise
+                value = default
+
+            value = func(value)
+            await self._driver.set(cog=self._cog, keys=keys, value=value)
+            if ttl is not None:
+                await self._set_expiration(keys, ttl)
+
+            await self._commit()
+            return value
+
+    @measured("add", source="config", cog=_cog_of)
+    async def add(self, deltas: Mapping[tuple, int], minimum: Optional[int] = None,
+                  maximum: Optional[int] = None) -> list[int]:
+        """
+        Add a delta to many integer values atomically and return the new values, saving them together.
+        If a value is missing, is not an integer or would go out of minimum and maximum, nothing is changed
+        """
+        async with self._writer(deltas):
+            logging.debug(f"Adding to {len(deltas)} values for {self._cog}")
+            for keys in deltas:
+                await self._remove_expired(keys)
+
+            values = await self._driver.add(cog=self._cog, deltas=deltas, minimum=minimum, maximum=maximum)
+
+            await self._commit()
+            return values
 
     # ------|
     # Guild |
     # ------|
+    async def for_guild(self, guild: Guild) -> "Config":
+        """
+        Config of the partition of a guild, initialized with guild_schema.
+        Partitions are loaded on first use, and unloaded when more than guild_budget are in memory
+        """
+        try:
+            config = self._guilds[guild.id]
+        except KeyError:
+            pass
+        else:
+            self._guilds.move_to_end(guild.id)
+            return config
+
+        schema = await self._guild_seed()
+        # another task could have loaded the partition in the meantime
+        if guild.id in self._guilds:
+            return self._guilds[guild.id]
+
+        logging.debug(f"Loading {self._cog} partition of guild {guild.id}")
+        config = Config(f"{self._cog}.{guild.id}", schema=schema, driver=self._driver,
+                        write_behind=self._scheduler is not None, cache_size=self._cache_size)
+        self._guilds[guild.id] = config
+
+        if len(self._guilds) > self.guild_budget:
+            _, evicted = self._guilds.popitem(last=False)
+            await evicted._unload()
+
+        return config
+
+    async def _guild_seed(self) -> dict:
+        """
+        Schema of new partitions: guild_schema, with the settings the cog stored globally before being partitioned.
+        Only values are copied: dictionaries empty in guild_schema, like the warn counts, belong to a guild
+        and start empty. Partitions already stored are not changed
+        """
+        if self._guild_seeded is not None:
+            return self._guild_seeded
+
+        async with self._reader([()]):
+            seed = await self._seed(self._guild_schema, ())
+
+        self._guild_seeded = seed
+        return seed
+
+    async def _seed(self, schema: dict, keys: tuple) -> dict:
+        seed = {}
+        for key, default in schema.items():
+            sub_keys = keys + (key,)
+            if type(default) is dict:
+                seed[key] = await self._seed(default, sub_keys) if default else {}
+                continue
+
+            try:
+                seed[key] = await self._driver.get(cog=self._cog, keys=sub_keys)
+            except KeyError:
+                seed[key] = default
+
+        return seed
+
     async def get_from_guild(self, guild: Guild, keys: KeysSet) -> Any:
-        async with self._lock.reader_lock:
-            logging.debug(f"Getting value for {self._cog}/{keys} from")
-            return await self._driver.get(cog=self._cog, keys=keys)
+        return await (await self.for_guild(guild)).get(keys)
 
     async def set_for_guild(self, guild: Guild, keys: KeysSet, value: Any):
-        async with self._lock.writer_lock:
-            logging.debug(f"Setting value for {self._cog}/{keys}")
-            await self._driver.set(cog=self._cog, keys=keys, value=value)
-
-            if not self._in_transaction:
-                # save changes
-                await self.save()
+        await (await self.for_guild(guild)).set(keys, value)
 
     async def delete_from_guild(self, guild: Guild, keys: KeysSet):
-        async with self._lock.writer_lock:
-            logging.debug(f"Deleting value for {self._cog}/{keys}")
-            await self._driver.delete(cog=self._cog, keys=keys)
-
-            if not self._in_transaction:
-                # save changes
-                await self.save()
+        await (await self.for_guild(guild)).delete(keys)
 
     async def register_guild(self, guild: Guild, keys: KeysSet, value: Any) -> Any:
-        async with self._lock.writer_lock:
-            await self._driver.setdefault(cog=self._cog, keys=keys, value=value)
+        await (await self.for_guild(guild)).setdefault(keys, value)
 
-            if not self._in_transaction:
-                # save changes
-                await self.save()
+    async def _unload(self):
+        """Write the data of the cog and release its memory, with its locks and expirations"""
+        logging.debug(f"Unloading {self._cog}")
+        async with self._writer([()]):
+            await self._driver.unload(self._cog)
+            self._unloaded = True
+            if self._cache is not None:
+                self._cache.clear()
+
+            # expirations are scheduled again when the partition is loaded
+            self._sweeper.cancel(self)
+            self._expirations.pop(self._cog, None)
+            self._versions.pop(self._cog, None)
+            # tasks waiting for the locks take new ones once they are released
+            self._locks.pop(self._cog, None)
 
     # ----|
     # Cog |
     # ----|
     async def delete_data(self):
         logging.info(f"Deleting all data for {self._cog}")
-        await self._driver.unregister(cog=self._cog)
+        async with self._writer([()]):
+            await self._driver.unregister(cog=self._cog)
+            self._expirations.pop(self._cog, None)
 
-        if not self._in_transaction:
-            # save changes
-            await self.save()
+            await self._commit()
 
     async def init(self, schema=None, override_schema: bool = False):
         if schema is None:
             schema = {}
-        self._driver.register(self._cog, schema=schema, override_schema=override_schema)
+
+        async with self._writer([()]):
+            self._driver.register(self._cog, schema=schema, override_schema=override_schema)
+            self._expirations.pop(self._cog, None)
+
+    # ------|
+    # Cache |
+    # ------|
+    def _cache_hit(self, keys: tuple) -> Any:
+        """The cached value of keys if up to date and not expired, _MISSING otherwise"""
+        try:
+            cached_version, value = self._cache[keys]
+        except KeyError:
+            return _MISSING
+
+        if cached_version != self._versions.get(self._cog, 0):
+            return _MISSING
+
+        # expired values are handled by the locked path
+        table = self._expirations.get(self._cog)
+        if table is None or self._expired(table, keys):
+            return _MISSING
+
+        self._hits += 1
+        self._cache.move_to_end(keys)
+        return value
+
+    async def _cached_get(self, keys: tuple) -> Any:
+        version = self._versions.get(self._cog, 0)
+
+        try:
+            cached_version, value = self._cache[keys]
+        except KeyError:
+            pass
+        else:
+            if cached_version == version:
+                self._hits += 1
+                self._cache.move_to_end(keys)
+                return value
+
+        self._misses += 1
+        value = await self._driver.get(cog=self._cog, keys=keys)
+
+        self._cache[keys] = (version, value)
+        self._cache.move_to_end(keys)
+        if len(self._cache) > self._cache_size:
+            # evict the least recently used value
+            self._cache.popitem(last=False)
+
+        return value
+
+    def cache_info(self) -> CacheInfo:
+        """Hits and misses of the read cache"""
+        return CacheInfo(hits=self._hits, misses=self._misses, size=len(self._cache or ()), max_size=self._cache_size)
+
+    # -----------|
+    # Expiration |
+    # -----------|
+    async def ttl(self, keys: KeysSet) -> Optional[float]:
+        """Seconds before keys expire, None if they are not set or don't expire"""
+        keys = tuple(keys)
+        async with self._reader([keys]):
+            expires_at = (await self._expiration_table()).get(keys)
+
+        if expires_at is None or expires_at <= time():
+            return None
+
+        return expires_at - time()
+
+    async def _expiration_table(self) -> dict[tuple, float]:
+        try:
+            return self._expirations[self._cog]
+        except KeyError:
+            pass
+
+        try:
+            raw_table = await self._driver.get(cog=self._cog, keys=(_EXPIRES,))
+        except KeyError:
+            raw_table = {}
+
+        table = {tuple(json.loads(path)): expires_at for path, expires_at in raw_table.items()}
+
+        # another task could have loaded the table in the meantime
+        if self._expirations.setdefault(self._cog, table) is table:
+            for keys, expires_at in table.items():
+                self._sweeper.schedule(self, keys, expires_at)
+
+        return self._expirations[self._cog]
+
+    async def _check_expired(self, keys: KeysSet):
+        """Raise KeyError if keys or one of their parents has expired"""
+        keys = tuple(keys)
+        if self._expired(await self._expiration_table(), keys):
+            raise KeyError(keys[-1])
+
+    @staticmethod
+    def _expired(table: dict[tuple, float], keys: tuple) -> bool:
+        """Whether keys or one of their parents has expired"""
+        if not table:
+            return False
+
+        now = time()
+        for length in range(1, len(keys) + 1):
+            expires_at = table.get(keys[:length])
+            if expires_at is not None and expires_at <= now:
+                return True
+
+        return False
+
+    async def _set_expiration(self, keys: KeysSet, ttl: Optional[float]):
+        """
+        Set or clear the expiration of keys. Must hold the writer lock of keys.
+        Expirations belong to keys: changing their parents does not clear them
+        """
+        keys = tuple(keys)
+        table = await self._expiration_table()
+        path = json.dumps(keys)
+
+        if ttl is None:
+            if table.pop(keys, None) is not None:
+                with suppress(KeyError):
+                    await self._driver.delete(cog=self._cog, keys=(_EXPIRES, path))
+            return
+
+        expires_at = time() + ttl
+        table[keys] = expires_at
+        await self._driver.setdefault(cog=self._cog, keys=(_EXPIRES,), value={})
+        await self._driver.set(cog=self._cog, keys=(_EXPIRES, path), value=expires_at)
+
+        self._sweeper.schedule(self, keys, expires_at)
+
+    async def _remove_expired(self, keys: KeysSet):
+        """Delete keys if they have expired, so they are handled as not set. Must hold the writer lock of keys"""
+        keys = tuple(keys)
+        expires_at = (await self._expiration_table()).get(keys)
+        if expires_at is None or expires_at > time():
+            return
+
+        with suppress(KeyError):
+            await self._driver.delete(cog=self._cog, keys=keys)
+        await self._set_expiration(keys, None)
+
+    async def _expire(self, paths: list[tuple]) -> int:
+        """Delete the expired paths, called by the sweeper. Return the number of deleted paths"""
+        removed = 0
+        async with self._writer(paths):
+            table = await self._expiration_table()
+            for keys in paths:
+                # the expiration could have been changed since it was scheduled
+                expires_at = table.get(keys)
+                if expires_at is None or expires_at > time():
+                    continue
+
+                await self._remove_expired(keys)
+                removed += 1
+
+            if removed:
+                await self._commit()
+
+            if self._unloaded:
+                # the sweeper loaded the data of an unloaded partition again
+                await self._driver.unload(self._cog)
+
+        return removed
+
+    # -------|
+    # Claims |
+    # -------|
+    @measured("claim", source="config", cog=_cog_of)
+    async def claim(self, keys: KeysSet, ttl: float, value: Any = None) -> float:
+        """
+        Set keys to value (the current time by default) for ttl seconds, unless they are already set.
+        Return 0 if set, otherwise the seconds before they expire.
+        On shared drivers the storage expires them, so claims are atomic between processes too
+        """
+        if value is None:
+            value = int(time())
+
+        if self._driver.shared:
+            return await self._driver.claim(cog=self._cog, keys=keys, value=value, ttl=ttl)
+
+        async with self._writer([keys]):
+            await self._remove_expired(keys)
+            try:
+                await self._driver.get(cog=self._cog, keys=keys)
+            except KeyError:
+                await self._driver.set(cog=self._cog, keys=keys, value=value)
+                await self._set_expiration(keys, ttl)
+                await self._commit()
+                return 0
+
+        return await self.claimed(keys)
+
+    async def claimed(self, keys: KeysSet) -> float:
+        """Seconds before keys set by claim expire, 0 if they are not set"""
+        if self._driver.shared:
+            return await self._driver.claimed(cog=self._cog, keys=keys)
+
+        return await self.ttl(keys) or 0
+
+    async def release(self, keys: KeysSet):
+        """Delete keys set by claim before they expire"""
+        if self._driver.shared:
+            await self._driver.release(cog=self._cog, keys=keys)
+            return
+
+        async with self._writer([keys]):
+            with suppress(KeyError):
+                await self._driver.delete(cog=self._cog, keys=keys)
+            await self._set_expiration(keys, None)
+
+            await self._commit()
+
+    # ------|
+    # Locks |
+    # ------|
+    def _stripes_of(self, paths: Iterable[KeysSet]) -> tuple[list[tuple], list[tuple]]:
+        """Prefixes of the stripes guarding paths, and the paths covering a whole subtree"""
+        prefixes = []
+        subtrees = []
+        for keys in paths:
+            keys = tuple(keys)
+            if len(keys) < self.lock_prefix_length:
+                subtrees.append(keys)
+            else:
+                prefixes.append(keys[:self.lock_prefix_length])
+
+        return prefixes, subtrees
+
+    @asynccontextmanager
+    async def _locked(self, paths: Iterable[KeysSet], write: bool):
+        async with AsyncExitStack() as stack:
+            start = perf_counter()
+            prefixes, subtrees = self._stripes_of(paths)
+            indexes = {prefix: hash(prefix) % self.lock_stripes for prefix in prefixes}
+
+            while True:
+                entry = self._locks.get(self._cog)
+                if entry is None:
+                    entry = self._locks[self._cog] = RWLock(fast=True), {}, {}
+                cog_lock, stripes, used = entry
+
+                # the first write to a stripe under a prefix registers it, excluding the readers of the subtree
+                exclusive = write and (bool(subtrees) or any(index not in used.get(prefix[:-1], ())
+                                                             for prefix, index in indexes.items()))
+                lock = cog_lock.writer_lock if exclusive else cog_lock.reader_lock
+                await lock.acquire()
+                # the locks of an unloaded partition are dropped while tasks wait for them: take the new ones
+                if self._locks.get(self._cog) is entry:
+                    stack.callback(lock.release)
+                    break
+                lock.release()
+
+            if exclusive:
+                for prefix, index in indexes.items():
+                    for length in range(len(prefix)):
+                        used.setdefault(prefix[:length], set()).add(index)
+            else:
+                locked = set(indexes.values())
+                for keys in subtrees:
+                    locked.update(used.get(keys, ()))
+
+                for index in sorted(locked):
+                    stripe = stripes.get(index)
+                    if stripe is None:
+                        stripe = stripes[index] = RWLock(fast=True)
+                    await stack.enter_async_context(stripe.writer_lock if write else stripe.reader_lock)
+            metrics.observe("config", self._cog, "lock_wait", perf_counter() - start)
+            yield
+
+    @asynccontextmanager
+    async def _reader(self, paths: Iterable[KeysSet]):
+        """Acquire the reader locks of paths"""
+        async with self._locked(paths, write=False):
+            yield
+
+    @asynccontextmanager
+    async def _writer(self, paths: Iterable[KeysSet]):
+        """Acquire the writer locks of paths and invalidate the cached values"""
+        async with self._locked(paths, write=True):
+            # unloaded partitions have no version
+            self._versions[self._cog] = self._versions.get(self._cog, 0) + 1
+            yield
 
     # ------|
     # Other |
@@ -123,16 +657,46 @@ class Config:
         try:
             yield self
         finally:
-            logging.debug("Saving changes")
+            self._in_transaction = False
 
-            # save changes
-            await self.save()
+            logging.debug("Saving changes")
+            await self._commit()
 
-            self._in_transaction = False
             logging.debug("Closed config transaction")
 
+    async def _commit(self):
+        """Save changes, or schedule them when using write-behind"""
+        if self._in_transaction:
+            return
+
+        if self._scheduler is None:
+            await self.save()
+        else:
+            self._scheduler.mark_dirty()
+
     async def save(self):
         """Save changes"""
         logging.info("Saving data")
-        await self._driver.dump()
+        await self._driver.commit()
         logging.info("Data Saved")
+
+    async def flush(self):
+        """Write the changes still pending in write-behind"""
+        if self._scheduler is not None:
+            await self._scheduler.flush()
+
+    @classmethod
+    def drivers(cls) -> list[Base]:
+        """A driver of every class in use"""
+        return list(cls._drivers.values())
+
+    @classmethod
+    async def flush_all(cls):
+        """Stop every write-behind scheduler and write the pending changes of every driver"""
+        await cls._sweeper.close()
+        for scheduler in cls._schedulers.values():
+            await scheduler.close()
+
+        # changes no scheduler counted, like the cogs moved to their own shard
+        for driver in cls._drivers.values():
+            await driver.commit()
@@ -1,3 +1,5 @@
 from .base import Base, KeysSet
 from .json import Json
 from .shelve import Shelve
+from .sqlite import Sqlite
+from .redis import Redis
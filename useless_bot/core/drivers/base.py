@@ -1,15 +1,58 @@
+import asyncio
+import logging
 from abc import ABC, abstractmethod
-from typing import Any, Union, TypeVar
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from time import monotonic, perf_counter
+from typing import Any, Union, TypeVar, Callable, Optional, AsyncIterator, Mapping
+
+from .group_commit import GroupCommit
+from ..metrics import measured, metrics
 
 KeysSet = TypeVar('KeysSet', tuple[Union[str, int], ...], list[Union[str, int], ...])
 
+logger = logging.getLogger("useless_bot.core.drivers")
+
+# operations of every driver whose latency is recorded in metrics
+MEASURED = ("setdefault", "set", "set_many", "get", "delete", "add", "dump")
+
+
+def _cog_of(driver: "Base", cog: Optional[str] = None, *args, **kwargs) -> str:
+    # dump without a cog saves every cog
+    return cog or "*"
+
 
 class Base(ABC):
     _data: Any
 
+    # threads doing the disk work of the drivers
+    _executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="useless_bot-storage")
+
+    # the data is shared with other processes, so copies kept in memory go stale
+    shared: bool = False
+
+    # longest time (in seconds) the event loop has been blocked by a driver
+    max_blocking_time: float = 0
+
+    # commit pipeline of every driver class, drivers share their data between instances
+    _groups: dict[type, GroupCommit] = {}
+
+    # claims of the drivers keeping them in memory: (driver class, cog, keys) -> expiration on the monotonic clock
+    _claims: dict[tuple, float] = {}
+    _claims_limit: int = 1024
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # measure the operations implemented by the subclass, inherited ones are already measured
+        for name in MEASURED:
+            method = cls.__dict__.get(name)
+            if method is not None and not getattr(method, "__isabstractmethod__", False):
+                setattr(cls, name, measured(name, cog=_cog_of)(method))
+
     @abstractmethod
-    async def setdefault(self, cog: str, keys: KeysSet, value: Any = None) -> None:
-        """Initialize a sub_key if not already initialized"""
+    async def setdefault(self, cog: str, keys: KeysSet, value: Any = None) -> bool:
+        """Initialize a sub_key if not already initialized, return whether it was initialized"""
         ...
 
     @abstractmethod
@@ -27,6 +70,70 @@ class Base(ABC):
         """Delete a sub_key and its value"""
         ...
 
+    @abstractmethod
+    async def scan(self, cog: str, keys: KeysSet, after: Union[str, int, None] = None,
+                   count: int = 1000) -> list[Union[str, int]]:
+        """At most count keys of the dictionary under keys following the key after, in an order fixed by the driver"""
+        ...
+
+    async def set_many(self, cog: str, values: Mapping[tuple, Any]) -> None:
+        """Set many sub_keys at once"""
+        for keys, value in values.items():
+            await self.set(cog, keys, value)
+
+    async def add(self, cog: str, deltas: Mapping[tuple, int], minimum: Optional[int] = None,
+                  maximum: Optional[int] = None) -> list[int]:
+        """
+        Add a delta to every integer value and return the new values.
+        If a value is missing (KeyError), is not an integer (TypeError), would go under minimum (ValueError)
+        or over maximum (OverflowError), nothing is changed
+        """
+        values = []
+        for keys, delta in deltas.items():
+            value = await self.get(cog, keys)
+            if type(value) is not int:
+                raise TypeError(f"{keys} is not an integer")
+            if minimum is not None and value + delta < minimum:
+                raise ValueError(f"{keys} would be under {minimum}")
+            if maximum is not None and value + delta > maximum:
+                raise OverflowError(f"{keys} would be over {maximum}")
+            values.append(value + delta)
+
+        for keys, value in zip(deltas, values):
+            await self.set(cog, keys, value)
+
+        return values
+
+    async def claim(self, cog: str, keys: KeysSet, value: Any, ttl: float) -> float:
+        """
+        Set a sub_key to value for ttl seconds, expired by the storage itself, unless it is already set.
+        Return 0 if set, otherwise the seconds before it expires.
+        Shared drivers must implement it. Drivers used by a single process keep the claims in memory here,
+        without their value and lost on restart: Config claims with the stored data instead
+        """
+        now = monotonic()
+        claim = (type(self), cog, tuple(keys))
+        expires_at = self._claims.get(claim, 0)
+        if expires_at > now:
+            return expires_at - now
+
+        # drop the expired claims once they are as many as the ones kept after the last cleanup
+        if len(self._claims) >= self._claims_limit:
+            for key in [key for key, expires_at in self._claims.items() if expires_at <= now]:
+                del self._claims[key]
+            Base._claims_limit = max(1024, len(self._claims) * 2)
+
+        self._claims[claim] = now + ttl
+        return 0
+
+    async def claimed(self, cog: str, keys: KeysSet) -> float:
+        """Seconds before a sub_key set by claim expires, 0 if not set"""
+        return max(self._claims.get((type(self), cog, tuple(keys)), 0) - monotonic(), 0)
+
+    async def release(self, cog: str, keys: KeysSet) -> None:
+        """Delete a sub_key set by claim before it expires"""
+        self._claims.pop((type(self), cog, tuple(keys)), None)
+
     @abstractmethod
     def register(self, cog: str, *, schema: dict, override_schema: bool) -> None:
         """Initialize a main_key in data if not already initialized"""
@@ -38,10 +145,52 @@ class Base(ABC):
         ...
 
     @abstractmethod
-    async def dump(self) -> None:
-        """Save data"""
+    async def dump(self, cog: Optional[str] = None) -> None:
+        """Save data of cog, or of every cog"""
+        ...
+
+    @abstractmethod
+    async def cogs(self) -> list[str]:
+        """Names of the cogs stored"""
         ...
 
+    @abstractmethod
+    def export(self, cog: str, chunk_size: int = 1000) -> AsyncIterator[list[tuple[tuple, Any]]]:
+        """
+        Consistent snapshot of the data of cog, in chunks of (keys, value) pairs.
+        Dictionaries are given as empty dictionaries, before their content
+        """
+        ...
+
+    async def commit(self) -> None:
+        """Save data of every cog durably. Concurrent commits are grouped into a single dump"""
+        group = self._groups.get(type(self))
+        if group is None:
+            group = self._groups[type(self)] = GroupCommit(self.dump)
+
+        await group.request()
+
+    async def unload(self, cog: str) -> None:
+        """Save data of cog and release the memory it uses, it is loaded again on next use"""
+        await self.dump(cog=cog)
+
     async def _load(self) -> None:
         """Load data"""
         raise NotImplementedError
+
+    async def _run_io(self, func: Callable, *args, **kwargs) -> Any:
+        """Run blocking disk work on the storage threads"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    @contextmanager
+    def _blocking(self):
+        """Measure work done by a driver on the event loop"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            metrics.maximum(type(self).__name__, "*", "max_blocking_time", elapsed)
+            if elapsed > Base.max_blocking_time:
+                Base.max_blocking_time = elapsed
+                logger.debug(f"Storage blocked the event loop for {elapsed * 1000:.3f}ms")
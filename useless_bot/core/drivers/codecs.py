@@ -0,0 +1,138 @@
+import logging
+import pickle
+from abc import ABC, abstractmethod
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    logging.debug("Cannot import orjson. orjson codec not supported")
+
+try:
+    import msgpack
+except ImportError:
+    logging.debug("Cannot import msgpack. msgpack codec not supported")
+
+try:
+    import zstandard
+except ImportError:
+    logging.debug("Cannot import zstandard. zstd compression not supported")
+
+# first bytes of a zstd frame
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# prefix of the string keys that would be read back as int keys, or that start with it
+KEY_ESCAPE = "\x1f"
+
+
+def _escape_key(key: Any) -> Any:
+    if type(key) is str and (key.isdecimal() and key.isascii() or key.startswith(KEY_ESCAPE)):
+        return KEY_ESCAPE + key
+
+    return key
+
+
+def _restore_key(key: str) -> Any:
+    if key.startswith(KEY_ESCAPE):
+        return key[1:]
+
+    return int(key) if key.isdecimal() and key.isascii() else key
+
+
+def escape_keys(value: Any) -> Any:
+    """Escape the string keys looking like numbers, so restore_keys gives them back as strings"""
+    if type(value) is dict:
+        return {_escape_key(key): escape_keys(sub_value) for key, sub_value in value.items()}
+
+    return value
+
+
+def restore_keys(value: Any) -> Any:
+    """JSON objects only have string keys, turn back numeric keys (discord ids) into int"""
+    if type(value) is dict:
+        return {_restore_key(key): restore_keys(sub_value) for key, sub_value in value.items()}
+
+    return value
+
+
+class Codec(ABC):
+    """Turn the values stored by a driver into bytes and back"""
+    name: str
+
+    @abstractmethod
+    def encode(self, value: Any) -> bytes:
+        ...
+
+    @abstractmethod
+    def decode(self, raw_data: bytes) -> Any:
+        ...
+
+
+class Pickle(Codec):
+    name = "pickle"
+
+    def encode(self, value: Any) -> bytes:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, raw_data: bytes) -> Any:
+        return pickle.loads(raw_data)
+
+
+class Orjson(Codec):
+    name = "orjson"
+
+    def encode(self, value: Any) -> bytes:
+        return orjson.dumps(escape_keys(value), option=orjson.OPT_NON_STR_KEYS)
+
+    def decode(self, raw_data: bytes) -> Any:
+        return restore_keys(orjson.loads(raw_data))
+
+
+class Msgpack(Codec):
+    """Compact binary encoding, keeping int keys and telling apart bytes and str"""
+    name = "msgpack"
+
+    def encode(self, value: Any) -> bytes:
+        return msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, raw_data: bytes) -> Any:
+        return msgpack.unpackb(raw_data, raw=False, strict_map_key=False)
+
+
+class Zstd(Codec):
+    """Compress the output of another codec, for data written once and read rarely"""
+
+    def __init__(self, codec: Codec, *, level: int = 3):
+        self.codec = codec
+        self.level = level
+        self.name = f"{codec.name}+zstd"
+
+    def encode(self, value: Any) -> bytes:
+        return zstandard.ZstdCompressor(level=self.level).compress(self.codec.encode(value))
+
+    def decode(self, raw_data: bytes) -> Any:
+        return self.codec.decode(zstandard.ZstdDecompressor().decompress(raw_data))
+
+
+CODECS: dict[str, type[Codec]] = {
+    "pickle": Pickle,
+    "orjson": Orjson,
+    "msgpack": Msgpack,
+}
+
+
+def get_codec(name: str) -> Codec:
+    """Codec from its name, like msgpack or msgpack+zstd"""
+    base, _, compression = name.partition("+")
+
+    try:
+        codec = CODECS[base]()
+    except KeyError:
+        raise ValueError(f"Unknown codec: {base}") from None
+
+    if compression == "zstd":
+        return Zstd(codec)
+    if compression:
+        raise ValueError(f"Unknown compression: {compression}")
+
+    return codec
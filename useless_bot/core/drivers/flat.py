@@ -0,0 +1,265 @@
+from bisect import bisect_left, bisect_right, insort
+from typing import Any, Callable, Iterable, Optional, Union
+
+from .base import KeysSet
+
+_MISSING = object()
+
+# separator between the keys of an encoded path
+PATH_SEPARATOR = "\x1f"
+
+
+def encode_path(keys: KeysSet) -> str:
+    """Flatten a keys set into a string, keeping the type of every key"""
+    parts = []
+    for key in keys:
+        if type(key) is int:
+            parts.append(f"i{key}")
+        elif type(key) is str:
+            parts.append(f"s{key}")
+        else:
+            raise TypeError(f"Unsupported key type: {type(key).__name__}")
+
+    return PATH_SEPARATOR.join(parts)
+
+
+def decode_path(path: str) -> tuple[Union[str, int], ...]:
+    """Rebuild the keys set from a flattened path"""
+    if not path:
+        return ()
+
+    return tuple(int(part[1:]) if part[0] == "i" else part[1:] for part in path.split(PATH_SEPARATOR))
+
+
+class FlatStore:
+    """
+    Nested data stored by the full keys tuple of every value.
+    Dictionaries are not stored as objects: an index keeps the children of every dictionary,
+    so subtrees can still be read, while point reads and writes are a single hash lookup.
+    When track_changes is set, the paths changed since the last clear of `changed` are tracked individually.
+    """
+
+    def __init__(self, data: Optional[dict] = None, *, track_changes: bool = True):
+        self._values: dict[tuple, Any] = {}
+        # dictionary path -> its keys, in insertion order
+        self._children: dict[tuple, dict] = {(): {}}
+        self.changed: Optional[set[tuple]] = set() if track_changes else None
+        # open snapshots, they keep the values changed after they were taken
+        self._snapshots: list[Snapshot] = []
+        # sorted int and str keys of the dictionaries scanned, kept up to date as their keys change
+        self._sorted: dict[tuple, tuple[list, list]] = {}
+
+        if data:
+            self.replace(data)
+            if track_changes:
+                self.changed.clear()
+
+    @classmethod
+    def from_entries(cls, dictionaries: Iterable[tuple], values: Iterable[tuple[tuple, Any]]) -> "FlatStore":
+        """Build a store from the paths of its dictionaries and the (keys, value) pairs of its values"""
+        store = cls()
+
+        # parents must be indexed before their children
+        for keys in sorted(dictionaries, key=len):
+            if keys:
+                store._children[keys] = {}
+                store._children[keys[:-1]][keys[-1]] = None
+
+        for keys, value in values:
+            store._values[keys] = value
+            store._children[keys[:-1]][keys[-1]] = None
+
+        return store
+
+    def __len__(self) -> int:
+        return len(self._children[()])
+
+    def __contains__(self, keys: KeysSet) -> bool:
+        keys = tuple(keys)
+        return keys in self._values or keys in self._children
+
+    def is_dict(self, keys: tuple) -> bool:
+        return keys in self._children
+
+    def children(self, keys: KeysSet) -> Iterable:
+        """Keys of a dictionary, without building it"""
+        return self._children[tuple(keys)].keys()
+
+    def scan(self, keys: KeysSet, after: Union[str, int, None] = None, count: int = 1000) -> list:
+        """
+        At most count keys of a dictionary following after, int keys first.
+        The keys are sorted on the first scan, next scans are a binary search
+        """
+        keys = tuple(keys)
+        try:
+            ints, strs = self._sorted[keys]
+        except KeyError:
+            children = self._children[keys]
+            ints = sorted(key for key in children if type(key) is int)
+            strs = sorted(key for key in children if type(key) is str)
+            self._sorted[keys] = ints, strs
+
+        if after is None:
+            start = 0
+        elif type(after) is int:
+            start = bisect_right(ints, after)
+        else:
+            start = len(ints) + bisect_right(strs, after)
+
+        result = ints[start:start + count]
+        start = max(start - len(ints), 0)
+        return result + strs[start:start + count - len(result)]
+
+    def get(self, keys: KeysSet) -> Any:
+        keys = tuple(keys)
+
+        try:
+            return self._values[keys]
+        except KeyError:
+            pass
+
+        if keys in self._children:
+            return self._build(keys)
+
+        raise KeyError(keys[-1])
+
+    def set(self, keys: KeysSet, value: Any):
+        keys = tuple(keys)
+        if not keys:
+            self.replace(value)
+            return
+
+        parent = keys[:-1]
+        if parent not in self._children:
+            raise KeyError(parent[-1] if parent else keys[-1])
+
+        self._remove(keys)
+        self._insert(keys, value)
+        if keys[-1] not in self._children[parent]:
+            self._children[parent][keys[-1]] = None
+            self._index(parent, keys[-1], insort)
+
+    def setdefault(self, keys: KeysSet, value: Any) -> bool:
+        """Set value if keys are not set, return True if the value has been set"""
+        if keys in self:
+            return False
+
+        self.set(keys, value)
+        return True
+
+    def delete(self, keys: KeysSet):
+        keys = tuple(keys)
+        if keys not in self:
+            raise KeyError(keys[-1])
+
+        self._remove(keys)
+        del self._children[keys[:-1]][keys[-1]]
+        self._index(keys[:-1], keys[-1], self._unsort)
+
+    def replace(self, data: dict):
+        """Replace all the data"""
+        for key in list(self._children[()]):
+            self._remove((key,))
+
+        self._children[()] = {}
+        self._sorted.clear()
+        for key, value in data.items():
+            self._insert((key,), value)
+            self._children[()][key] = None
+
+    def snapshot(self) -> "Snapshot":
+        """Consistent view of the current data, must be closed after use"""
+        snapshot = Snapshot(self)
+        self._snapshots.append(snapshot)
+        return snapshot
+
+    def to_dict(self) -> dict:
+        return self._build(())
+
+    def _build(self, keys: tuple) -> dict:
+        result = {}
+        for key in self._children[keys]:
+            sub_keys = keys + (key,)
+            if sub_keys in self._children:
+                result[key] = self._build(sub_keys)
+            else:
+                result[key] = self._values[sub_keys]
+
+        return result
+
+    def _insert(self, keys: tuple, value: Any):
+        if self.changed is not None:
+            self.changed.add(keys)
+        for snapshot in self._snapshots:
+            snapshot.preserve(keys)
+
+        if type(value) is dict:
+            self._children[keys] = dict.fromkeys(value)
+            for key, sub_value in value.items():
+                self._insert(keys + (key,), sub_value)
+        else:
+            self._values[keys] = value
+
+    def _index(self, parent: tuple, key: Union[str, int], change: Callable[[list, Any], None]):
+        """Add or remove a key in the sorted keys of its parent, if they have been sorted"""
+        try:
+            ints, strs = self._sorted[parent]
+        except KeyError:
+            return
+
+        change(ints if type(key) is int else strs, key)
+
+    @staticmethod
+    def _unsort(keys: list, key: Union[str, int]):
+        del keys[bisect_left(keys, key)]
+
+    def _remove(self, keys: tuple):
+        """Remove a value or a dictionary and its content, the parent is left untouched"""
+        for snapshot in self._snapshots:
+            snapshot.preserve(keys)
+
+        if self._values.pop(keys, _MISSING) is not _MISSING:
+            if self.changed is not None:
+                self.changed.add(keys)
+            return
+
+        children = self._children.pop(keys, None)
+        if children is None:
+            return
+
+        self._sorted.pop(keys, None)
+        if self.changed is not None:
+            self.changed.add(keys)
+        for key in children:
+            self._remove(keys + (key,))
+
+
+class Snapshot:
+    """
+    View of a FlatStore at the time it was taken, without copying its values:
+    only the paths are listed, and the store keeps here the previous value of every path changed afterwards
+    """
+
+    def __init__(self, store: FlatStore):
+        self._store = store
+        self._previous: dict[tuple, Any] = {}
+
+        # parents come before their children
+        self.dictionaries: list[tuple] = sorted((keys for keys in store._children if keys), key=len)
+        self.values: list[tuple] = list(store._values)
+
+    def preserve(self, keys: tuple):
+        """Called by the store before changing keys"""
+        if keys not in self._previous:
+            self._previous[keys] = self._store._values.get(keys, _MISSING)
+
+    def get(self, keys: tuple) -> Any:
+        """Value of one of the paths in values"""
+        value = self._previous.get(keys, _MISSING)
+        if value is _MISSING:
+            return self._store._values[keys]
+
+        return value
+
+    def close(self):
+        self._store._snapshots.remove(self)
@@ -0,0 +1,51 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger("useless_bot.core.drivers.group_commit")
+
+
+class GroupCommit:
+    """
+    Group concurrent commit requests: requests made while a commit is running
+    wait for the next one, which serves all of them with a single call to commit.
+    """
+
+    def __init__(self, commit: Callable[[], Awaitable[None]]):
+        self._commit = commit
+
+        # commit waited by the requests not yet served
+        self._next: Optional[asyncio.Future] = None
+        self._waiters = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def request(self):
+        """Wait until a commit started after this call has completed"""
+        if self._next is None:
+            self._next = asyncio.get_running_loop().create_future()
+            self._waiters = 0
+
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+        self._waiters += 1
+        # a cancelled request must not cancel the commit of the others
+        await asyncio.shield(self._next)
+
+    async def _run(self):
+        try:
+            while self._next is not None:
+                group, self._next = self._next, None
+                waiters = self._waiters
+
+                try:
+                    await self._commit()
+                except Exception as error:
+                    group.set_exception(error)
+                    # retrieved here too, since every waiter could have been cancelled
+                    group.exception()
+                else:
+                    group.set_result(None)
+                    logger.debug(f"Committed {waiters} requests together")
+        finally:
+            self._task = None
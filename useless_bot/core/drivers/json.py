@@ -1,96 +1,271 @@
+import asyncio
 import logging
+import os
+from dataclasses import dataclass, field
 
 try:
     import orjson
-    import aiofiles
 except ImportError:
-    logging.debug("Cannot import orjson and aiofiles. JSON driver not supported")
+    logging.debug("Cannot import orjson. JSON driver not supported")
 
-from typing import Any
-from aiorwlock import RWLock
+from typing import Any, Optional
 
-from .base import Base, KeysSet
+from .base import KeysSet
+from .codecs import Codec, Orjson, Zstd, ZSTD_MAGIC, escape_keys, restore_keys
+from .flat import FlatStore, Snapshot
+from .sharded import Shard, Sharded, fsync_directory
+from ..metrics import metrics
 
+logger = logging.getLogger("useless_bot.core.drivers.json")
 
-class Json(Base):
-    _data: dict = None
+
+@dataclass
+class JsonShard(Shard):
+    log_file: str = ""
+    # encoded changes not yet written to the journal
+    journal: list[bytes] = field(default_factory=list)
+    log_size: int = 0
+    compacting: Optional[asyncio.Task] = None
+
+
+class Json(Sharded):
+    """
+    Store every cog in its own JSON snapshot (cog.json) and append every change
+    to a journal (cog.json.log), one JSON array per line.
+    The journal is replayed on top of the snapshot when the shard is opened,
+    and compacted into a new snapshot in background when it grows over compact_threshold bytes.
+    Snapshots are compressed with zstd when compress_snapshots is set.
+    """
+    # single file used before sharding, cogs found there are moved to their own shard
+    _legacy: Optional[dict] = None
     _file: str
     _auto_save: bool
+    _compact_threshold: int
+    _snapshot_codec: Codec
 
-    _lock: RWLock
-
-    def __init__(self, *, auto_save: bool = True, file: str = "data/config.json"):
-        self.__class__.file = file
+    def __init__(self, *, auto_save: bool = True, file: str = "data/config.json", directory: str = "data/json",
+                 compact_threshold: int = 4 * 1024 * 1024, compress_snapshots: bool = False):
+        super().__init__(directory=directory)
+        self.__class__._file = file
         self.__class__._auto_save = auto_save
-        self._lock = RWLock()
+        self.__class__._compact_threshold = compact_threshold
+        self.__class__._snapshot_codec = Zstd(Orjson()) if compress_snapshots else Orjson()
 
-        # load data
-        if not self._data:
-            with open(self._file, "rb") as file:
-                raw_data = file.read()
+    def _open(self, cog: str) -> JsonShard:
+        file = os.path.join(self._directory, f"{cog}.json")
+        log_file = f"{file}.log"
+        created = not os.path.exists(file) and not os.path.exists(log_file)
 
-            # decode data
-            self.__class__._data = orjson.loads(raw_data)
+        data, log_size = self._read(file, log_file)
+        # changes are tracked by the journal
+        shard = JsonShard(file=file, data=FlatStore(data.get("data", {}), track_changes=False), cog=cog,
+                          log_file=log_file, log_size=log_size)
 
-    async def setdefault(self, cog: str, keys: KeysSet, value: Any = None):
-        # If main_key is not set, initialize it with an empty dict, otherwise do nothing
-        partial = self.__class__._data[cog]
-        for key in keys[:-1]:
-            partial = partial[key]
+        if created:
+            legacy_data = self._legacy_data(cog)
+            if legacy_data is not None:
+                logger.info(f"Moving {cog} to its own shard")
+                shard.data.replace(legacy_data)
+                self._changed(shard, "s", [], legacy_data)
 
-        partial[keys[-1]].setdefault(cog, value)
+        return shard
 
-    async def set(self, cog: str, keys: KeysSet, value: Any):
-        partial = self.__class__._data[cog]
+    def _stored_cogs(self) -> set[str]:
+        cogs = set()
+        for name in os.listdir(self._directory):
+            for suffix in (".json", ".json.log"):
+                if name.endswith(suffix):
+                    cogs.add(name[:-len(suffix)])
 
-        for key in keys:
-            partial = partial[key]
+        return cogs
 
-        partial = value
+    def _legacy_data(self, cog: str) -> Optional[dict]:
+        if self._legacy is None:
+            self.__class__._legacy = self._read_snapshot(self._file)
 
-    async def get(self, cog: str, keys: KeysSet) -> Any:
-        partial = self.__class__._data[cog]
+        return self._legacy.get(cog)
 
-        for key in keys[:-1]:
-            partial = partial[key]
+    def _changed(self, shard: JsonShard, operation: str, keys: KeysSet, value: Any = None):
+        super()._changed(shard, operation, keys, value)
+
+        if operation == "s":
+            shard.journal.append(orjson.dumps((operation, keys, escape_keys(value)), option=orjson.OPT_NON_STR_KEYS)
+                                 + b"\n")
+        else:
+            shard.journal.append(orjson.dumps((operation, keys)) + b"\n")
+
+    async def _dump_shard(self, shard: JsonShard):
+        """Append the pending changes to the journal"""
+        async with shard.lock.writer_lock:
+            await self._flush_journal(shard)
+
+        if shard.log_size > self._compact_threshold and shard.compacting is None:
+            shard.compacting = asyncio.get_running_loop().create_task(self._compact(shard))
+
+    async def _close_shard(self, shard: JsonShard):
+        await super()._close_shard(shard)
+
+        # the snapshot must be complete before the shard is opened again
+        if shard.compacting is not None:
+            await shard.compacting
+
+    async def _flush_journal(self, shard: JsonShard):
+        if not shard.journal:
+            return
+
+        raw_data = b"".join(shard.journal)
+        journal, shard.journal = shard.journal, []
+        shard.dirty = False
+
+        try:
+            await self._run_io(self._append, shard.log_file, raw_data)
+        except Exception:
+            # keep the changes pending, before the ones made meanwhile, the next dump will retry
+            shard.journal[:0] = journal
+            shard.dirty = True
+            raise
+
+        shard.log_size += len(raw_data)
+        metrics.count(type(self).__name__, shard.cog, "bytes_written", len(raw_data))
 
-        return partial[keys[-1]]
+    async def _compact(self, shard: JsonShard):
+        """Write a new snapshot and drop the journal it covers"""
+        try:
+            async with shard.lock.writer_lock:
+                # the journal must be complete in case writing the snapshot fails
+                await self._flush_journal(shard)
+                # the snapshot keeps the data as it is now, changes go on meanwhile
+                snapshot = shard.data.snapshot()
+                end = shard.log_size
 
-    async def delete(self, cog: str, keys: KeysSet):
-        partial = self.__class__._data[cog]
+            try:
+                data = await self._build(snapshot)
+            finally:
+                snapshot.close()
 
+            logger.info(f"Compacting journal {shard.log_file} of {end} bytes")
+            # the data built is not shared, it is encoded off the loop
+            raw_data = await self._run_io(self._snapshot_codec.encode, {"data": data})
+            await self._run_io(self._write, shard.file, raw_data)
+            metrics.count(type(self).__name__, shard.cog, "bytes_written", len(raw_data))
+
+            # no change is appended while the journal is cut
+            async with shard.lock.writer_lock:
+                await self._run_io(self._cut, shard.log_file, end)
+                shard.log_size -= end
+        except Exception:
+            logger.error("Journal compaction failed", exc_info=True)
+        finally:
+            shard.compacting = None
+
+    @staticmethod
+    async def _build(snapshot: Snapshot, chunk_size: int = 10_000) -> dict:
+        """Nested data of a snapshot, built a chunk at a time so the loop runs between chunks"""
+        data = {}
+        dictionaries = {(): data}
+        for start in range(0, len(snapshot.dictionaries), chunk_size):
+            for keys in snapshot.dictionaries[start:start + chunk_size]:
+                dictionaries[keys] = dictionaries[keys[:-1]][keys[-1]] = {}
+            await asyncio.sleep(0)
+
+        for start in range(0, len(snapshot.values), chunk_size):
+            for keys in snapshot.values[start:start + chunk_size]:
+                dictionaries[keys[:-1]][keys[-1]] = snapshot.get(keys)
+            await asyncio.sleep(0)
+
+        return data
+
+    @staticmethod
+    def _apply(data: dict, operation: str, keys: list, value: Any = None) -> dict:
+        if not keys:
+            return restore_keys(value) if operation == "s" else {}
+
+        partial = data
         for key in keys[:-1]:
             partial = partial[key]
 
-        del partial[keys[-1]]
-
-    def register(self, cog: str, *, schema: dict, override_schema: bool):
-        if override_schema:
-            self.__class__._data[cog] = schema
+        if operation == "s":
+            partial[keys[-1]] = restore_keys(value)
         else:
-            self.__class__._data.setdefault(cog, schema)
+            partial.pop(keys[-1], None)
 
-    async def unregister(self, cog: str):
-        # delete main key and its data
-        del self.__class__._data[cog]
+        return data
+
+    @classmethod
+    def _replay(cls, data: dict, line: bytes) -> dict:
+        operation, keys, *value = orjson.loads(line)
+        # the data of the shard is kept under a single key, so it can be replaced as a whole
+        return cls._apply(data, operation, ["data", *keys], *value)
 
-    async def dump(self):
-        """Encode and save JSON data to file"""
-        async with self._lock.writer_lock:
-            # encode data
-            raw_data = orjson.dumps(self._data)
+    @staticmethod
+    def _read_snapshot(file: str) -> dict:
+        try:
+            with open(file, "rb") as fp:
+                raw_data = fp.read()
+        except FileNotFoundError:
+            return {}
 
-            # save data to file
-            async with open(self._file, "wb") as file:
-                await file.write(raw_data)
+        # decode data, snapshots can be compressed
+        codec = Zstd(Orjson()) if raw_data.startswith(ZSTD_MAGIC) else Orjson()
+        return codec.decode(raw_data)
 
     @classmethod
-    async def _load(cls):
-        """Read and decode JSON data from file"""
-        async with cls._lock.writer_lock:
-            # read data from file
-            async with open(cls._file, "rb") as file:
-                raw_data = await file.read()
-
-            # decode data
-            cls._data = orjson.loads(raw_data)
+    def _read(cls, file: str, log_file: str) -> tuple[dict, int]:
+        data = cls._read_snapshot(file)
+
+        try:
+            with open(log_file, "rb") as fp:
+                lines = fp.readlines()
+        except FileNotFoundError:
+            return data, 0
+
+        for line in lines:
+            try:
+                data = cls._replay(data, line)
+            except orjson.JSONDecodeError:
+                # a torn line can only be the last one, written during a crash
+                logger.warning(f"Ignoring incomplete line at the end of {log_file}")
+            except KeyError:
+                # the change was already in the snapshot, when a crash happened during compaction
+                continue
+
+        return data, sum(len(line) for line in lines)
+
+    @staticmethod
+    def _append(log_file: str, raw_data: bytes):
+        with open(log_file, "ab") as fp:
+            size = fp.tell()
+            try:
+                fp.write(raw_data)
+                fp.flush()
+                os.fsync(fp.fileno())
+            except OSError:
+                # drop a partial write, so the retry does not follow a torn line
+                fp.truncate(size)
+                raise
+
+    @staticmethod
+    def _write(file: str, raw_data: bytes):
+        # write the snapshot aside and swap it, so a crash never leaves a partial snapshot
+        with open(f"{file}.tmp", "wb") as fp:
+            fp.write(raw_data)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        os.replace(f"{file}.tmp", file)
+        fsync_directory(os.path.dirname(file) or ".")
+
+    @staticmethod
+    def _cut(log_file: str, end: int):
+        """Drop the first end bytes of the journal, covered by the snapshot"""
+        with open(log_file, "rb") as fp:
+            fp.seek(end)
+            tail = fp.read()
+
+        with open(f"{log_file}.tmp", "wb") as fp:
+            fp.write(tail)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        os.replace(f"{log_file}.tmp", log_file)
+        fsync_directory(os.path.dirname(log_file) or ".")
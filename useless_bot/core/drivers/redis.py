@@ -0,0 +1,483 @@
+import asyncio
+import logging
+import pickle
+from typing import Any, AsyncIterator, Iterator, Mapping, Optional, Union
+from uuid import uuid4
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:
+    logging.debug("Cannot import redis. Redis driver not supported")
+
+from .base import Base, KeysSet
+from .flat import PATH_SEPARATOR, encode_path, decode_path
+
+logger = logging.getLogger("useless_bot.core.drivers.redis")
+
+# value of the fields of dictionaries
+_DICT = b""
+
+# Lua helpers shared by the scripts. Paths of a subtree sort between path + "\x1f" and path + "\x20"
+_SUBTREE = """
+local function subtree(index, path)
+    if path == "" then
+        return redis.call("ZRANGEBYLEX", index, "(", "+")
+    end
+    return redis.call("ZRANGEBYLEX", index, "(" .. path .. "\\031", "(" .. path .. "\\032")
+end
+
+local function erase(hash, index, path)
+    if path == "" then
+        redis.call("DEL", hash, index)
+        return
+    end
+
+    local paths = subtree(index, path)
+    table.insert(paths, path)
+    for start = 1, #paths, 1000 do
+        local batch = {unpack(paths, start, math.min(start + 999, #paths))}
+        redis.call("HDEL", hash, unpack(batch))
+        redis.call("ZREM", index, unpack(batch))
+    end
+end
+"""
+
+# KEYS: hash, index. ARGV: mode, path, parent path or "" for the root, then the fields to write.
+# Return 0 if the parent is not a dictionary, 2 if setdefault kept the value set, 1 otherwise
+_SET = _SUBTREE + """
+local hash, index, mode, path = KEYS[1], KEYS[2], ARGV[1], ARGV[2]
+if path ~= "" and redis.call("HGET", hash, ARGV[3]) ~= "" then
+    return 0
+end
+if mode == "setdefault" and redis.call("HEXISTS", hash, path) == 1 then
+    return 2
+end
+
+erase(hash, index, path)
+for i = 4, #ARGV, 2 do
+    redis.call("HSET", hash, ARGV[i], ARGV[i + 1])
+    redis.call("ZADD", index, 0, ARGV[i])
+end
+return 1
+"""
+
+# KEYS: hash, index. ARGV: for every value its path, parent path, number of fields, then the fields to write.
+# Every parent is checked, after the values before it, before anything is written:
+# return the position (from 1) of the first value whose parent is not a dictionary, 0 once written
+_SET_MANY = _SUBTREE + """
+local hash, index = KEYS[1], KEYS[2]
+-- fields written by the values checked, with the position of their value and whether they are dictionaries,
+-- and the last position replacing the subtree of every path
+local written, replaced = {}, {}
+
+local function last_replaced(path)
+    local last = replaced[""] or 0
+    local start = 1
+    while path ~= "" do
+        local found = string.find(path, "\\031", start, true)
+        last = math.max(last, replaced[found and string.sub(path, 1, found - 1) or path] or 0)
+        if not found then
+            break
+        end
+        start = found + 1
+    end
+    return last
+end
+
+local function is_dict(path)
+    local last = last_replaced(path)
+    local field = written[path]
+    if field and field[1] >= last then
+        return field[2]
+    end
+    -- erased by a value before
+    if last > 0 then
+        return false
+    end
+    return redis.call("HGET", hash, path) == ""
+end
+
+local values = {}
+local i = 1
+while i <= #ARGV do
+    local path, parent, count = ARGV[i], ARGV[i + 1], tonumber(ARGV[i + 2])
+    local position = #values + 1
+    if path ~= "" and not is_dict(parent) then
+        return position
+    end
+
+    replaced[path] = position
+    for j = i + 3, i + 1 + count * 2, 2 do
+        written[ARGV[j]] = {position, ARGV[j + 1] == ""}
+    end
+    table.insert(values, {path, i + 3, count})
+    i = i + 3 + count * 2
+end
+
+for _, value in ipairs(values) do
+    erase(hash, index, value[1])
+    for j = value[2], value[2] + value[3] * 2 - 1, 2 do
+        redis.call("HSET", hash, ARGV[j], ARGV[j + 1])
+        redis.call("ZADD", index, 0, ARGV[j])
+    end
+end
+return 0
+"""
+
+# KEYS: hash, index. ARGV: path. Return nil if missing, {value} or {"", path, value, ...} for dictionaries
+_GET = _SUBTREE + """
+local hash, index, path = KEYS[1], KEYS[2], ARGV[1]
+local value = redis.call("HGET", hash, path)
+if not value or value ~= "" then
+    return value and {value}
+end
+
+local result = {""}
+local paths = subtree(index, path)
+for start = 1, #paths, 1000 do
+    local batch = {unpack(paths, start, math.min(start + 999, #paths))}
+    local values = redis.call("HMGET", hash, unpack(batch))
+    for i = 1, #batch do
+        table.insert(result, batch[i])
+        table.insert(result, values[i])
+    end
+end
+return result
+"""
+
+# KEYS: hash, index. ARGV: path. Return 0 if missing
+_DELETE = _SUBTREE + """
+if redis.call("HEXISTS", KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+erase(KEYS[1], KEYS[2], ARGV[1])
+return 1
+"""
+
+# KEYS: index. ARGV: prefix of the children paths ("" for the root), first path as a ZRANGEBYLEX bound, count.
+# Return the paths of the children, skipping the subtree of every child with a single lookup
+_SCAN = """
+local index, prefix, start, count = KEYS[1], ARGV[1], ARGV[2], tonumber(ARGV[3])
+local upper = "+"
+if prefix ~= "" then
+    upper = "(" .. string.sub(prefix, 1, -2) .. "\\032"
+end
+
+local result = {}
+while #result < count do
+    local paths = redis.call("ZRANGEBYLEX", index, start, upper, "LIMIT", 0, 1)
+    if #paths == 0 then
+        break
+    end
+    table.insert(result, paths[1])
+    start = "[" .. paths[1] .. "\\032"
+end
+return result
+"""
+
+# KEYS: hash. ARGV: minimum or "", maximum or "", then path and delta of every value.
+# Return {1, new values...}, or {error, index of the value}:
+# -1 missing, -2 not an integer, 0 under minimum, 2 over maximum
+_ADD = """
+local hash, minimum, maximum = KEYS[1], ARGV[1], ARGV[2]
+for i = 3, #ARGV, 2 do
+    local value = redis.call("HGET", hash, ARGV[i])
+    if not value then
+        return {-1, (i - 3) / 2}
+    end
+    if not string.match(value, "^-?%d+$") then
+        return {-2, (i - 3) / 2}
+    end
+    local result = tonumber(value) + tonumber(ARGV[i + 1])
+    if minimum ~= "" and result < tonumber(minimum) then
+        return {0, (i - 3) / 2}
+    end
+    if maximum ~= "" and result > tonumber(maximum) then
+        return {2, (i - 3) / 2}
+    end
+end
+
+local result = {1}
+for i = 3, #ARGV, 2 do
+    table.insert(result, redis.call("HINCRBY", hash, ARGV[i], ARGV[i + 1]))
+end
+return result
+"""
+
+# KEYS: claim. ARGV: value, time to live in milliseconds. Return 0 if claimed, or the milliseconds left
+_CLAIM = """
+if redis.call("SET", KEYS[1], ARGV[1], "NX", "PX", ARGV[2]) then
+    return 0
+end
+local left = redis.call("PTTL", KEYS[1])
+if left > 0 then
+    return left
+end
+-- expired since the SET, or stored without expiration: claim it now
+redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2])
+return 0
+"""
+
+
+def _encode(value: Any) -> bytes:
+    # integers are stored as text, so the scripts can add to them
+    if type(value) is int:
+        return str(value).encode()
+
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _decode(raw_value: bytes) -> Any:
+    # pickles start with the PROTO opcode, integers with a digit or a minus
+    if raw_value[:1] == b"\x80":
+        return pickle.loads(raw_value)
+
+    return int(raw_value)
+
+
+class Redis(Base):
+    """
+    Store every cog in a Redis hash, holding every value under its flattened key path,
+    and in a sorted set of the paths, so subtrees are read and deleted by range.
+    Every operation runs as a script on the server, so it is atomic even when many bot processes share the data.
+    Config locks only guard a single process: read-modify-write of shared values must use add,
+    and values claimed for a time must use claim, which stores them in keys expired by the server.
+    """
+    _data: "aioredis.Redis" = None
+    shared = True
+    _scripts: dict[str, Any] = {}
+
+    # schemas registered and not yet written, and schemas being written
+    _schemas: dict[str, tuple[dict, bool]] = {}
+    _registering: dict[str, asyncio.Future] = {}
+
+    def __init__(self, *, url: str = "redis://localhost:6379/0", prefix: str = "useless_bot",
+                 max_connections: int = 16, client: Optional["aioredis.Redis"] = None):
+        self._prefix = prefix
+
+        # Initialize _data, the connection pool is shared by every instance
+        if client is not None or not self._data:
+            self.__class__._data = client or aioredis.from_url(url, max_connections=max_connections)
+            self.__class__._scripts = {
+                "set": self._data.register_script(_SET),
+                "set_many": self._data.register_script(_SET_MANY),
+                "get": self._data.register_script(_GET),
+                "delete": self._data.register_script(_DELETE),
+                "add": self._data.register_script(_ADD),
+                "scan": self._data.register_script(_SCAN),
+                "claim": self._data.register_script(_CLAIM),
+            }
+
+    # --------|
+    # Helpers |
+    # --------|
+    def _keys(self, cog: str) -> list[str]:
+        """Hash of the values and index of the paths of cog"""
+        return [f"{self._prefix}:{cog}", f"{self._prefix}:{cog}:paths"]
+
+    def _claim_key(self, cog: str, keys: KeysSet) -> str:
+        return f"{self._prefix}:{cog}:claim:{encode_path(keys)}"
+
+    @property
+    def _cogs_key(self) -> str:
+        return f"{self._prefix}:cogs"
+
+    def _flatten(self, keys: tuple, value: Any) -> Iterator[bytes]:
+        if type(value) is dict:
+            yield encode_path(keys).encode()
+            yield _DICT
+            for key, sub_value in value.items():
+                yield from self._flatten(keys + (key,), sub_value)
+        else:
+            yield encode_path(keys).encode()
+            yield _encode(value)
+
+    def _write_args(self, mode: str, keys: KeysSet, value: Any) -> list:
+        keys = tuple(keys)
+        return [mode, encode_path(keys), encode_path(keys[:-1]), *self._flatten(keys, value)]
+
+    @staticmethod
+    def _missing_parent(cog: str, keys: KeysSet) -> KeyError:
+        return KeyError(keys[-2] if len(keys) > 1 else cog)
+
+    async def _ready(self, cog: str):
+        """Write the schema registered for cog, if any, before using its data"""
+        if cog in self._schemas:
+            schema, override_schema = self._schemas.pop(cog)
+            self._registering[cog] = asyncio.ensure_future(self._register(cog, schema, override_schema))
+
+        registering = self._registering.get(cog)
+        if registering is not None:
+            await asyncio.shield(registering)
+
+    async def _register(self, cog: str, schema: dict, override_schema: bool):
+        try:
+            async with self._data.pipeline(transaction=True) as pipeline:
+                await self._scripts["set"](keys=self._keys(cog), client=pipeline,
+                                           args=self._write_args("set" if override_schema else "setdefault",
+                                                                 (), schema))
+                await pipeline.sadd(self._cogs_key, cog)
+                await pipeline.execute()
+        finally:
+            del self._registering[cog]
+
+    # ----|
+    # API |
+    # ----|
+    async def setdefault(self, cog: str, keys: KeysSet, value: Any = None) -> bool:
+        # If the sub_key is not set, initialize it with value, otherwise do nothing
+        await self._ready(cog)
+        result = await self._scripts["set"](keys=self._keys(cog), args=self._write_args("setdefault", keys, value))
+        if not result:
+            raise self._missing_parent(cog, keys)
+        return result == 1
+
+    async def set(self, cog: str, keys: KeysSet, value: Any):
+        await self._ready(cog)
+        if not await self._scripts["set"](keys=self._keys(cog), args=self._write_args("set", keys, value)):
+            raise self._missing_parent(cog, keys)
+
+    async def set_many(self, cog: str, values: Mapping[tuple, Any]):
+        await self._ready(cog)
+
+        args = []
+        for keys, value in values.items():
+            keys = tuple(keys)
+            fields = list(self._flatten(keys, value))
+            args += [encode_path(keys), encode_path(keys[:-1]), len(fields) // 2, *fields]
+
+        # a single script: nothing is written if a parent is missing
+        position = await self._scripts["set_many"](keys=self._keys(cog), args=args)
+        if position:
+            raise self._missing_parent(cog, list(values)[position - 1])
+
+    async def get(self, cog: str, keys: KeysSet) -> Any:
+        await self._ready(cog)
+        reply = await self._scripts["get"](keys=self._keys(cog), args=[encode_path(keys)])
+
+        if reply is None:
+            raise KeyError(keys[-1] if keys else cog)
+
+        if reply[0] != _DICT:
+            return _decode(reply[0])
+
+        # parents always come before their children, so every node is created before being filled
+        depth = len(keys)
+        result = {}
+        for index in range(1, len(reply), 2):
+            relative = decode_path(reply[index].decode())[depth:]
+
+            partial = result
+            for key in relative[:-1]:
+                partial = partial[key]
+
+            partial[relative[-1]] = {} if reply[index + 1] == _DICT else _decode(reply[index + 1])
+
+        return result
+
+    async def delete(self, cog: str, keys: KeysSet):
+        await self._ready(cog)
+        if not await self._scripts["delete"](keys=self._keys(cog), args=[encode_path(keys)]):
+            raise KeyError(keys[-1] if keys else cog)
+
+    async def scan(self, cog: str, keys: KeysSet, after: Union[str, int, None] = None,
+                   count: int = 1000) -> list[Union[str, int]]:
+        await self._ready(cog)
+        path = encode_path(keys)
+        if await self._data.hget(self._keys(cog)[0], path) != _DICT:
+            raise KeyError(keys[-1] if keys else cog)
+
+        prefix = path + PATH_SEPARATOR if path else ""
+        start = f"({prefix}" if after is None else f"[{prefix}{encode_path((after,))}\x20"
+        paths = await self._scripts["scan"](keys=self._keys(cog)[1:], args=[prefix, start, count])
+        return [decode_path(child.decode())[-1] for child in paths]
+
+    async def add(self, cog: str, deltas: Mapping[tuple, int], minimum: Optional[int] = None,
+                  maximum: Optional[int] = None) -> list[int]:
+        await self._ready(cog)
+
+        paths = list(deltas)
+        args = ["" if minimum is None else minimum, "" if maximum is None else maximum]
+        for keys, delta in deltas.items():
+            args += [encode_path(keys), delta]
+
+        status, *result = await self._scripts["add"](keys=self._keys(cog)[:1], args=args)
+        if status == -1:
+            raise KeyError(paths[result[0]][-1])
+        if status == -2:
+            raise TypeError(f"{paths[result[0]]} is not an integer")
+        if status == 0:
+            raise ValueError(f"{paths[result[0]]} would be under {minimum}")
+        if status == 2:
+            raise OverflowError(f"{paths[result[0]]} would be over {maximum}")
+
+        return result
+
+    async def claim(self, cog: str, keys: KeysSet, value: Any, ttl: float) -> float:
+        # a key of its own, expired by the server
+        left = await self._scripts["claim"](keys=[self._claim_key(cog, keys)],
+                                            args=[_encode(value), max(1, int(ttl * 1000))])
+        return left / 1000
+
+    async def claimed(self, cog: str, keys: KeysSet) -> float:
+        return max(0, await self._data.pttl(self._claim_key(cog, keys))) / 1000
+
+    async def release(self, cog: str, keys: KeysSet):
+        await self._data.delete(self._claim_key(cog, keys))
+
+    def register(self, cog: str, *, schema: dict, override_schema: bool):
+        # written on first use of cog, since registering can not wait for the server
+        if override_schema or cog not in self._schemas:
+            self._schemas[cog] = (schema, override_schema)
+
+    async def unregister(self, cog: str):
+        # delete main key and its data
+        self._schemas.pop(cog, None)
+        await self._ready(cog)
+
+        async with self._data.pipeline(transaction=True) as pipeline:
+            await pipeline.delete(*self._keys(cog))
+            await pipeline.srem(self._cogs_key, cog)
+            await pipeline.execute()
+
+        claims = [key async for key in self._data.scan_iter(match=f"{self._prefix}:{cog}:claim:*", count=1000)]
+        for start in range(0, len(claims), 1000):
+            await self._data.delete(*claims[start:start + 1000])
+
+    async def dump(self, cog: Optional[str] = None):
+        # every write is sent to the server as it happens, the server persists them
+        for registered in [cog] if cog is not None else list(self._schemas):
+            await self._ready(registered)
+
+    async def cogs(self) -> list[str]:
+        return sorted(cog.decode() for cog in await self._data.smembers(self._cogs_key))
+
+    async def export(self, cog: str, chunk_size: int = 1000) -> AsyncIterator[list[tuple[tuple, Any]]]:
+        await self._ready(cog)
+
+        # copy the data of cog at once, then read the copy while the bot goes on
+        copies = [f"{key}:export:{uuid4().hex}" for key in self._keys(cog)]
+        async with self._data.pipeline(transaction=True) as pipeline:
+            for key, copy in zip(self._keys(cog), copies):
+                await pipeline.copy(key, copy)
+                # the copy is deleted by the server if the export is interrupted
+                await pipeline.expire(copy, 3600)
+            await pipeline.execute()
+
+        try:
+            # paths of parents sort before the paths of their children
+            start = 0
+            while True:
+                paths = await self._data.zrangebylex(copies[1], "(", "+", start=start, num=chunk_size)
+                if not paths:
+                    break
+
+                start += len(paths)
+                values = await self._data.hmget(copies[0], paths)
+                yield [(decode_path(path.decode()), {} if value == _DICT else _decode(value))
+                       for path, value in zip(paths, values)]
+        finally:
+            await self._data.delete(*copies)
+
+    async def _load(self):
+        """Data lives on the server, there is nothing to load"""
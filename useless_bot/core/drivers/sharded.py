@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import os
+from abc import ABC, abstractmethod
+from contextlib import suppress
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Any, AsyncIterator, Optional, Union
+
+from aiorwlock import RWLock
+
+from .base import Base, KeysSet
+from .flat import FlatStore
+from ..metrics import metrics
+
+logger = logging.getLogger("useless_bot.core.drivers.sharded")
+
+
+def fsync_directory(directory: str):
+    """Make the files created or renamed in directory durable"""
+    if os.name != "posix":
+        return
+
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@dataclass
+class Shard:
+    """Data of a single cog, stored in its own file"""
+    file: str
+    data: FlatStore
+    cog: str = ""
+    # only one dump of the shard can run at a time, set on the event loop once the shard is loaded
+    lock: Optional[RWLock] = None
+    dirty: bool = False
+
+
+class Sharded(Base, ABC):
+    """
+    Base for drivers storing every cog in its own file.
+    Every shard has its own lock and dirty state, so saving a cog never writes the others
+    and shards are dumped in parallel.
+    Shards are loaded lazily on the storage threads the first time their cog is used,
+    so registering cogs at startup never reads their files.
+    """
+    _shards: dict[str, Shard]
+    # shards being loaded, and schemas registered before their shard was loaded
+    _loading: dict[str, asyncio.Future]
+    _schemas: dict[str, tuple[dict, bool]]
+    # shards being unloaded, their cog is loaded again once they are written
+    _closing: dict[str, asyncio.Future]
+    _directory: str
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # shards are shared between the instances of a driver, not between drivers
+        cls._shards = {}
+        cls._loading = {}
+        cls._schemas = {}
+        cls._closing = {}
+
+    def __init__(self, *, directory: str):
+        self.__class__._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @abstractmethod
+    def _open(self, cog: str) -> Shard:
+        """Load the shard of a cog, creating it if needed"""
+        ...
+
+    @abstractmethod
+    async def _dump_shard(self, shard: Shard) -> None:
+        """Write the changes of a shard to its file"""
+        ...
+
+    @abstractmethod
+    def _stored_cogs(self) -> set[str]:
+        """Cogs having a shard in the directory"""
+        ...
+
+    async def _close_shard(self, shard: Shard) -> None:
+        """Write the changes of a shard and release its file, once the dumps running are done"""
+        if shard.dirty:
+            await self._dump_shard(shard)
+
+        async with shard.lock.writer_lock:
+            await self._release_shard(shard)
+
+    async def _release_shard(self, shard: Shard) -> None:
+        """Release the file of a shard"""
+        pass
+
+    async def _shard(self, cog: str) -> Shard:
+        """Shard of a cog, loaded on first use"""
+        try:
+            return self._shards[cog]
+        except KeyError:
+            pass
+
+        loading = self._loading.get(cog)
+        if loading is None:
+            loading = self._loading[cog] = asyncio.ensure_future(self._load_shard(cog))
+
+        # a cancelled caller must not cancel the load for the others
+        return await asyncio.shield(loading)
+
+    async def _load_shard(self, cog: str) -> Shard:
+        try:
+            closing = self._closing.get(cog)
+            if closing is not None:
+                with suppress(Exception):
+                    await asyncio.shield(closing)
+                # the shard could not be written, it is kept
+                if cog in self._shards:
+                    return self._shards[cog]
+
+            start = perf_counter()
+            shard = await self._run_io(self._open, cog)
+            shard.lock = RWLock()
+            elapsed = perf_counter() - start
+            metrics.observe(type(self).__name__, cog, "load", elapsed)
+            logger.info(f"Loaded {cog} in {elapsed * 1000:.1f}ms")
+
+            self._shards[cog] = shard
+            if cog in self._schemas:
+                self._apply_schema(shard, *self._schemas.pop(cog))
+
+            return shard
+        finally:
+            del self._loading[cog]
+
+    def _apply_schema(self, shard: Shard, schema: dict, override_schema: bool):
+        if override_schema or not shard.data:
+            with self._blocking():
+                shard.data.replace(schema)
+                self._changed(shard, "s", [], schema)
+
+    def _changed(self, shard: Shard, operation: str, keys: KeysSet, value: Any = None):
+        """Called after every change to the data of a shard"""
+        shard.dirty = True
+
+    async def setdefault(self, cog: str, keys: KeysSet, value: Any = None) -> bool:
+        # If the sub_key is not set, initialize it with value, otherwise do nothing
+        shard = await self._shard(cog)
+        with self._blocking():
+            if not shard.data.setdefault(keys, value):
+                return False
+            self._changed(shard, "s", keys, value)
+            return True
+
+    async def set(self, cog: str, keys: KeysSet, value: Any):
+        shard = await self._shard(cog)
+        # replacing or building a whole subtree is not free: measure it like the disk work
+        with self._blocking():
+            shard.data.set(keys, value)
+            self._changed(shard, "s", keys, value)
+
+    async def get(self, cog: str, keys: KeysSet) -> Any:
+        shard = await self._shard(cog)
+        with self._blocking():
+            return shard.data.get(keys)
+
+    async def scan(self, cog: str, keys: KeysSet, after: Union[str, int, None] = None,
+                   count: int = 1000) -> list[Union[str, int]]:
+        shard = await self._shard(cog)
+        with self._blocking():
+            return shard.data.scan(keys, after, count)
+
+    async def delete(self, cog: str, keys: KeysSet):
+        shard = await self._shard(cog)
+        with self._blocking():
+            shard.data.delete(keys)
+            self._changed(shard, "d", keys)
+
+    def register(self, cog: str, *, schema: dict, override_schema: bool):
+        shard = self._shards.get(cog)
+        if shard is not None:
+            self._apply_schema(shard, schema, override_schema)
+        elif override_schema or cog not in self._schemas:
+            # applied when the shard is loaded
+            self._schemas[cog] = (schema, override_schema)
+
+    async def unregister(self, cog: str):
+        # delete the data of the cog, its shard is kept
+        shard = await self._shard(cog)
+        with self._blocking():
+            shard.data.replace({})
+            self._changed(shard, "d", [])
+
+    async def dump(self, cog: Optional[str] = None):
+        if cog is None:
+            shards = list(self._shards.values())
+        else:
+            # a shard not loaded has nothing to write
+            shards = [self._shards[cog]] if cog in self._shards else []
+
+        await asyncio.gather(*(self._dump_shard(shard) for shard in shards if shard.dirty))
+
+    async def cogs(self) -> list[str]:
+        stored = await self._run_io(self._stored_cogs)
+        return sorted(stored.union(self._shards))
+
+    async def export(self, cog: str, chunk_size: int = 1000) -> AsyncIterator[list[tuple[tuple, Any]]]:
+        # a shard loaded only for the export is unloaded afterwards, so a backup never keeps every cog in memory
+        loaded = cog in self._shards or cog in self._loading
+        shard = await self._shard(cog)
+
+        # the shard keeps the values changed during the export in the snapshot
+        snapshot = shard.data.snapshot()
+        try:
+            for start in range(0, len(snapshot.dictionaries), chunk_size):
+                yield [(keys, {}) for keys in snapshot.dictionaries[start:start + chunk_size]]
+
+            for start in range(0, len(snapshot.values), chunk_size):
+                yield [(keys, snapshot.get(keys)) for keys in snapshot.values[start:start + chunk_size]]
+        finally:
+            snapshot.close()
+            if not loaded and not shard.dirty:
+                await self.unload(cog)
+
+    async def unload(self, cog: str):
+        # no change is made to the shard once it is out of _shards
+        shard = self._shards.pop(cog, None)
+        if shard is None:
+            # unloaded by another task, wait until it is written
+            closing = self._closing.get(cog)
+            if closing is not None:
+                await asyncio.shield(closing)
+            return
+
+        closing = self._closing[cog] = asyncio.ensure_future(self._unload_shard(shard))
+        await asyncio.shield(closing)
+
+    async def _unload_shard(self, shard: Shard):
+        try:
+            await self._close_shard(shard)
+        except Exception:
+            # keep the changes in memory, unless the cog was loaded again
+            self._shards.setdefault(shard.cog, shard)
+            raise
+        finally:
+            del self._closing[shard.cog]
+
+    async def _load(self):
+        """Reload every shard from its file"""
+        for cog in list(self._shards):
+            del self._shards[cog]
+            await self._shard(cog)
@@ -1,73 +1,261 @@
+import dbm
+import dbm.dumb
+import logging
+import os
 import pickle
 import shelve
-from typing import Any
+import struct
+import zlib
+from dataclasses import dataclass, field
+from typing import Optional
 
-from aiorwlock import RWLock
+from .codecs import Codec, Pickle, get_codec
+from .flat import FlatStore, encode_path, decode_path
+from .sharded import Shard, Sharded
+from ..metrics import metrics
 
-from .base import Base, KeysSet
+logger = logging.getLogger("useless_bot.core.drivers.shelve")
 
+# entry holding the format of a shard, written by every dump
+_VERSION_KEY = b"\x00version"
+_VERSION = b"2"
+# entry holding the name of the codec of the values, pickle when missing
+_CODEC_KEY = b"\x00codec"
+# value of the entries of dictionaries
+_DICT = b""
+# length and checksum of a record of the write-ahead log
+_WAL_HEADER = struct.Struct(">QI")
+# files of the dbm implementations, fsynced when the log is checkpointed
+_DBM_SUFFIXES = ("", ".db", ".dat", ".dir", ".pag")
+# other files of a shard
+_OTHER_SUFFIXES = (".bak", ".wal")
 
-class Shelve(Base):
-    _data: shelve.Shelf = None
+
+@dataclass
+class ShelveShard(Shard):
+    shelf: Optional[shelve.Shelf] = None
+    codec: Codec = field(default_factory=Pickle)
+    wal_size: int = 0
+
+
+class Shelve(Sharded):
+    """
+    Store every cog in its own shelf, with an entry for each value and dictionary.
+    Values of new shards are encoded with codec, existing shards keep the codec they were created with.
+    The changes of every dump are appended and fsynced to a write-ahead log (cog.wal) before updating the shelf,
+    the log is replayed when the shard is opened and checkpointed when it grows over checkpoint_size bytes.
+    """
+    # single shelf used before sharding, cogs found there are moved to their own shard
+    _legacy: Optional[shelve.Shelf] = None
     _file: str
+    _codec: Codec = Pickle()
+    _checkpoint_size: int
+
+    def __init__(self, *, file: str = "data/config", directory: str = "data/shelve", codec: str = "pickle",
+                 checkpoint_size: int = 1024 * 1024):
+        super().__init__(directory=directory)
+        self.__class__._file = file
+        self.__class__._codec = get_codec(codec)
+        self.__class__._checkpoint_size = checkpoint_size
 
-    _lock: RWLock
+    def _open(self, cog: str) -> ShelveShard:
+        file = os.path.join(self._directory, cog)
+        shelf = shelve.open(file, flag='c', protocol=pickle.HIGHEST_PROTOCOL)
+        self._recover(shelf, file)
 
-    def __init__(self, *, file: str = "data/config"):
-        self._file = file
-        self._lock = RWLock()
+        if _CODEC_KEY in shelf.dict:
+            codec = get_codec(shelf.dict[_CODEC_KEY].decode())
+        else:
+            codec = self._codec
 
-        # Initialize _data
-        if not self._data:
-            self.__class__._data = shelve.open(self._file, flag='c', protocol=pickle.HIGHEST_PROTOCOL, writeback=True)
+        # the whole cog is kept in memory, so reads never touch the file while a dump writes it
+        shard = ShelveShard(file=file, data=self._decode(shelf.dict, codec), cog=cog, shelf=shelf, codec=codec)
 
-    async def setdefault(self, cog: str, keys: KeysSet, value: Any = None):
-        # If main_key is not set, initialize it with an empty dict, otherwise do nothing
-        partial = self.__class__._data[cog]
-        for key in keys[:-1]:
-            partial = partial[key]
+        # every dump writes the version, so the shard has never been written
+        if _VERSION_KEY not in shelf.dict:
+            legacy_data = self._legacy_data(cog)
+            if legacy_data is not None:
+                logger.info(f"Moving {cog} to its own shard")
+                shard.data.replace(legacy_data)
+                # written before the shard is used, nothing else would write it if the cog is only read
+                self._write(shelf, file, self._encode_changes(shard), codec, 0, 0)
 
-        partial[keys[-1]].setdefault(cog, value)
+        return shard
 
-    async def set(self, cog: str, keys: KeysSet, value: Any):
-        partial = self.__class__._data[cog]
+    @staticmethod
+    def _decode(database, codec: Codec) -> FlatStore:
+        if _VERSION_KEY not in database:
+            return FlatStore()
 
-        for key in keys[:-1]:
-            partial = partial[key]
+        dictionaries = []
+        values = []
+        for raw_key in database.keys():
+            if raw_key in (_VERSION_KEY, _CODEC_KEY):
+                continue
 
-        # noinspection PyUnusedLocal
-        partial[keys[-1]] = value
+            keys = decode_path(raw_key.decode())
+            raw_value = database[raw_key]
 
-    async def get(self, cog: str, keys: KeysSet) -> Any:
-        partial = self.__class__._data[cog]
+            if raw_value == _DICT:
+                dictionaries.append(keys)
+            else:
+                values.append((keys, codec.decode(raw_value)))
 
-        for key in keys[:-1]:
-            partial = partial[key]
+        return FlatStore.from_entries(dictionaries, values)
 
-        return partial[keys[-1]]
+    def _stored_cogs(self) -> set[str]:
+        cogs = set()
+        for name in os.listdir(self._directory):
+            for suffix in _DBM_SUFFIXES[1:] + _OTHER_SUFFIXES:
+                if name.endswith(suffix):
+                    name = name[:-len(suffix)]
+                    break
 
-    async def delete(self, cog: str, keys: KeysSet):
-        partial = self.__class__._data[cog]
+            cogs.add(name)
 
-        for key in keys[:-1]:
-            partial = partial[key]
+        return cogs
 
-        del partial[keys[-1]]
+    def _legacy_data(self, cog: str) -> Optional[dict]:
+        if dbm.whichdb(self._file) is None:
+            return None
 
-    def register(self, cog: str, *, schema: dict, override_schema: bool):
-        if override_schema:
-            self.__class__._data[cog] = schema
-        else:
-            self.__class__._data.setdefault(cog, schema)
+        if self._legacy is None:
+            self.__class__._legacy = shelve.open(self._file, flag='r')
+
+        return self._legacy.get(cog)
+
+    async def _dump_shard(self, shard: ShelveShard):
+        async with shard.lock.writer_lock:
+            # written by the dump before, the shelf can be closed since
+            if not shard.dirty:
+                return
+            store = shard.data
 
-    async def unregister(self, cog: str):
-        # delete main key and its data
-        del self.__class__._data[cog]
+            # pickle the changed values on the loop, so the snapshot is consistent
+            with self._blocking():
+                changes = self._encode_changes(shard)
+                shard.dirty = False
 
-    async def dump(self):
-        async with self._lock.writer_lock:
             # write updated data to file
-            self._data.sync()
+            try:
+                shard.wal_size = await self._run_io(self._write, shard.shelf, shard.file, changes, shard.codec,
+                                                    shard.wal_size, self._checkpoint_size)
+            except Exception:
+                # keep the changes pending, the next dump will retry
+                store.changed.update(decode_path(key.decode()) for key in changes)
+                shard.dirty = True
+                raise
+
+            metrics.count(type(self).__name__, shard.cog, "bytes_written",
+                          sum(len(key) + len(raw_value or b"") for key, raw_value in changes.items()))
+
+    @staticmethod
+    def _encode_changes(shard: ShelveShard) -> dict[bytes, Optional[bytes]]:
+        """Encoded entries of the paths changed since the last dump, None for the deleted ones"""
+        store = shard.data
+        changes = {}
+        for keys in store.changed:
+            if store.is_dict(keys):
+                raw_value = _DICT
+            elif keys in store:
+                raw_value = shard.codec.encode(store.get(keys))
+            else:
+                raw_value = None
+
+            changes[encode_path(keys).encode()] = raw_value
+
+        store.changed.clear()
+        return changes
+
+    async def _release_shard(self, shard: ShelveShard):
+        await self._run_io(shard.shelf.close)
+
+    @classmethod
+    def _write(cls, shelf: shelve.Shelf, file: str, changes: dict[bytes, Optional[bytes]], codec: Codec,
+               wal_size: int, checkpoint_size: int) -> int:
+        """Log the changes durably and apply them to the shelf, return the new size of the log"""
+        record = pickle.dumps((changes, codec.name), protocol=pickle.HIGHEST_PROTOCOL)
+        with open(f"{file}.wal", "ab") as fp:
+            fp.write(_WAL_HEADER.pack(len(record), zlib.crc32(record)) + record)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        cls._apply(shelf.dict, changes, codec.name)
+
+        wal_size += _WAL_HEADER.size + len(record)
+        if wal_size > checkpoint_size:
+            cls._checkpoint(shelf, file)
+            return 0
+
+        return wal_size
+
+    @classmethod
+    def _recover(cls, shelf: shelve.Shelf, file: str):
+        """Apply the changes logged but maybe not written to the shelf before a crash"""
+        try:
+            with open(f"{file}.wal", "rb") as fp:
+                raw_data = fp.read()
+        except FileNotFoundError:
+            return
+
+        if not raw_data:
+            return
+
+        offset = 0
+        while offset < len(raw_data):
+            header = raw_data[offset:offset + _WAL_HEADER.size]
+            if len(header) < _WAL_HEADER.size:
+                break
+
+            length, checksum = _WAL_HEADER.unpack(header)
+            record = raw_data[offset + _WAL_HEADER.size:offset + _WAL_HEADER.size + length]
+            if len(record) < length or zlib.crc32(record) != checksum:
+                break
+
+            cls._apply(shelf.dict, *pickle.loads(record))
+            offset += _WAL_HEADER.size + length
+
+        if offset < len(raw_data):
+            # a torn record can only be the last one, its dump never completed
+            logger.warning(f"Ignoring incomplete record at the end of {file}.wal")
+
+        logger.info(f"Recovered {file} from its write-ahead log")
+        cls._checkpoint(shelf, file)
+
+    @staticmethod
+    def _checkpoint(shelf: shelve.Shelf, file: str):
+        """Make the shelf durable, so the log can start over"""
+        # the changes applied since the last checkpoint are in the log: the index of the database
+        # (rewritten as a whole by dbm.dumb) is written only here
+        if hasattr(shelf.dict, "sync"):
+            shelf.dict.sync()
+
+        for suffix in _DBM_SUFFIXES:
+            try:
+                fd = os.open(f"{file}{suffix}", os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        with open(f"{file}.wal", "wb"):
+            pass
+
+    @staticmethod
+    def _apply(database, changes: dict[bytes, Optional[bytes]], codec_name: str):
+        for key, raw_value in changes.items():
+            if raw_value is not None:
+                database[key] = raw_value
+            elif isinstance(database, dbm.dumb._Database):
+                # dbm.dumb rewrites its whole index on every deletion: drop the entry from the index in memory,
+                # it is written by the sync of the next checkpoint, like the other changes
+                if database._index.pop(key, None) is not None:
+                    database._modified = True
+            elif key in database:
+                del database[key]
 
-    async def _load(self):
-        self.__class__._data = shelve.open(self._file, flag='c', protocol=pickle.HIGHEST_PROTOCOL, writeback=True)
+        database[_VERSION_KEY] = _VERSION
+        database[_CODEC_KEY] = codec_name.encode()
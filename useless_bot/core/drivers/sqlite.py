@@ -0,0 +1,251 @@
+import logging
+import pickle
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Iterator, Optional, Union
+
+from aiorwlock import RWLock
+
+from .base import Base, KeysSet
+from .flat import PATH_SEPARATOR, encode_path, decode_path
+
+logger = logging.getLogger("useless_bot.core.drivers.sqlite")
+
+_SEP = PATH_SEPARATOR
+# first character after the separator, used as upper bound when scanning a subtree
+_SEP_END = chr(ord(PATH_SEPARATOR) + 1)
+
+
+class Sqlite(Base):
+    """
+    Store every value in its own row, identified by the flattened key path.
+    Dictionaries are stored as marker rows (with a NULL value) followed by the rows of their children,
+    so a write touches only the rows under the changed path.
+    """
+    _data: sqlite3.Connection = None
+    _file: str
+
+    _lock: RWLock
+
+    # a single thread uses the connection, so queries never run concurrently
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="useless_bot-sqlite")
+
+    # schemas registered and not yet written
+    _schemas: dict[str, tuple[dict, bool]] = {}
+
+    def __init__(self, *, file: str = "data/config.sqlite3"):
+        self._file = file
+        self._lock = RWLock()
+
+        # Initialize _data
+        if not self._data:
+            self.__class__._data = self._connect(self._file)
+
+    @staticmethod
+    def _connect(file: str) -> sqlite3.Connection:
+        # the connection is created here but used from the sqlite thread
+        connection = sqlite3.connect(file, check_same_thread=False)
+        # WAL lets readers go on while a commit is being written
+        connection.execute("PRAGMA journal_mode=WAL")
+        # every commit is durable, concurrent saves are grouped into a single commit
+        connection.execute("PRAGMA synchronous=FULL")
+        connection.execute("CREATE TABLE IF NOT EXISTS data ("
+                           "cog TEXT NOT NULL, "
+                           "path TEXT NOT NULL, "
+                           "value BLOB, "
+                           "PRIMARY KEY (cog, path)"
+                           ") WITHOUT ROWID")
+        connection.commit()
+        return connection
+
+    # --------|
+    # Helpers |
+    # --------|
+    def _row(self, cog: str, path: str) -> Optional[tuple[Optional[bytes]]]:
+        return self._data.execute("SELECT value FROM data WHERE cog = ? AND path = ?", (cog, path)).fetchone()
+
+    def _is_dict(self, cog: str, path: str) -> bool:
+        row = self._row(cog, path)
+        return row is not None and row[0] is None
+
+    def _subtree(self, cog: str, path: str) -> Iterator[tuple[str, Optional[bytes]]]:
+        if path:
+            return self._data.execute("SELECT path, value FROM data WHERE cog = ? AND path > ? AND path < ? "
+                                      "ORDER BY path", (cog, path + _SEP, path + _SEP_END))
+
+        return self._data.execute("SELECT path, value FROM data WHERE cog = ? AND path > '' ORDER BY path", (cog,))
+
+    def _build(self, cog: str, keys: KeysSet) -> dict:
+        """Rebuild the dictionary stored under keys"""
+        depth = len(keys)
+        result = {}
+
+        # parents always come before their children, so every node is created before being filled
+        for path, value in self._subtree(cog, encode_path(keys)):
+            relative = decode_path(path)[depth:]
+
+            partial = result
+            for key in relative[:-1]:
+                partial = partial[key]
+
+            partial[relative[-1]] = {} if value is None else pickle.loads(value)
+
+        return result
+
+    def _erase(self, cog: str, keys: KeysSet):
+        path = encode_path(keys)
+        self._data.execute("DELETE FROM data WHERE cog = ? AND path = ?", (cog, path))
+        if path:
+            self._data.execute("DELETE FROM data WHERE cog = ? AND path > ? AND path < ?",
+                               (cog, path + _SEP, path + _SEP_END))
+        else:
+            self._data.execute("DELETE FROM data WHERE cog = ?", (cog,))
+
+    def _write(self, cog: str, keys: KeysSet, value: Any):
+        self._erase(cog, keys)
+        self._data.executemany("INSERT INTO data (cog, path, value) VALUES (?, ?, ?)",
+                               ((cog, path, raw) for path, raw in self._flatten(tuple(keys), value)))
+
+    def _flatten(self, keys: tuple, value: Any) -> Iterator[tuple[str, Optional[bytes]]]:
+        if type(value) is dict:
+            yield encode_path(keys), None
+            for key, sub_value in value.items():
+                yield from self._flatten(keys + (key,), sub_value)
+        else:
+            yield encode_path(keys), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _check_parent(self, cog: str, keys: KeysSet):
+        if not self._is_dict(cog, encode_path(keys[:-1])):
+            raise KeyError(keys[-2] if len(keys) > 1 else cog)
+
+    def _setdefault(self, cog: str, keys: KeysSet, value: Any) -> bool:
+        self._check_parent(cog, keys)
+
+        if self._row(cog, encode_path(keys)) is not None:
+            return False
+
+        self._write(cog, keys, value)
+        return True
+
+    def _set(self, cog: str, keys: KeysSet, value: Any):
+        self._check_parent(cog, keys)
+        self._write(cog, keys, value)
+
+    def _get(self, cog: str, keys: KeysSet) -> Any:
+        row = self._row(cog, encode_path(keys))
+
+        if row is None:
+            raise KeyError(keys[-1] if keys else cog)
+
+        if row[0] is None:
+            return self._build(cog, keys)
+
+        return pickle.loads(row[0])
+
+    def _scan(self, cog: str, keys: KeysSet, after: Union[str, int, None], count: int) -> list[Union[str, int]]:
+        path = encode_path(keys)
+        if not self._is_dict(cog, path):
+            raise KeyError(keys[-1] if keys else cog)
+
+        # children are the rows of the subtree without a separator after the prefix
+        prefix = path + _SEP if path else ""
+        start = prefix if after is None else prefix + encode_path((after,))
+        if path:
+            rows = self._data.execute("SELECT path FROM data WHERE cog = ? AND path > ? AND path < ? "
+                                      "AND instr(substr(path, ?), ?) = 0 ORDER BY path LIMIT ?",
+                                      (cog, start, path + _SEP_END, len(prefix) + 1, _SEP, count))
+        else:
+            rows = self._data.execute("SELECT path FROM data WHERE cog = ? AND path > ? "
+                                      "AND instr(path, ?) = 0 ORDER BY path LIMIT ?", (cog, start, _SEP, count))
+
+        return [decode_path(child)[-1] for child, in rows]
+
+    def _delete(self, cog: str, keys: KeysSet):
+        if self._row(cog, encode_path(keys)) is None:
+            raise KeyError(keys[-1])
+
+        self._erase(cog, keys)
+
+    def _register(self, cog: str, schema: dict, override_schema: bool):
+        if override_schema or self._row(cog, "") is None:
+            self._write(cog, (), schema)
+
+    async def _ready(self, cog: str):
+        """Write the schema registered for cog, if any, before using its data"""
+        if cog in self._schemas:
+            # submitted before any later query, and the sqlite thread runs them in order
+            await self._run_io(self._register, cog, *self._schemas.pop(cog))
+
+    # ----|
+    # API |
+    # ----|
+    # every query runs on the sqlite thread, so the connection is only used by one thread at a time
+    async def setdefault(self, cog: str, keys: KeysSet, value: Any = None) -> bool:
+        # If the sub_key is not set, initialize it with value, otherwise do nothing
+        await self._ready(cog)
+        return await self._run_io(self._setdefault, cog, keys, value)
+
+    async def set(self, cog: str, keys: KeysSet, value: Any):
+        await self._ready(cog)
+        await self._run_io(self._set, cog, keys, value)
+
+    async def get(self, cog: str, keys: KeysSet) -> Any:
+        await self._ready(cog)
+        return await self._run_io(self._get, cog, keys)
+
+    async def delete(self, cog: str, keys: KeysSet):
+        await self._ready(cog)
+        await self._run_io(self._delete, cog, keys)
+
+    async def scan(self, cog: str, keys: KeysSet, after: Union[str, int, None] = None,
+                   count: int = 1000) -> list[Union[str, int]]:
+        await self._ready(cog)
+        return await self._run_io(self._scan, cog, keys, after, count)
+
+    def register(self, cog: str, *, schema: dict, override_schema: bool):
+        # written on first use of cog, since queries run on the sqlite thread
+        if override_schema or cog not in self._schemas:
+            self._schemas[cog] = (schema, override_schema)
+
+    async def unregister(self, cog: str):
+        # delete main key and its data
+        self._schemas.pop(cog, None)
+        await self._run_io(self._erase, cog, ())
+
+    async def dump(self, cog: Optional[str] = None):
+        for registered in [cog] if cog is not None else list(self._schemas):
+            await self._ready(registered)
+
+        async with self._lock.writer_lock:
+            # commit only the rows changed since the last dump, whatever their cog
+            await self._run_io(self._data.commit)
+
+    async def cogs(self) -> list[str]:
+        rows = await self._run_io(lambda: self._data.execute("SELECT DISTINCT cog FROM data ORDER BY cog").fetchall())
+        return [cog for cog, in rows]
+
+    async def export(self, cog: str, chunk_size: int = 1000) -> AsyncIterator[list[tuple[tuple, Any]]]:
+        await self._ready(cog)
+        await self.commit()
+
+        # a read transaction of another connection sees the data of the last commit until it ends
+        connection = await self._run_io(sqlite3.connect, self._file, check_same_thread=False)
+        try:
+            cursor = await self._run_io(self._begin_export, connection, cog)
+            while True:
+                rows = await self._run_io(cursor.fetchmany, chunk_size)
+                if not rows:
+                    break
+
+                yield [(decode_path(path), {} if value is None else pickle.loads(value)) for path, value in rows]
+        finally:
+            await self._run_io(connection.close)
+
+    @staticmethod
+    def _begin_export(connection: sqlite3.Connection, cog: str) -> sqlite3.Cursor:
+        connection.execute("BEGIN")
+        # paths of parents sort before the paths of their children
+        return connection.execute("SELECT path, value FROM data WHERE cog = ? AND path > '' ORDER BY path", (cog,))
+
+    async def _load(self):
+        self.__class__._data = await self._run_io(self._connect, self._file)
@@ -4,3 +4,9 @@ class BalanceUnderLimitError(Exception):
 
 class BalanceOverLimitError(Exception):
     pass
+
+
+class FreeCreditsCooldownError(Exception):
+    def __init__(self, seconds: int):
+        super().__init__(f"Free credits can be claimed again in {seconds} seconds")
+        self.seconds = seconds
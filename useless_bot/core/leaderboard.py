@@ -0,0 +1,140 @@
+import random
+from typing import Iterable, Optional
+
+# levels of the skip list, enough for 2 ** 32 users
+MAX_LEVEL = 32
+# key of the end of the list, greater than every (-balance, user_id) key
+_END = (float("inf"),)
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key: tuple, level: int):
+        self.key = key
+        self.next: list[Optional[_Node]] = [None] * level
+        # number of nodes skipped following next at every level, plus one
+        self.width = [1] * level
+
+
+class Leaderboard:
+    """
+    Users ordered by balance, highest first, and by user id on ties.
+    An indexable skip list: updates and ranks take O(log n), the top n users O(log n + n)
+    """
+
+    def __init__(self, balances: Optional[Iterable[tuple[int, int]]] = None, *, seed: Optional[int] = None):
+        self._random = random.Random(seed)
+        self._end = _Node(_END, 0)
+        self._head = _Node((), MAX_LEVEL)
+        self._head.next = [self._end] * MAX_LEVEL
+        self._balances: dict[int, int] = {}
+
+        for user_id, balance in balances or ():
+            self.update(user_id, balance)
+
+    def __len__(self) -> int:
+        return len(self._balances)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._balances
+
+    def _level(self) -> int:
+        level = 1
+        while level < MAX_LEVEL and self._random.random() < 0.5:
+            level += 1
+        return level
+
+    def _insert(self, key: tuple):
+        # last node before key at every level, and the nodes skipped to reach it
+        chain = [self._head] * MAX_LEVEL
+        steps = [0] * MAX_LEVEL
+        node = self._head
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level].key < key:
+                steps[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        new = _Node(key, self._level())
+        skipped = 0
+        for level in range(len(new.next)):
+            previous = chain[level]
+            new.next[level] = previous.next[level]
+            previous.next[level] = new
+            new.width[level] = previous.width[level] - skipped
+            previous.width[level] = skipped + 1
+            skipped += steps[level]
+
+        for level in range(len(new.next), MAX_LEVEL):
+            chain[level].width[level] += 1
+
+    def _remove(self, key: tuple):
+        chain = [self._head] * MAX_LEVEL
+        node = self._head
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+
+        removed = chain[0].next[0]
+        for level in range(len(removed.next)):
+            previous = chain[level]
+            previous.width[level] += removed.width[level] - 1
+            previous.next[level] = removed.next[level]
+
+        for level in range(len(removed.next), MAX_LEVEL):
+            chain[level].width[level] -= 1
+
+    def update(self, user_id: int, balance: int):
+        """Set the balance of a user, adding the user if needed"""
+        old_balance = self._balances.get(user_id)
+        if old_balance == balance:
+            return
+
+        if old_balance is not None:
+            self._remove((-old_balance, user_id))
+        self._insert((-balance, user_id))
+        self._balances[user_id] = balance
+
+    def remove(self, user_id: int):
+        balance = self._balances.pop(user_id, None)
+        if balance is not None:
+            self._remove((-balance, user_id))
+
+    def clear(self):
+        self._head.next = [self._end] * MAX_LEVEL
+        self._head.width = [1] * MAX_LEVEL
+        self._balances.clear()
+
+    def rank(self, user_id: int) -> int:
+        """Position of a user, starting from 1. KeyError if the user is not ranked"""
+        key = (-self._balances[user_id], user_id)
+
+        position = 0
+        node = self._head
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+
+        return position + 1
+
+    def top(self, n: int, start: int = 0) -> list[tuple[int, int]]:
+        """(user id, balance) of n users, from the position start (0 is the first)"""
+        # reach the node before start by skipping as many nodes as possible at every level
+        remaining = start
+        node = self._head
+        for level in reversed(range(MAX_LEVEL)):
+            while node.width[level] <= remaining and node.next[level] is not self._end:
+                remaining -= node.width[level]
+                node = node.next[level]
+
+        result = []
+        node = node.next[0]
+        while node is not self._end and len(result) < n:
+            balance, user_id = node.key
+            result.append((user_id, -balance))
+            node = node.next[0]
+
+        return result
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+import struct
+from contextlib import suppress
+from enum import IntEnum
+from time import time
+from typing import AsyncIterator, Iterator, NamedTuple, Optional
+
+logger = logging.getLogger("useless_bot.core.ledger")
+
+# a record: time in milliseconds, kind, user id, id of the other user of a move (0 otherwise),
+# change of the balance and balance after the change
+RECORD = struct.Struct("<qBQQqq")
+# a checkpoint: the size of the ledger it covers and the number of users, then the balance of every user
+CHECKPOINT_HEADER = struct.Struct("<8sQQ")
+CHECKPOINT_ENTRY = struct.Struct("<Qq")
+MAGIC = b"UBLEDGER"
+
+
+class Kind(IntEnum):
+    TRANSFER = 0
+    DEPOSIT = 1
+    WITHDRAW = 2
+    MOVE = 3
+    BLACKJACK = 4
+    AIRDROP = 5
+    # the account is created, deleted, or every account is deleted
+    OPEN = 6
+    CLOSE = 7
+    RESET = 8
+
+
+class Entry(NamedTuple):
+    time: float
+    kind: Kind
+    user_id: int
+    other_id: int
+    delta: int
+    balance: int
+
+
+class Ledger:
+    """
+    Append-only log of the changes of the bank balances, in fixed-size records.
+    The balances are checkpointed every checkpoint_every records, so they are recovered replaying only the tail.
+    Every record is written with a single write to a file opened in append mode, so the processes sharing
+    a storage can share the ledger without tearing records.
+    Records are synced sync_interval seconds after being appended
+    """
+
+    def __init__(self, directory: str = "data/ledger", *, checkpoint_every: int = 10_000,
+                 chunk_size: int = 4096, sync_interval: float = 5):
+        os.makedirs(directory, exist_ok=True)
+        self._file = os.path.join(directory, "ledger.bin")
+        self._checkpoint_file = os.path.join(directory, "checkpoint.bin")
+
+        self.checkpoint_every = checkpoint_every
+        # records read at once when reading the ledger
+        self.chunk_size = chunk_size
+        self.sync_interval = sync_interval
+
+        # drop the last record if it was written only partially
+        if os.path.exists(self._file):
+            size = os.path.getsize(self._file)
+            if size % RECORD.size:
+                logger.warning(f"Dropping an incomplete record at the end of {self._file}")
+                os.truncate(self._file, size - size % RECORD.size)
+
+        self._fd = os.open(self._file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._appended = 0
+        self._checkpoint_task: Optional[asyncio.Task] = None
+        self._sync_task: Optional[asyncio.Task] = None
+
+    def append(self, kind: Kind, user_id: int, delta: int, balance: int, other_id: int = 0):
+        """Record a change of a balance. Must be called from the event loop"""
+        os.write(self._fd, RECORD.pack(int(time() * 1000), kind, user_id, other_id, delta, balance))
+
+        self._appended += 1
+        if self._appended >= self.checkpoint_every and self._checkpoint_task is None:
+            self._checkpoint_task = asyncio.get_running_loop().create_task(self._checkpoint())
+
+        if self._sync_task is None:
+            self._sync_task = asyncio.get_running_loop().create_task(self._sync_later())
+
+    def _end(self) -> int:
+        """Size of the ledger"""
+        return os.fstat(self._fd).st_size
+
+    async def sync(self):
+        """Wait until the records are on disk"""
+        await asyncio.to_thread(os.fsync, self._fd)
+
+    async def _sync_later(self):
+        try:
+            await asyncio.sleep(self.sync_interval)
+            await self.sync()
+        except Exception:
+            logger.error("Ledger sync failed", exc_info=True)
+        finally:
+            self._sync_task = None
+
+    # -----------|
+    # Checkpoint |
+    # -----------|
+    async def checkpoint(self):
+        """Write the balance of every user, folding the records written since the last checkpoint"""
+        if self._checkpoint_task is None:
+            self._checkpoint_task = asyncio.get_running_loop().create_task(self._checkpoint())
+
+        await asyncio.shield(self._checkpoint_task)
+
+    async def _checkpoint(self):
+        try:
+            self._appended = 0
+            end = self._end()
+            # the checkpoint never covers records lost by a crash
+            await self.sync()
+            balances = await asyncio.to_thread(self._replay, end)
+            await asyncio.to_thread(self._write_checkpoint, balances, end)
+            logger.info(f"Ledger checkpoint written with {len(balances)} balances")
+        except Exception:
+            logger.error("Ledger checkpoint failed", exc_info=True)
+        finally:
+            self._checkpoint_task = None
+
+    def _read_checkpoint(self) -> tuple[dict[int, int], int]:
+        """Balances of the last checkpoint and size of the ledger they cover"""
+        try:
+            fp = open(self._checkpoint_file, "rb")
+        except FileNotFoundError:
+            return {}, 0
+
+        with fp:
+            magic, end, count = CHECKPOINT_HEADER.unpack(fp.read(CHECKPOINT_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{self._checkpoint_file} is not a ledger checkpoint")
+
+            balances = dict(CHECKPOINT_ENTRY.iter_unpack(fp.read(count * CHECKPOINT_ENTRY.size)))
+            return balances, end
+
+    def _write_checkpoint(self, balances: dict[int, int], end: int):
+        # the checkpoint is replaced only once complete, other processes can be writing one too
+        tmp_file = f"{self._checkpoint_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as fp:
+            fp.write(CHECKPOINT_HEADER.pack(MAGIC, end, len(balances)))
+            for entry in balances.items():
+                fp.write(CHECKPOINT_ENTRY.pack(*entry))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        os.replace(tmp_file, self._checkpoint_file)
+
+    def _records(self, start: int, end: int) -> Iterator[tuple]:
+        """Records between the offsets start and end, oldest first"""
+        with open(self._file, "rb") as fp:
+            fp.seek(start)
+            while start < end:
+                data = fp.read(min(self.chunk_size * RECORD.size, end - start))
+                start += len(data)
+                yield from RECORD.iter_unpack(data)
+
+    def _replay(self, end: int) -> dict[int, int]:
+        """Balances after the records before the offset end, replaying the records after the last checkpoint"""
+        balances, start = self._read_checkpoint()
+        for _, kind, user_id, _, _, balance in self._records(start, end):
+            if kind == Kind.RESET:
+                balances.clear()
+            elif kind == Kind.CLOSE:
+                balances.pop(user_id, None)
+            else:
+                balances[user_id] = balance
+
+        return balances
+
+    async def balances(self) -> dict[int, int]:
+        """Balance of every user, recovered from the ledger"""
+        return await asyncio.to_thread(self._replay, self._end())
+
+    # --------|
+    # History |
+    # --------|
+    def _read_user(self, user_id: int, start: int, end: int) -> list[tuple]:
+        return [record for record in self._records(start, end) if record[2] == user_id]
+
+    async def history(self, user_id: int) -> AsyncIterator[Entry]:
+        """Records of a user, newest first, reading the ledger backwards a chunk at a time"""
+        end = self._end()
+        while end > 0:
+            start = max(0, end - self.chunk_size * RECORD.size)
+            records = await asyncio.to_thread(self._read_user, user_id, start, end)
+            for timestamp, kind, _, other_id, delta, balance in reversed(records):
+                yield Entry(timestamp / 1000, Kind(kind), user_id, other_id, delta, balance)
+            end = start
+
+    async def close(self):
+        """Wait for the running checkpoint and sync the records"""
+        if self._checkpoint_task is not None:
+            await self._checkpoint_task
+
+        task, self._sync_task = self._sync_task, None
+        if task is not None:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+
+        await self.sync()
+        os.close(self._fd)
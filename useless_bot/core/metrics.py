@@ -0,0 +1,130 @@
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+from typing import Any, Callable, Optional
+
+# upper bounds of the latency buckets, in seconds: 4 buckets per decade from 1µs to 10s
+BUCKETS = tuple(10 ** (exponent / 4) for exponent in range(-24, 5))
+
+
+class Histogram:
+    """Latencies in fixed logarithmic buckets, so observing is cheap and memory is constant"""
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # the last bucket holds values over the last bound
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+
+    def percentile(self, percent: float) -> float:
+        """Upper bound of the bucket holding the percentile, or the max value if it is lower"""
+        rank = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKETS[index], self.max) if index < len(BUCKETS) else self.max
+
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+def _cog_label(cog: str) -> str:
+    """The guild partitions of a cog (cog.guild_id) share the label of the cog, so labels don't grow with guilds"""
+    name, _, guild_id = cog.rpartition(".")
+    return name if name and guild_id.isdecimal() else cog
+
+
+class Metrics:
+    """
+    Counters, maxima and latency histograms of the storage operations,
+    labelled by source (config or the driver class), cog and operation
+    """
+
+    def __init__(self):
+        self._histograms: dict[tuple[str, str, str], Histogram] = {}
+        self._counters: dict[tuple[str, str, str], int] = {}
+        self._maxima: dict[tuple[str, str, str], float] = {}
+
+    def observe(self, source: str, cog: str, operation: str, seconds: float):
+        key = (source, _cog_label(cog), operation)
+        try:
+            histogram = self._histograms[key]
+        except KeyError:
+            histogram = self._histograms[key] = Histogram()
+
+        histogram.observe(seconds)
+
+    def count(self, source: str, cog: str, name: str, value: int = 1):
+        key = (source, _cog_label(cog), name)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def maximum(self, source: str, cog: str, name: str, value: float):
+        """Keep the highest value seen"""
+        key = (source, _cog_label(cog), name)
+        if value > self._maxima.get(key, float("-inf")):
+            self._maxima[key] = value
+
+    def snapshot(self) -> dict:
+        """Current values, latencies in seconds"""
+        return {
+            "latencies": [
+                {"source": source, "cog": cog, "operation": operation, **histogram.to_dict()}
+                for (source, cog, operation), histogram in self._histograms.items()
+            ],
+            "counters": [
+                {"source": source, "cog": cog, "name": name, "value": value}
+                for (source, cog, name), value in self._counters.items()
+            ],
+            "maxima": [
+                {"source": source, "cog": cog, "name": name, "value": value}
+                for (source, cog, name), value in self._maxima.items()
+            ],
+        }
+
+    def reset(self):
+        self._histograms.clear()
+        self._counters.clear()
+        self._maxima.clear()
+
+
+metrics = Metrics()
+
+
+def measured(operation: str, *, source: Optional[str] = None, cog: Callable[..., str]) -> Callable:
+    """
+    Record the latency of a coroutine method.
+    cog extracts the label of the cog from the arguments, source defaults to the class of the instance
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        async def wrapper(self, *args, **kwargs) -> Any:
+            start = perf_counter()
+            try:
+                return await func(self, *args, **kwargs)
+            finally:
+                metrics.observe(source or type(self).__name__, cog(self, *args, **kwargs), operation,
+                                perf_counter() - start)
+
+        return wrapper
+
+    return decorator
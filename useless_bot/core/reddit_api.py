@@ -2,7 +2,6 @@ from __future__ import annotations
 
 import logging
 from dataclasses import dataclass
-from time import time
 from typing import Optional, Union
 from uuid import uuid4
 
@@ -51,8 +50,8 @@ class Forbidden(Exception):
 
 
 class RedditAPI:
-    expires_in: int = 0
-    last_auth_time: int = 0
+    # the token is renewed this many seconds before reddit expires it
+    token_margin: int = 60
 
     def __init__(self,
                  client_id: str,
@@ -71,7 +70,17 @@ class RedditAPI:
         self.headers = headers
         self._session = session
 
-    async def _auth(self):
+    async def _authorize(self):
+        """Set the bearer token in headers, getting a new one if it has expired"""
+        try:
+            token = await self.config.get(["token"])
+        except KeyError:
+            logging.info("Token has expired")
+            token = await self._auth()
+
+        self.headers["Authorization"] = f"bearer {token}"
+
+    async def _auth(self) -> str:
         """Authorize bot and save bearer token"""
         logging.info("Starting authentication with RedditAPI")
         data = {
@@ -90,9 +99,8 @@ class RedditAPI:
         logging.info("Authentication with RedditAPI successful")
 
         token = resp_data["access_token"]
-        self.last_auth_time = int(time())
-        self.expires_in = resp_data["expires_in"] + self.last_auth_time
-        self.headers["Authorization"] = f"bearer {token}"
+        await self.config.set(["token"], token, ttl=max(resp_data["expires_in"] - self.token_margin, 0))
+        return token
 
     async def listing(self,
                       endpoint: str,
@@ -101,10 +109,7 @@ class RedditAPI:
                       g: str = "GLOBAL",
                       show: Optional[str] = None,
                       sr_detail: Optional[str] = None) -> list[Post]:
-        # if the token has expired, get a new one, otherwise do nothing
-        if self.expires_in <= self.last_auth_time:
-            logging.info("Token has expired")
-            await self._auth()
+        await self._authorize()
 
         # build body for request
         data = {
@@ -146,9 +151,7 @@ class RedditAPI:
         return await self.listing(endpoint=f"/r/{subreddits_str}/hot.json", count=count, limit=limit)
 
     async def link(self, link: str) -> Post:
-        if self.expires_in <= self.last_auth_time:
-            logging.debug("Token has expired")
-            await self._auth()
+        await self._authorize()
 
         post_url = URL(link.removesuffix("/").removesuffix(".json") + ".json").with_host("oauth.reddit.com")
         logging.info("Getting post from Reddit API")
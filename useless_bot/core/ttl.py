@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+from contextlib import suppress
+from itertools import count
+from time import time
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .config import Config
+
+logger = logging.getLogger("useless_bot.core.ttl")
+
+
+class Sweeper:
+    """
+    Remove expired keys in background.
+    Expirations are kept in a heap, so the sweeper sleeps until the earliest one
+    and removes the expired keys in batches of batch_size.
+    """
+
+    def __init__(self, *, batch_size: int = 100):
+        self.batch_size = batch_size
+
+        # (expires_at, tie breaker, config, keys)
+        self._heap: list[tuple[float, int, Config, tuple]] = []
+        self._counter = count()
+
+        # created on first use, so they are bound to the running event loop
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, config: Config, keys: tuple, expires_at: float):
+        """Remove keys from config at expires_at. Must be called from the event loop"""
+        entry = (expires_at, next(self._counter), config, keys)
+        heapq.heappush(self._heap, entry)
+
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        elif self._heap[0] is entry:
+            # the sweeper is sleeping until a later expiration
+            self._wakeup.set()
+
+    def cancel(self, config: Config):
+        """Forget the expirations scheduled for config"""
+        heap = [entry for entry in self._heap if entry[2] is not config]
+        if len(heap) != len(self._heap):
+            heapq.heapify(heap)
+            self._heap = heap
+
+    async def _run(self):
+        # stop when closed, even if the cancellation was lost: wait_for swallows it if the event is set meanwhile
+        while self._task is not None:
+            timeout = self._heap[0][0] - time() if self._heap else None
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            self._wakeup.clear()
+
+            try:
+                await self.sweep()
+            except Exception:
+                logger.error("Expired keys sweep failed", exc_info=True)
+
+    async def sweep(self) -> int:
+        """Remove a batch of expired keys, return the number of keys removed"""
+        now = time()
+        batches: dict[Config, list[tuple]] = {}
+
+        for _ in range(self.batch_size):
+            if not self._heap or self._heap[0][0] > now:
+                break
+
+            _, _, config, keys = heapq.heappop(self._heap)
+            batches.setdefault(config, []).append(keys)
+
+        removed = 0
+        for config, paths in batches.items():
+            removed += await config._expire(paths)
+
+        if self._heap and self._heap[0][0] <= now:
+            # more keys expired than a batch, continue without waiting
+            self._wakeup.set()
+
+        if removed:
+            logger.debug(f"Removed {removed} expired keys")
+
+        return removed
+
+    async def close(self):
+        """Stop the background task, pending expirations are applied lazily or on the next start"""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from contextlib import suppress
+from typing import Optional
+
+from .drivers import Base
+
+logger = logging.getLogger("useless_bot.core.write_behind")
+
+
+class WriteBehind:
+    """Count the changes made to a driver and dump them in background"""
+
+    def __init__(self, driver: Base, *, interval: float, threshold: int):
+        self._driver = driver
+
+        # flush every interval seconds or after threshold changes, whichever comes first
+        self.interval = interval
+        self.threshold = threshold
+
+        self._dirty = 0
+        # created on first use, so they are bound to the running event loop
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def dirty(self) -> int:
+        """Number of changes not yet written to disk"""
+        return self._dirty
+
+    def mark_dirty(self):
+        """Register a change. Must be called from the event loop"""
+        self._dirty += 1
+
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+        if self._dirty >= self.threshold:
+            self._wakeup.set()
+
+    async def _run(self):
+        # stop when closed, even if the cancellation was lost: wait_for swallows it if the event is set meanwhile
+        while self._task is not None:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                logger.error("Background flush failed", exc_info=True)
+
+    async def flush(self):
+        """Write pending changes to disk"""
+        if self._dirty == 0:
+            return
+
+        dirty = self._dirty
+        self._dirty = 0
+
+        try:
+            await self._driver.commit()
+        except Exception:
+            # keep the changes pending, the next flush will retry
+            self._dirty += dirty
+            raise
+
+        logger.debug(f"Flushed {dirty} changes")
+
+    async def close(self):
+        """Stop the background task and write pending changes"""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+
+        await self.flush()